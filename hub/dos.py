@@ -280,6 +280,63 @@ def offset_or_add(offsets,
   results.update(second_results)
   return results
 
+
+def count_param_values(method,
+                       path,
+                       param,
+                       value_list,
+                       period,
+                       header='REMOTE_ADDR'):
+  """Counts executions for many values of a rate-limited parameter at once.
+
+  Uses the same rate-limit keys as limit() with the same 'param' and 'header',
+  so a handler that accepts many requests in one call can share the limits
+  of the handler that accepts them one at a time.
+
+  Args:
+    method: HTTP method of the limited handler, e.g., 'POST'.
+    path: Request path of the limited handler.
+    param: The limited request parameter.
+    value_list: List of values of the parameter, one per request; the same
+      value may appear more than once.
+    period: Period of the rate limit, in seconds.
+    header: Header used for the rate limit, or None; see limit().
+
+  Returns:
+    List with the count of executions within the period for each value in
+    value_list, including those before it in the list. None is returned for
+    values that should not be limited, such as when memcache is unavailable.
+  """
+  if DISABLE_FOR_TESTING:
+    return [None] * len(value_list)
+
+  suffix = []
+  if header:
+    header_value = os.environ.get(header)
+    if not header_value:
+      logging.critical('Incomplete rate-limit keys on "%s %s" for param = '
+                       '"%s", header = "%s"', method, path, param, header)
+      return [None] * len(value_list)
+    suffix.append('%s=%s' % (header, header_value))
+
+  key_list = [' '.join([method, path, '%s=%s' % (param, value)] + suffix)
+              for value in value_list]
+  offsets = {}
+  for key in key_list:
+    offsets[key] = offsets.get(key, 0) + 1
+  results = offset_or_add(offsets, period)
+
+  count_list = []
+  seen = {}
+  for key in key_list:
+    seen[key] = seen.get(key, 0) + 1
+    total = results.get(key)
+    if total is None:
+      count_list.append(None)
+    else:
+      count_list.append(total - offsets[key] + seen[key])
+  return count_list
+
 ################################################################################
 
 # TODO: Support more than 1MB of sample data by using multiple memcache calls
@@ -976,24 +1033,32 @@ class UrlScorer(object):
     keys.extend('failure:' + d for d in domain_list)
     values = memcache.get_multi(keys, key_prefix=self.prefix)
 
-    result = []
-    for domain in domain_list:
-      success = values.get('success:' + domain, 0)
-      failure = values.get('failure:' + domain, 0)
-      requests = success + failure
+    return [self._score(values, domain) for domain in domain_list]
 
-      if requests > 0:
-        failure_percentage = (1.0 * failure) / requests
-      else:
-        failure_percentage = 0
+  def _score(self, values, domain):
+    """Scores a single domain based on its success and failure counts.
 
-      allow = bool(
-          DISABLE_FOR_TESTING or
-          requests < self.min_requests or
-          failure_percentage < self.max_failure_percentage)
-      result.append((allow, failure_percentage))
+    Args:
+      values: Dictionary of memcache values retrieved for the domain.
+      domain: The domain to score.
 
-    return result
+    Returns:
+      Tuple (allowed, failure_percentage) as returned by filter().
+    """
+    success = values.get('success:' + domain, 0)
+    failure = values.get('failure:' + domain, 0)
+    requests = success + failure
+
+    if requests > 0:
+      failure_percentage = (1.0 * failure) / requests
+    else:
+      failure_percentage = 0
+
+    allow = bool(
+        DISABLE_FOR_TESTING or
+        requests < self.min_requests or
+        failure_percentage < self.max_failure_percentage)
+    return allow, failure_percentage
 
   def report(self, success, failure):
     """Reports the status of interactions with a set of URLs.
@@ -1053,3 +1118,226 @@ class UrlScorer(object):
     values = dict(('failure:' + get_url_domain(u), self.min_requests)
                   for u in urls)
     memcache.set_multi(values, key_prefix=self.prefix)
+
+
+class CircuitBreaker(UrlScorer):
+  """UrlScorer that opens a circuit for domains that fail too often.
+
+  A domain starts out 'closed' and is scored just like with UrlScorer. Once
+  its failure rate goes over the maximum, the circuit 'opens' and all requests
+  to the domain are blocked for an open period. After the open period the
+  circuit is 'half-open' and only a few probe requests are allowed through.
+  A successful probe closes the circuit and clears the domain's score; a
+  failed probe opens the circuit again for twice as long, up to a maximum.
+  """
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half-open'
+
+  def __init__(self,
+               period=None,
+               min_requests=None,
+               max_failure_percentage=None,
+               prefix=None,
+               open_period=None,
+               max_open_period=None,
+               probe_count=None):
+    """Initializer.
+
+    Args:
+      period, min_requests, max_failure_percentage, prefix: See UrlScorer.
+      open_period: How long, in seconds, a circuit stays open the first time
+        it trips. Each consecutive trip doubles this period. Must be a
+        positive number, forced to integer.
+      max_open_period: Maximum time, in seconds, a circuit will stay open.
+        Must be at least the open_period, forced to integer.
+      probe_count: How many requests to allow through while the circuit is
+        half-open. Must be a positive integer.
+
+    Raises:
+      ConfigError if any of the parameters above are invalid.
+    """
+    UrlScorer.__init__(self,
+                       period=period,
+                       min_requests=min_requests,
+                       max_failure_percentage=max_failure_percentage,
+                       prefix=prefix)
+    try:
+      open_period = int(open_period)
+    except (TypeError, ValueError), e:
+      raise ConfigError('Invalid open_period: %s' % e)
+    if open_period <= 0:
+      raise ConfigError('open_period must be positive')
+
+    try:
+      max_open_period = int(max_open_period)
+    except (TypeError, ValueError), e:
+      raise ConfigError('Invalid max_open_period: %s' % e)
+    if max_open_period < open_period:
+      raise ConfigError('max_open_period must be at least open_period')
+
+    try:
+      probe_count = int(probe_count)
+    except (TypeError, ValueError), e:
+      raise ConfigError('Invalid probe_count: %s' % e)
+    if probe_count <= 0:
+      raise ConfigError('probe_count must be positive')
+
+    self.open_period = open_period
+    self.max_open_period = max_open_period
+    self.probe_count = probe_count
+
+  def filter(self, urls, now=time.time):
+    """Checks if each URL can proceed based on its domain's circuit.
+
+    Args:
+      urls: Iterable of URLs to check. Each input URL will have a corresponding
+        result returned in the same order they were passed in.
+      now: Returns the current time in seconds since the epoch. Used in tests.
+
+    Returns:
+      List of tuple (allowed, failure_percentage) as with UrlScorer.filter.
+    """
+    domain_list = [get_url_domain(u) for u in urls]
+    keys = []
+    for domain in domain_list:
+      keys.extend(('success:' + domain,
+                   'failure:' + domain,
+                   'open_until:' + domain))
+    values = memcache.get_multi(keys, key_prefix=self.prefix)
+    current = now()
+
+    result = []
+    tripped = set()
+    for domain in domain_list:
+      allow, failure_percentage = self._score(values, domain)
+      open_until = values.get('open_until:' + domain)
+      if DISABLE_FOR_TESTING:
+        pass
+      elif domain in tripped:
+        allow = False
+      elif open_until is None:
+        if not allow:
+          logging.warning('Opening circuit for domain %s with failure '
+                          'rate %.2f%%', domain, 100 * failure_percentage)
+          tripped.add(domain)
+      elif current < open_until:
+        allow = False
+      else:
+        allow = self._take_probe(domain)
+      result.append((allow, failure_percentage))
+
+    if tripped:
+      self._open(tripped, current)
+    return result
+
+  def report(self, success, failure, now=time.time):
+    """Reports the status of interactions with a set of URLs.
+
+    Successful requests to a half-open domain close its circuit; failed
+    requests to a half-open domain open it again.
+
+    Args:
+      success: Iterable of URLs that had successful interactions.
+      failure: Iterable of URLs that had failed interactions.
+      now: Returns the current time in seconds since the epoch. Used in tests.
+    """
+    success = list(success or [])
+    failure = list(failure or [])
+    UrlScorer.report(self, success, failure)
+
+    success_domains = set(get_url_domain(u) for u in success)
+    failure_domains = set(get_url_domain(u) for u in failure)
+    all_domains = success_domains | failure_domains
+    if not all_domains:
+      return
+
+    values = memcache.get_multi(
+        ['open_until:' + d for d in all_domains], key_prefix=self.prefix)
+    current = now()
+    closed = set()
+    reopened = set()
+    for domain in all_domains:
+      open_until = values.get('open_until:' + domain)
+      if open_until is None or current < open_until:
+        continue
+      if domain in success_domains:
+        closed.add(domain)
+      else:
+        reopened.add(domain)
+
+    if closed:
+      logging.info('Closing circuit for domains: %s', sorted(closed))
+      keys = []
+      for domain in closed:
+        keys.extend(('success:' + domain,
+                     'failure:' + domain,
+                     'open_until:' + domain,
+                     'trips:' + domain,
+                     'probes:' + domain))
+      memcache.delete_multi(keys, key_prefix=self.prefix)
+    if reopened:
+      logging.warning('Probes failed; reopening circuit for domains: %s',
+                      sorted(reopened))
+      self._open(reopened, current)
+
+  def get_states(self, urls, now=time.time):
+    """Retrieves the circuit states for a set of URLs.
+
+    Args:
+      urls: Iterable of URLs to retrieve the states for. Each input will have
+        a corresponding entry in the returned value in the same order.
+      now: Returns the current time in seconds since the epoch. Used in tests.
+
+    Returns:
+      List of CLOSED, OPEN, or HALF_OPEN for each URL.
+    """
+    domain_list = [get_url_domain(u) for u in urls]
+    values = memcache.get_multi(
+        ['open_until:' + d for d in domain_list], key_prefix=self.prefix)
+    current = now()
+    result = []
+    for domain in domain_list:
+      open_until = values.get('open_until:' + domain)
+      if open_until is None:
+        result.append(self.CLOSED)
+      elif current < open_until:
+        result.append(self.OPEN)
+      else:
+        result.append(self.HALF_OPEN)
+    return result
+
+  def _take_probe(self, domain):
+    """Returns True if a half-open domain may receive another probe."""
+    probes = memcache.incr('probes:' + domain,
+                           key_prefix=self.prefix,
+                           initial_value=0)
+    if probes is None:
+      # Memcache is unavailable, so let the request through and rely on the
+      # normal scoring to trip the circuit again.
+      return True
+    return probes <= self.probe_count
+
+  def _open(self, domains, current):
+    """Opens the circuit for a set of domains.
+
+    Args:
+      domains: Set of domains to open.
+      current: The current time in seconds since the epoch.
+    """
+    trip_values = memcache.get_multi(
+        ['trips:' + d for d in domains], key_prefix=self.prefix)
+    values = {}
+    for domain in domains:
+      trips = trip_values.get('trips:' + domain, 0)
+      open_period = min(self.open_period * (2 ** trips), self.max_open_period)
+      values['open_until:' + domain] = int(current + open_period)
+      values['trips:' + domain] = trips + 1
+    # Keep the trip count around long enough to keep doubling the open period
+    # if the domain is still failing once the circuit goes half-open again.
+    memcache.set_multi(values,
+                       time=self.max_open_period + self.period,
+                       key_prefix=self.prefix)
+    memcache.delete_multi(['probes:' + d for d in domains],
+                          key_prefix=self.prefix)
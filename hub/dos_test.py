@@ -474,6 +474,47 @@ class LayeringTest(LimitTestBase):
     self.handle('get')
     self.assertEquals(503, self.response_code())
 
+
+class CountParamValuesTest(LimitTestBase):
+  """Tests for the count_param_values function."""
+
+  handler_class = ParamAndHeaderHandler
+
+  def setUp(self):
+    """Sets up the test harness."""
+    LimitTestBase.setUp(self)
+    os.environ['REMOTE_ADDR'] = '10.1.1.4'
+
+  def testCounts(self):
+    """Tests counting repeated and distinct values."""
+    self.assertEquals(
+        [1, 1, 2, 3],
+        dos.count_param_values('POST', '/foobar_path', 'foo',
+                               ['meep', 'wooh', 'meep', 'meep'], 10))
+    self.assertEquals(
+        [4, 2],
+        dos.count_param_values('POST', '/foobar_path', 'foo',
+                               ['meep', 'wooh'], 10))
+
+  def testSharedWithLimit(self):
+    """Tests that counts use the same keys as the limit decorator."""
+    self.assertEquals(
+        [1, 2, 3],
+        dos.count_param_values('POST', '/foobar_path', 'foo',
+                               ['meep'] * 3, 10))
+    self.handle('post', ('foo', 'meep'))
+    self.assertEquals(503, self.response_code())
+    self.handle('post', ('foo', 'wooh'))
+    self.assertEquals(200, self.response_code())
+
+  def testHeaderMissing(self):
+    """Tests that values are not counted without the header."""
+    del os.environ['REMOTE_ADDR']
+    self.assertEquals(
+        [None, None],
+        dos.count_param_values('POST', '/foobar_path', 'foo',
+                               ['meep', 'meep'], 10))
+
 ################################################################################
 
 class GetUrlDomainTest(unittest.TestCase):
@@ -1713,5 +1754,114 @@ class UrlScorerTest(unittest.TestCase):
 
 ################################################################################
 
+class CircuitBreakerTest(unittest.TestCase):
+  """Tests for the CircuitBreaker class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.domain1 = 'mydomain.com'
+    self.url1 = 'http://mydomain.com/stuff/meep'
+    self.url2 = 'http://example.com/some-path?a=b'
+    self.current = 1000
+    self.now = lambda: self.current
+    self.breaker = dos.CircuitBreaker(
+        period=60,
+        min_requests=1,
+        max_failure_percentage=0.2,
+        prefix='test',
+        open_period=10,
+        max_open_period=35,
+        probe_count=2)
+
+  def testConfig(self):
+    """Tests that the circuit parameters are sanitized."""
+    def create(**kwargs):
+      params = dict(period=60, min_requests=1, max_failure_percentage=0.2,
+                    prefix='test', open_period=10, max_open_period=35,
+                    probe_count=2)
+      params.update(kwargs)
+      return dos.CircuitBreaker(**params)
+
+    self.assertRaises(dos.ConfigError, create, open_period=0)
+    self.assertRaises(dos.ConfigError, create, open_period='bad')
+    self.assertRaises(dos.ConfigError, create, max_open_period=5)
+    self.assertRaises(dos.ConfigError, create, max_open_period=None)
+    self.assertRaises(dos.ConfigError, create, probe_count=0)
+    self.assertRaises(dos.ConfigError, create, probe_count='bad')
+    self.assertRaises(dos.ConfigError, create, period=0)
+
+  def testClosed(self):
+    """Tests that a healthy domain is scored like a UrlScorer."""
+    memcache.set('scoring:test:success:' + self.domain1, 100)
+    memcache.set('scoring:test:failure:' + self.domain1, 1)
+    self.assertEquals(
+        [(True, 1/101.0), (True, 0)],
+        self.breaker.filter([self.url1, self.url2], now=self.now))
+    self.assertEquals(
+        [dos.CircuitBreaker.CLOSED, dos.CircuitBreaker.CLOSED],
+        self.breaker.get_states([self.url1, self.url2], now=self.now))
+
+  def testOpenHalfOpenAndClose(self):
+    """Tests opening a circuit, probing it, and closing it on success."""
+    self.breaker.blackhole([self.url1])
+    self.assertEquals(
+        [(False, 1.0), (True, 0)],
+        self.breaker.filter([self.url1, self.url2], now=self.now))
+    self.assertEquals(
+        [dos.CircuitBreaker.OPEN],
+        self.breaker.get_states([self.url1], now=self.now))
+
+    self.current += 9
+    self.assertEquals([(False, 1.0)],
+                      self.breaker.filter([self.url1], now=self.now))
+
+    # Half-open only allows a couple of probes through.
+    self.current += 1
+    self.assertEquals(
+        [dos.CircuitBreaker.HALF_OPEN],
+        self.breaker.get_states([self.url1], now=self.now))
+    self.assertEquals(
+        [(True, 1.0), (True, 1.0), (False, 1.0)],
+        self.breaker.filter([self.url1] * 3, now=self.now))
+
+    self.breaker.report([self.url1], [], now=self.now)
+    self.assertEquals(
+        [dos.CircuitBreaker.CLOSED],
+        self.breaker.get_states([self.url1], now=self.now))
+    self.assertEquals([(True, 0)],
+                      self.breaker.filter([self.url1], now=self.now))
+    self.assertEquals([(0, 0)], self.breaker.get_scores([self.url1]))
+
+  def testProbeFailureBacksOff(self):
+    """Tests that failed probes reopen the circuit for longer each time."""
+    self.breaker.blackhole([self.url1])
+    self.breaker.filter([self.url1], now=self.now)
+    for open_period in (20, 35, 35):
+      self.current = memcache.get('scoring:test:open_until:' + self.domain1)
+      self.assertEquals([(True, 1.0)],
+                        self.breaker.filter([self.url1], now=self.now))
+      self.breaker.report([], [self.url1], now=self.now)
+      self.assertEquals(
+          self.current + open_period,
+          memcache.get('scoring:test:open_until:' + self.domain1))
+      self.assertEquals(
+          [dos.CircuitBreaker.OPEN],
+          self.breaker.get_states([self.url1], now=self.now))
+
+  def testReportWhileOpen(self):
+    """Tests that late reports for an open circuit do not change it."""
+    self.breaker.blackhole([self.url1])
+    self.breaker.filter([self.url1], now=self.now)
+    open_until = memcache.get('scoring:test:open_until:' + self.domain1)
+    self.breaker.report([self.url1], [self.url1], now=self.now)
+    self.assertEquals(
+        open_until, memcache.get('scoring:test:open_until:' + self.domain1))
+    self.assertEquals(
+        [dos.CircuitBreaker.OPEN],
+        self.breaker.get_states([self.url1], now=self.now))
+
+################################################################################
+
 if __name__ == '__main__':
   unittest.main()
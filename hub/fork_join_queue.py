@@ -80,21 +80,33 @@ interacts with Datastore queries and Bigtable's tablet splitting behavior.
 Using contiguous row indexes on any work item properties can have the same
 effect, so a hash of the sequential work index is used to ensure balancing
 across tablets.
+
+Backends:
+
+All counters, in-memory work items, task scheduling, and timing go through a
+Backend instance. AppEngineBackend, the default, uses memcache and the task
+queue, plus the Datastore for MemcacheForkJoinQueue's optional journal.
+LocalBackend keeps everything in-process with a simulated clock, so traces of
+work can be replayed offline to measure batching behavior.
 """
 
+import abc
+import calendar
+import collections
 import datetime
+import heapq
 import logging
 import os
 import random
+import threading
 import time
+import zlib
 
 from google.net.proto import ProtocolBuffer
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import db
-
-# TODO: Consider using multiple work indexes to alleviate the memcache
-# hotspot for the writer path.
+from google.appengine.runtime import apiproxy_errors
 
 ################################################################################
 
@@ -125,6 +137,313 @@ class TaskConflictError(Error):
 class MemcacheError(Error):
   """Enqueuing the work item in memcache failed."""
 
+class DecodeError(Error):
+  """A work item read from memcache could not be decoded."""
+
+################################################################################
+
+class ForkJoinJournal(db.Model):
+  """Durable copy of one work item in a memcache fork-join queue.
+
+  The key name is the item's memcache key. Each item is its own root entity,
+  so concurrent writers never contend on an entity group, and items are
+  read back with a strongly consistent batch get by key.
+  """
+
+  item = db.BlobProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+
+
+class _CompletedWrite(object):
+  """Result of a journal write that finished right away."""
+
+  def get_result(self):
+    return None
+
+################################################################################
+
+class Backend(object):
+  """Interface to the services that fork-join queues are built on.
+
+  Counters and items live in a shared, possibly lossy, key-value store;
+  counter values are integers and may be evicted at any time. Tasks are
+  scheduled by unique name. The reader/writer lock of each work index is
+  built out of counters by ForkJoinQueue itself.
+
+  Subclasses must implement every method except add_tasks() and report().
+  """
+
+  __metaclass__ = abc.ABCMeta
+
+  @abc.abstractmethod
+  def get_counter(self, key):
+    """Returns the value of a counter, or None if it is not present."""
+
+  @abc.abstractmethod
+  def add_counter(self, key, value):
+    """Sets a counter to a value only if it is not already present."""
+
+  @abc.abstractmethod
+  def incr_counter(self, key, delta=1, initial_value=None):
+    """Increments a counter, like memcache.incr(); returns the new value."""
+
+  @abc.abstractmethod
+  def decr_counter(self, key, delta=1):
+    """Decrements a counter, like memcache.decr(); returns the new value."""
+
+  @abc.abstractmethod
+  def set_items(self, mapping, time=0):
+    """Stores items by key, like memcache.set_multi().
+
+    Returns:
+      List of the keys that could not be stored.
+    """
+
+  @abc.abstractmethod
+  def get_items(self, key_list):
+    """Returns a dictionary of the items found for the given keys."""
+
+  @abc.abstractmethod
+  def add_task(self, queue_name, name, url, eta=None, params=None):
+    """Schedules a POST task.
+
+    Raises:
+      taskqueue.TaskAlreadyExistsError if a task with the name is pending.
+      taskqueue.TombstonedTaskError if a task with the name already ran.
+    """
+
+  def add_tasks(self, queue_name, task_list):
+    """Schedules several POST tasks, skipping those whose names are taken.
+
+    Implementations should add the tasks in as few calls as possible.
+
+    Args:
+      queue_name: Name of the queue to add the tasks to.
+      task_list: List of dictionaries with the keys 'name', 'url', and
+        'params', and optionally 'eta'; the arguments of add_task().
+    """
+    for task in task_list:
+      try:
+        self.add_task(queue_name, **task)
+      except (taskqueue.TaskAlreadyExistsError,
+              taskqueue.TombstonedTaskError):
+        pass
+
+  @abc.abstractmethod
+  def get_version(self):
+    """Returns the major version of the running application."""
+
+  @abc.abstractmethod
+  def time(self):
+    """Returns the current time as a UNIX timestamp."""
+
+  @abc.abstractmethod
+  def sleep(self, seconds):
+    """Waits for the given number of seconds."""
+
+  def report(self, event, value=1):
+    """Records a measurement about the queue's behavior; optional."""
+
+  @abc.abstractmethod
+  def write_journal(self, mapping):
+    """Starts durably storing encoded work items by key; used for recovery.
+
+    Args:
+      mapping: Dictionary mapping keys to encoded work items, as strings.
+
+    Returns:
+      An object whose get_result() method waits for the write to finish.
+    """
+
+  @abc.abstractmethod
+  def read_journal(self, key_list):
+    """Returns a dictionary of the journaled items found for the given keys."""
+
+
+class AppEngineBackend(Backend):
+  """Backend that uses memcache and the task queue."""
+
+  def get_counter(self, key):
+    return memcache.get(key)
+
+  def add_counter(self, key, value):
+    return memcache.add(key, value)
+
+  def incr_counter(self, key, delta=1, initial_value=None):
+    return memcache.incr(key, delta, initial_value=initial_value)
+
+  def decr_counter(self, key, delta=1):
+    return memcache.decr(key, delta)
+
+  def set_items(self, mapping, time=0):
+    return memcache.set_multi(mapping, time=time)
+
+  def get_items(self, key_list):
+    return memcache.get_multi(key_list)
+
+  def add_task(self, queue_name, name, url, eta=None, params=None):
+    taskqueue.Task(
+      method='POST',
+      name=name,
+      url=url,
+      eta=eta,
+      params=params
+    ).add(queue_name)
+
+  def add_tasks(self, queue_name, task_list):
+    tasks = [taskqueue.Task(method='POST', **task) for task in task_list]
+    queue = taskqueue.Queue(queue_name)
+    for i in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+      try:
+        queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+      except (taskqueue.TaskAlreadyExistsError,
+              taskqueue.TombstonedTaskError):
+        # The tasks in the batch with names that were free are still added.
+        pass
+
+  def get_version(self):
+    # Include major version in the task name to ensure that test tasks
+    # enqueued from a non-default major version will run in the new context
+    # instead of the default major version.
+    return os.environ['CURRENT_VERSION_ID'].split('.')[0]
+
+  def time(self):
+    return time.time()
+
+  def sleep(self, seconds):
+    time.sleep(seconds)
+
+  def write_journal(self, mapping):
+    return db.put_async([ForkJoinJournal(key_name=key, item=db.Blob(value))
+                         for key, value in mapping.iteritems()])
+
+  def read_journal(self, key_list):
+    journal_list = ForkJoinJournal.get_by_key_name(key_list)
+    return dict((key, str(journal.item))
+                for key, journal in zip(key_list, journal_list)
+                if journal is not None)
+
+
+class LocalBackend(Backend):
+  """In-process, thread-safe backend with a simulated clock.
+
+  Tasks are held in memory until take_due_tasks() is called; sleeping only
+  advances the clock. Calls to report() are collected in 'stats', which maps
+  each event name to the list of values reported for it.
+  """
+
+  def __init__(self, start_time=0.0, version='local'):
+    """Initializer.
+
+    Args:
+      start_time: The initial UNIX timestamp of the simulated clock.
+      version: The major version to use in task names.
+    """
+    self.lock = threading.RLock()
+    self.now = start_time
+    self.version = version
+    self.values = {}
+    self.task_heap = []
+    self.task_names = set()
+    self.journal = {}
+    self.stats = collections.defaultdict(list)
+
+  def get_counter(self, key):
+    with self.lock:
+      return self.values.get(key)
+
+  def add_counter(self, key, value):
+    with self.lock:
+      if key in self.values:
+        return False
+      self.values[key] = value
+      return True
+
+  def incr_counter(self, key, delta=1, initial_value=None):
+    with self.lock:
+      if key not in self.values:
+        if initial_value is None:
+          return None
+        self.values[key] = initial_value
+      # Like memcache, counters do not go below zero.
+      self.values[key] = max(0, self.values[key] + delta)
+      return self.values[key]
+
+  def decr_counter(self, key, delta=1):
+    return self.incr_counter(key, -delta)
+
+  def set_items(self, mapping, time=0):
+    with self.lock:
+      self.values.update(mapping)
+      return []
+
+  def get_items(self, key_list):
+    with self.lock:
+      return dict((k, self.values[k]) for k in key_list if k in self.values)
+
+  def add_task(self, queue_name, name, url, eta=None, params=None):
+    with self.lock:
+      if name in self.task_names:
+        if any(t[3] == name for t in self.task_heap):
+          raise taskqueue.TaskAlreadyExistsError(name)
+        raise taskqueue.TombstonedTaskError(name)
+      self.task_names.add(name)
+      if eta is None:
+        eta_stamp = self.now
+      else:
+        eta_stamp = calendar.timegm(eta.utctimetuple()) + (
+            eta.microsecond / 1e6)
+      heapq.heappush(self.task_heap, (
+          eta_stamp, len(self.task_names), queue_name, name, url,
+          params or {}))
+
+  def take_due_tasks(self):
+    """Removes and returns the tasks due at the current simulated time.
+
+    Returns:
+      List of dictionaries with the keys 'eta', 'queue_name', 'name', 'url',
+      and 'params', ordered by ETA.
+    """
+    result = []
+    with self.lock:
+      while self.task_heap and self.task_heap[0][0] <= self.now:
+        eta, unused, queue_name, name, url, params = heapq.heappop(
+            self.task_heap)
+        result.append(dict(eta=eta, queue_name=queue_name, name=name,
+                           url=url, params=params))
+    return result
+
+  def next_task_eta(self):
+    """Returns the ETA of the next pending task, or None if there is none."""
+    with self.lock:
+      if self.task_heap:
+        return self.task_heap[0][0]
+      return None
+
+  def get_version(self):
+    return self.version
+
+  def time(self):
+    with self.lock:
+      return self.now
+
+  def sleep(self, seconds):
+    with self.lock:
+      self.now += seconds
+
+  def report(self, event, value=1):
+    with self.lock:
+      self.stats[event].append(value)
+
+  def write_journal(self, mapping):
+    with self.lock:
+      self.journal.update(mapping)
+    return _CompletedWrite()
+
+  def read_journal(self, key_list):
+    with self.lock:
+      return dict((k, self.journal[k]) for k in key_list if k in self.journal)
+
 
 class ForkJoinQueue(object):
   """A fork-join queue for App Engine."""
@@ -143,7 +462,10 @@ class ForkJoinQueue(object):
                sync_timeout_ms=None,
                stall_timeout_ms=None,
                acquire_timeout_ms=None,
-               acquire_attempts=None):
+               acquire_attempts=None,
+               backend=None,
+               name=None,
+               reader_deferrals=0):
     """Initializer.
 
     Args:
@@ -166,10 +488,21 @@ class ForkJoinQueue(object):
         acquire a new index on each attempt.
       acquire_attempts: How many times writers should attempt to get new
         indexes before raising an error.
+      backend: Backend instance to use; defaults to AppEngineBackend.
+      name: Prefix for the memcache keys and task names of this queue, for
+        when several queues hold the same model class; defaults to 'fjq-'
+        followed by the model's kind.
+      reader_deferrals: When more than zero, readers that find writers still
+        holding the lock re-enqueue themselves to check again after
+        sync_timeout_ms, up to this many times, instead of sleeping in the
+        request. When zero, readers wait in the request for up to
+        lock_timeout_ms.
     """
     # TODO: Add validation.
+    self.backend = backend or AppEngineBackend()
     self.model_class = model_class
-    self.name = 'fjq-' + model_class.kind()
+    self.name = name or ('fjq-' + model_class.kind())
+    self.reader_deferrals = reader_deferrals
     self.index_property = index_property
     self.task_path = task_path
     self.queue_name = queue_name
@@ -189,6 +522,22 @@ class ForkJoinQueue(object):
     """Returns the name of the queue to use based on the given work index."""
     return self.queue_name
 
+  def get_shard(self, index):
+    """Returns the shard number that the given work index belongs to."""
+    return 0
+
+  def choose_shard(self, shard_key):
+    """Returns the shard number that writers should use for a shard key."""
+    return 0
+
+  def get_index_name(self, shard):
+    """Returns the index key for the given shard number."""
+    return self.index_name
+
+  def make_index(self, number, shard):
+    """Returns the work index for an index counter value in a shard."""
+    return knuth_hash(number)
+
   @property
   def lock_name(self):
     """Returns the lock key prefix for the current prefix name."""
@@ -204,23 +553,30 @@ class ForkJoinQueue(object):
     """Returns the index key prefix for the current prefix name."""
     return self.name + '-index'
 
-  def next_index(self,
-                 memget=memcache.get,
-                 memincr=memcache.incr,
-                 memdecr=memcache.decr):
+  def next_index(self, memget=None, memincr=None, memdecr=None,
+                 shard_key=None):
     """Reserves the next work index.
 
     Args:
-      memget, memincr, memdecr: Used for testing.
+      memget, memincr, memdecr: Used for testing; default to the backend's
+        counter methods.
+      shard_key: Optional string used to pick the shard of sharded queues, so
+        the same key always maps to the same index counter; when None, a
+        random shard is used.
 
     Returns:
       The next work index to use for work.
     """
+    memget = memget or self.backend.get_counter
+    memincr = memincr or self.backend.incr_counter
+    memdecr = memdecr or self.backend.decr_counter
+    shard = self.choose_shard(shard_key)
+    index_name = self.get_index_name(shard)
     for i in xrange(self.acquire_attempts):
-      next_index = memget(self.index_name)
+      next_index = memget(index_name)
       if next_index is None:
-        memcache.add(self.index_name, 1)
-        next_index = memget(self.index_name)
+        self.backend.add_counter(index_name, 1)
+        next_index = memget(index_name)
         if next_index is None:
           # Can't get it or add it, which means memcache is probably down.
           # Handle this as a separate fast-path to prevent memcache overload
@@ -228,7 +584,7 @@ class ForkJoinQueue(object):
           raise CannotGetIndexError(
               'Cannot establish new task index in memcache.')
 
-      next_index = knuth_hash(int(next_index))
+      next_index = self.make_index(int(next_index), shard)
       add_counter = self.add_counter_template % next_index
       count = memincr(add_counter, 1, initial_value=self.FAKE_ZERO)
       if count < self.FAKE_ZERO:
@@ -236,29 +592,41 @@ class ForkJoinQueue(object):
         # locked and we can no longer add tasks to it. We need to "refund" the
         # reader lock we took to ensure the worker doesn't wait for it.
         memdecr(add_counter, 1)
+        self.backend.report('writer_lock_retry')
       else:
+        self._report_acquire(i + 1)
         return next_index
-      time.sleep(self.acquire_timeout)
+      self.backend.sleep(self.acquire_timeout)
     else:
       # Force the index forward; here we're stuck in a loop where the memcache
       # index was evicted and all new lock acqusitions are reusing old locks
       # that were already closed off to new writers.
-      memincr(self.index_name)
+      memincr(index_name)
+      self._report_acquire(self.acquire_attempts)
+      self.backend.report('writer_lock_error')
       raise WriterLockError('Task adder could not increment writer lock.')
 
-  def add(self, index, gettime=time.time):
+  def _report_acquire(self, attempts):
+    """Reports the attempts and sleep time needed to reserve an index."""
+    self.backend.report('acquire_attempts', attempts)
+    self.backend.report('acquire_sleep_ms',
+                        1000 * (attempts - 1) * self.acquire_timeout)
+
+  def _report_batch(self, count):
+    """Reports the number of work items found by a pop."""
+    self.backend.report('batch_size', count)
+    if not count:
+      self.backend.report('empty_pop')
+
+  def add(self, index, gettime=None):
     """Adds a task for a work index, decrementing the writer lock."""
-    now_stamp = gettime()
+    now_stamp = (gettime or self.backend.time)()
     # Nearest gap used to kickstart the queues when a task is dropped or
     # memcache is evicted. This prevents new task names from overlapping with
     # old ones.
     nearest_gap = int(now_stamp / self.stall_timeout)
-    # Include major version in the task name to ensure that test tasks
-    # enqueued from a non-default major version will run in the new context
-    # instead of the default major version.
-    major_version, minor_version = os.environ['CURRENT_VERSION_ID'].split('.')
     task_name = '%s-%s-%d-%d-%d' % (
-        self.name, major_version, nearest_gap, index, 0)
+        self.name, self.backend.get_version(), nearest_gap, index, 0)
 
     # When the batch_period_ms is zero, then there should be no ETA, the task
     # should run immediately and the reader will busy wait for all writers.
@@ -268,23 +636,20 @@ class ForkJoinQueue(object):
       eta = datetime_from_stamp(now_stamp) + self.batch_delta
 
     try:
-      taskqueue.Task(
-        method='POST',
-        name=task_name,
-        url=self.task_path,
-        eta=eta
-      ).add(self.get_queue_name(index))
+      self.backend.add_task(
+          self.get_queue_name(index), task_name, self.task_path, eta=eta)
+      self.backend.report('task_added')
       if self.batch_delta is None:
         # When the batch_period_ms is zero, we want to immediately move the
         # index to the next position as soon as the current batch finishes
         # writing its task. This will only run for the first successful task
         # inserter.
-        memcache.incr(self.index_name)
+        self.backend.incr_counter(self.get_index_name(self.get_shard(index)))
     except taskqueue.TaskAlreadyExistsError:
       # This is okay. It means the task has already been inserted by another
       # add() call for this same batch. We're holding the lock at this point
       # so we know that job won't start yet.
-      pass
+      self.backend.report('task_deduped')
     except taskqueue.TombstonedTaskError, e:
       # This is bad. This means 1) the lock we held expired and the task already
       # ran, 2) this task name somehow overlaps with an old task. Return the
@@ -293,17 +658,13 @@ class ForkJoinQueue(object):
     finally:
       # Don't bother checking the decr status; worst-case the worker job
       # will time out after some number of seconds and proceed anyways.
-      memcache.decr(self.add_counter_template % index, 1)
+      self.backend.decr_counter(self.add_counter_template % index, 1)
 
-  def _increment_index(self, last_index):
-    """Moves the work index forward and waits for all writers.
+  def _close_index(self, last_index):
+    """Moves the work index forward and closes it to new writers.
 
     Args:
       last_index: The last index that was used for the reader/writer lock.
-
-    Returns:
-      True if all writers were definitely finished; False if the reader/writer
-      lock timed out and we are proceeding anyways.
     """
     # Increment the batch index counter so incoming jobs will use a new index.
     # Don't bother setting an initial value here because next_index() will
@@ -313,28 +674,82 @@ class ForkJoinQueue(object):
     # We do this even in the case that batch_period_ms was zero, just in case
     # that memcache operation failed for some reason, we'd rather have more
     # batches then have the work index pipeline stall.
-    memcache.incr(self.index_name)
+    self.backend.incr_counter(
+        self.get_index_name(self.get_shard(last_index)))
 
     # Prevent new writers by making the counter extremely negative. If the
     # decrement fails here we can't recover anyways, so just let the worker go.
-    add_counter = self.add_counter_template % last_index
-    memcache.decr(add_counter, self.LOCK_OFFSET)
+    self.backend.decr_counter(
+        self.add_counter_template % last_index, self.LOCK_OFFSET)
+
+  def _writers_finished(self, last_index):
+    """Returns True if no writers hold the lock of a closed work index."""
+    counter = self.backend.get_counter(self.add_counter_template % last_index)
+    # Less than or equal LOCK_OFFSET here in case a writer decrements twice
+    # due to rerunning failure tasks. Worst-case the counter will be gone due
+    # to memcache eviction, which means the worker can procede with without
+    # waiting for writers and just process whatever it can find. This may
+    # drop some work.
+    return counter is None or int(counter) <= self.LOCK_OFFSET
+
+  def _increment_index(self, last_index):
+    """Moves the work index forward and waits for all writers.
 
+    Args:
+      last_index: The last index that was used for the reader/writer lock.
+
+    Returns:
+      True if all writers were definitely finished; False if the reader/writer
+      lock timed out and we are proceeding anyways.
+    """
+    self._close_index(last_index)
+    start = self.backend.time()
     for i in xrange(self.sync_attempts):
-      counter = memcache.get(add_counter)
-      # Less than or equal LOCK_OFFSET here in case a writer decrements twice
-      # due to rerunning failure tasks.
-      if counter is None or int(counter) <= self.LOCK_OFFSET:
-        # Worst-case the counter will be gone due to memcache eviction, which
-        # means the worker can procede with without waiting for writers
-        # and just process whatever it can find. This may drop some work.
+      if self._writers_finished(last_index):
+        self.backend.report('writer_wait_ms',
+                            1000 * (self.backend.time() - start))
         return True
-      time.sleep(self.sync_timeout)
+      self.backend.sleep(self.sync_timeout)
     else:
       logging.critical('Worker for %s gave up waiting for writers', self.name)
+      self.backend.report('writer_wait_ms',
+                          1000 * (self.backend.time() - start))
+      self.backend.report('reader_lock_timeout')
 
     return False
 
+  def _defer_reader(self, rest, index, deferrals):
+    """Checks for writers again later instead of waiting in this request.
+
+    Args:
+      rest: The task name prefix before the work index.
+      index: The work index.
+      deferrals: How many times the reader has already been deferred.
+
+    Returns:
+      True if a task was enqueued to check again; False if the reader has
+      been deferred the maximum number of times and should proceed anyways.
+    """
+    if deferrals >= self.reader_deferrals:
+      logging.critical('Worker for %s gave up waiting for writers', self.name)
+      self.backend.report('writer_wait_ms',
+                          1000 * deferrals * self.sync_timeout)
+      self.backend.report('reader_lock_timeout')
+      return False
+
+    eta = datetime_from_stamp(self.backend.time() + self.sync_timeout)
+    try:
+      self.backend.add_task(
+          self.get_queue_name(index),
+          '%s-%d-0-w%d' % (rest, index, deferrals + 1),
+          self.task_path,
+          eta=eta)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      # A previous attempt of this task already deferred the reader.
+      pass
+    self.backend.report('reader_deferred')
+    return True
+
   def _query_work(self, index, cursor):
     """Queries for work in the Datastore."""
     query = (self.model_class.all()
@@ -343,6 +758,7 @@ class ForkJoinQueue(object):
     if cursor:
       query.with_cursor(cursor)
     result_list = query.fetch(self.batch_size)
+    self._report_batch(len(result_list))
     return result_list, query.cursor()
 
   def pop_request(self, request):
@@ -366,56 +782,333 @@ class ForkJoinQueue(object):
       cursor: The value of the cursor for this task (optional).
 
     Returns:
-      A list of work items, if any.
+      A list of work items, if any. The list is empty when the reader was
+      deferred to wait for writers in a later task.
     """
+    deferrals = 0
+    rest, last = task_name.rsplit('-', 1)
+    if last.startswith('w'):
+      # This is the root task checking for writers again after a deferral.
+      deferrals = int(last[1:])
+      task_name = rest
     rest, index, generation = task_name.rsplit('-', 2)
     index, generation = int(index), int(generation)
+    if not deferrals:
+      self.backend.report('generation', generation)
 
     if not cursor:
       # The root worker task already waited for all writers, so continuation
       # tasks can start processing immediately.
-      self._increment_index(index)
+      if not self.reader_deferrals:
+        self._increment_index(index)
+      else:
+        if not deferrals:
+          self._close_index(index)
+        if self._writers_finished(index):
+          self.backend.report('writer_wait_ms',
+                              1000 * deferrals * self.sync_timeout)
+        elif self._defer_reader(rest, index, deferrals):
+          return []
 
-    result_list, cursor = self._query_work(index, cursor)
+    return self._pop_work(rest, index, generation, cursor)
 
-    if len(result_list) == self.batch_size:
-      for i in xrange(3):
-        try:
-          taskqueue.Task(
-            method='POST',
-            name='%s-%d-%d' % (rest, index, generation + 1),
-            url=self.task_path,
-            params={'cursor': cursor}
-          ).add(self.get_queue_name(index))
-          break
-        except (taskqueue.TaskAlreadyExistsError,
-                taskqueue.TombstonedTaskError):
-          # This means the continuation chain already started and this root
-          # task failed for some reason; no problem.
-          break
-        except (taskqueue.TransientError, taskqueue.InternalError):
-          # Ignore transient taskqueue errors.
-          if i == 2:
-            raise
+  def _pop_work(self, rest, index, generation, cursor):
+    """Queries for a batch of work and continues the chain if it was full.
 
+    Args:
+      rest: The task name prefix before the work index.
+      index: The work index.
+      generation: The generation number of the current task.
+      cursor: The value of the cursor for this task, if any.
+
+    Returns:
+      A list of work items, if any.
+    """
+    result_list, cursor = self._query_work(index, cursor)
+    if len(result_list) == self.batch_size:
+      self._add_continuation(rest, index, generation + 1, cursor)
     return result_list
 
+  def _add_continuation(self, rest, index, generation, cursor):
+    """Enqueues a continuation task for a work index.
+
+    Args:
+      rest: The task name prefix before the work index.
+      index: The work index.
+      generation: The generation number of the new task.
+      cursor: The value of the cursor for the new task.
+    """
+    self._add_continuations(rest, index, [(generation, cursor)])
+
+  def _add_continuations(self, rest, index, continuation_list):
+    """Enqueues continuation tasks for a work index in batched calls.
+
+    Continuations that already exist are skipped; this means the chain
+    already started and this root task failed for some reason.
+
+    Args:
+      rest: The task name prefix before the work index.
+      index: The work index.
+      continuation_list: List of (generation, cursor) tuples, one for each
+        task to enqueue.
+    """
+    task_list = [
+        dict(name='%s-%d-%d' % (rest, index, generation),
+             url=self.task_path,
+             params={'cursor': cursor})
+        for generation, cursor in continuation_list]
+    for i in xrange(3):
+      try:
+        self.backend.add_tasks(self.get_queue_name(index), task_list)
+        break
+      except (taskqueue.TransientError, taskqueue.InternalError):
+        # Ignore transient taskqueue errors; tasks that were added before
+        # the error are skipped when retrying.
+        if i == 2:
+          raise
+    for unused in task_list:
+      self.backend.report('continuation_added')
+
 
 class ShardedForkJoinQueue(ForkJoinQueue):
-  """A fork-join queue that shards actual work across multiple task queues."""
+  """A fork-join queue that shards work across index counters and queues.
+
+  Each shard has its own index counter, so writers in different shards never
+  contend on the same memcache keys. The shard is encoded in the work index
+  itself (index modulo shard_count), which lets readers find the counter to
+  advance and the queue to use from the task name alone. When the queue name
+  contains '%(shard)s' each shard also gets its own task queue.
+  """
 
   def __init__(self, *args, **kwargs):
     """Initialized.
 
     Args:
       *args, **kwargs: Passed to ForkJoinQueue.
-      shard_count: How many queues there are for sharding the incoming work.
+      shard_count: How many shards there are for the incoming work.
     """
     self.shard_count = kwargs.pop('shard_count')
     ForkJoinQueue.__init__(self, *args, **kwargs)
 
   def get_queue_name(self, index):
-    return self.queue_name % {'shard': 1 + (index % self.shard_count)}
+    return self.queue_name % {'shard': 1 + self.get_shard(index)}
+
+  def get_shard(self, index):
+    return index % self.shard_count
+
+  def choose_shard(self, shard_key):
+    if self.shard_count == 1:
+      return 0
+    if shard_key is None:
+      return random.randrange(self.shard_count)
+    if isinstance(shard_key, unicode):
+      shard_key = shard_key.encode('utf-8')
+    return (zlib.crc32(shard_key) & 0xffffffff) % self.shard_count
+
+  def get_index_name(self, shard):
+    # A single shard keeps the unsharded key name so that changing the shard
+    # count does not strand the counter of a running deployment.
+    if self.shard_count == 1:
+      return self.index_name
+    return '%s:%d' % (self.index_name, shard)
+
+  def make_index(self, number, shard):
+    return knuth_hash(number) * self.shard_count + shard
+
+
+class EntityProtoSerializer(object):
+  """Encodes work items as full EntityProtos; works for any model."""
+
+  def encode(self, entity):
+    """Returns the value to store in memcache for a model instance."""
+    return db.model_to_protobuf(entity)
+
+  def decode(self, value):
+    """Returns the model instance for a value read from memcache.
+
+    Raises:
+      DecodeError if the value could not be decoded.
+    """
+    try:
+      return db.model_from_protobuf(value)
+    except ProtocolBuffer.ProtocolBufferDecodeError, e:
+      raise DecodeError(str(e))
+
+
+def _encode_varint(number, out):
+  """Appends a non-negative integer to a list as base-128 varint bytes."""
+  while number > 0x7f:
+    out.append(chr(0x80 | (number & 0x7f)))
+    number >>= 7
+  out.append(chr(number))
+
+
+def _decode_varint(data, offset):
+  """Reads a varint; returns a tuple (number, offset after the varint)."""
+  number = 0
+  shift = 0
+  while True:
+    byte = ord(data[offset])
+    offset += 1
+    number |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return number, offset
+    shift += 7
+
+
+class CompactSerializer(EntityProtoSerializer):
+  """Encodes work items as a key name and a fixed list of property values.
+
+  Values start with MAGIC and a version byte, followed by varint-prefixed
+  fields in the order of the property names given, so no kind, key path, or
+  property metadata is stored. Supported properties are strings (including
+  Text and Link), integers, and lists of strings. Values that do not start
+  with MAGIC (e.g., written before a deployment switched serializers) are
+  decoded as EntityProtos.
+  """
+
+  MAGIC = '\xfa'
+  VERSION = 1
+
+  def __init__(self, model_class, property_names):
+    """Initializer.
+
+    Args:
+      model_class: The model class of the work items; instances must have a
+        key name and no parent.
+      property_names: Names of the properties to store; all others will have
+        their default values after decoding.
+    """
+    self.model_class = model_class
+    self.property_list = []
+    for name in property_names:
+      prop = model_class.properties()[name]
+      if isinstance(prop, db.ListProperty):
+        kind = 'list'
+      elif isinstance(prop, db.IntegerProperty):
+        kind = 'int'
+      else:
+        kind = 'str'
+      self.property_list.append((name, kind))
+
+  def encode(self, entity):
+    key = entity.key()
+    if key.parent() is not None or key.name() is None:
+      raise ValueError('Compact encoding requires a root key name: %r' % key)
+    out = [self.MAGIC, chr(self.VERSION)]
+    self._encode_string(key.name(), out)
+    for name, kind in self.property_list:
+      value = getattr(entity, name)
+      if kind == 'list':
+        _encode_varint(len(value), out)
+        for item in value:
+          self._encode_string(item, out)
+      elif value is None:
+        out.append('\x00')
+      elif kind == 'int':
+        # Zig-zag encoding, shifted by one to make room for None.
+        _encode_varint(1 + ((value << 1) ^ (value >> 63)), out)
+      else:
+        out.append('\x01')
+        self._encode_string(value, out)
+    return ''.join(out)
+
+  def _encode_string(self, value, out):
+    """Appends a length-prefixed UTF-8 string to a list."""
+    if isinstance(value, unicode):
+      value = value.encode('utf-8')
+    _encode_varint(len(value), out)
+    out.append(value)
+
+  def _decode_string(self, data, offset):
+    """Reads a string; returns a tuple (unicode string, new offset)."""
+    length, offset = _decode_varint(data, offset)
+    end = offset + length
+    if end > len(data):
+      raise IndexError('String runs past end of data')
+    return data[offset:end].decode('utf-8'), end
+
+  def decode(self, value):
+    if not isinstance(value, str) or not value.startswith(self.MAGIC):
+      return EntityProtoSerializer.decode(self, value)
+    if len(value) < 2 or ord(value[1]) != self.VERSION:
+      raise DecodeError('Unknown compact encoding version')
+    try:
+      key_name, offset = self._decode_string(value, 2)
+      kwargs = {}
+      for name, kind in self.property_list:
+        if kind == 'list':
+          count, offset = _decode_varint(value, offset)
+          item_list = []
+          for i in xrange(count):
+            item, offset = self._decode_string(value, offset)
+            item_list.append(item)
+          kwargs[name] = item_list
+        elif kind == 'int':
+          number, offset = _decode_varint(value, offset)
+          if number == 0:
+            kwargs[name] = None
+          else:
+            number -= 1
+            kwargs[name] = (number >> 1) ^ -(number & 1)
+        else:
+          present, offset = _decode_varint(value, offset)
+          if present:
+            kwargs[name], offset = self._decode_string(value, offset)
+          else:
+            kwargs[name] = None
+    except (IndexError, UnicodeDecodeError), e:
+      raise DecodeError('Truncated or corrupt work item: %s' % e)
+    return self.model_class(key_name=key_name, **kwargs)
+
+
+class DeferredEntityList(object):
+  """List of work items that are decoded when first used.
+
+  Items that cannot be decoded are logged and left out of the list.
+  """
+
+  def __init__(self, value_list, serializer):
+    """Initializer.
+
+    Args:
+      value_list: List of (memcache key, encoded value) tuples.
+      serializer: Serializer used to decode the values.
+    """
+    self.value_list = value_list
+    self.serializer = serializer
+    self.entity_list = None
+
+  def _decode(self):
+    """Decodes all items the first time they are needed."""
+    if self.entity_list is None:
+      self.entity_list = []
+      for key, value in self.value_list:
+        try:
+          self.entity_list.append(self.serializer.decode(value))
+        except DecodeError:
+          logging.exception('Could not decode work item at memcache key %r: '
+                            '%r', key, value)
+      self.value_list = None
+    return self.entity_list
+
+  def __iter__(self):
+    return iter(self._decode())
+
+  def __len__(self):
+    return len(self._decode())
+
+  def __getitem__(self, index):
+    return self._decode()[index]
+
+  def __eq__(self, other):
+    return self._decode() == list(other)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return repr(self._decode())
 
 
 class MemcacheForkJoinQueue(ShardedForkJoinQueue):
@@ -425,6 +1118,13 @@ class MemcacheForkJoinQueue(ShardedForkJoinQueue):
   passing one or more model instances to enqueued in memcache.
 
   Also a sharded queue for maximum throughput.
+
+  With the journal enabled, each put() also writes its items to Datastore
+  entities keyed by their memcache keys, in parallel with the memcache write.
+  Items that were evicted from memcache by the time they are popped are read
+  back from the journal instead of being lost. If the length of a work index
+  is evicted too, readers fall back to a continuation chain that reads the
+  journal one batch at a time.
   """
 
   def __init__(self, *args, **kwargs):
@@ -435,11 +1135,17 @@ class MemcacheForkJoinQueue(ShardedForkJoinQueue):
       expiration_seconds: How long items inserted into memcache should remain
         until they are evicted due to timeout. Default is 0, meaning they
         will never be evicted.
+      serializer: How work items are encoded in memcache; defaults to an
+        EntityProtoSerializer.
+      journal: True to also write work items to a durable ForkJoinJournal
+        so they can be recovered after memcache eviction. Default is False.
     """
     if 'expiration_seconds' in kwargs:
       self.expiration_seconds = kwargs.pop('expiration_seconds')
     else:
       self.expiration_seconds = 0
+    self.serializer = kwargs.pop('serializer', None) or EntityProtoSerializer()
+    self.journal = kwargs.pop('journal', False)
     ShardedForkJoinQueue.__init__(self, *args, **kwargs)
 
   def _create_length_key(self, index):
@@ -450,23 +1156,57 @@ class MemcacheForkJoinQueue(ShardedForkJoinQueue):
     """Creates an index memcache key for the given in-memory queue location."""
     return '%s:index:%d-%d' % (self.name, index, number)
 
-  def put(self,
-          index,
-          entity_list,
-          memincr=memcache.incr,
-          memset=memcache.set_multi):
+  def _start_journal_write(self, index, key_map):
+    """Starts writing encoded work items to the journal.
+
+    Args:
+      index: The work index of the items.
+      key_map: Dictionary mapping memcache keys to encoded work items.
+
+    Returns:
+      The pending write, or None if it could not be started.
+    """
+    journal_map = {}
+    for key, value in key_map.iteritems():
+      if not isinstance(value, str):
+        value = value.Encode()
+      journal_map[key] = value
+    try:
+      return self.backend.write_journal(journal_map)
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not journal work items for index %d', index)
+      self.backend.report('journal_error')
+      return None
+
+  def _finish_journal_write(self, index, write):
+    """Waits for a journal write; returns True if it succeeded."""
+    if write is None:
+      return False
+    try:
+      write.get_result()
+      return True
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not journal work items for index %d', index)
+      self.backend.report('journal_error')
+      return False
+
+  def put(self, index, entity_list, memincr=None, memset=None):
     """Enqueue a model instance on this queue.
 
-    Does not write to the Datastore.
+    Only writes to the Datastore when the journal is enabled.
 
     Args:
       index: The work index for this entity.
       entity_list: List of work entities to insert into the in-memory queue.
-      memincr, memset: Used for testing.
+      memincr, memset: Used for testing; default to the backend's
+        incr_counter() and set_items() methods.
 
     Raises:
-      MemcacheError if the entities were not successfully added.
+      MemcacheError if the entities were not successfully added to memcache
+      or, when the journal is enabled, to either memcache or the journal.
     """
+    memincr = memincr or self.backend.incr_counter
+    memset = memset or self.backend.set_items
     length_key = self._create_length_key(index)
     end = memincr(length_key, len(entity_list), initial_value=0)
     if end is None:
@@ -475,12 +1215,104 @@ class MemcacheForkJoinQueue(ShardedForkJoinQueue):
     start = end - len(entity_list)
     key_map = {}
     for number, entity in zip(xrange(start, end), entity_list):
-      key_map[self._create_index_key(index, number)] = db.model_to_protobuf(
-          entity)
+      key_map[self._create_index_key(index, number)] = (
+          self.serializer.encode(entity))
 
+    write = None
+    if self.journal:
+      write = self._start_journal_write(index, key_map)
     result = memset(key_map, time=self.expiration_seconds)
+    journaled = self._finish_journal_write(index, write)
     if result:
-      raise MemcacheError('Could not set memcache keys %r' % result)
+      if not journaled:
+        raise MemcacheError('Could not set memcache keys %r' % result)
+      logging.warning('Could not set memcache keys %r; '
+                      'items will be read from the journal', result)
+
+  def _pop_work(self, rest, index, generation, cursor):
+    """Pops a range of in-memory work items.
+
+    The root task reads the final length of the queue once all writers are
+    done and enqueues a task for every remaining range at once, in batched
+    task queue calls, so all generations run in parallel. Continuation
+    chains are still used for older tasks and when the length key was
+    evicted.
+    """
+    if not cursor:
+      length = self.backend.get_counter(self._create_length_key(index))
+      if length is not None:
+        length = int(length)
+        continuation_list = []
+        for number, start in enumerate(
+            xrange(self.batch_size, length, self.batch_size)):
+          end = min(start + self.batch_size, length)
+          continuation_list.append(
+              (generation + 1 + number, '%d:%d' % (start, end)))
+        if continuation_list:
+          self._add_continuations(rest, index, continuation_list)
+        return self._get_items(index, 0, min(self.batch_size, length))
+    else:
+      item_range = self._parse_range(cursor)
+      if item_range is not None:
+        return self._get_items(index, *item_range)
+    return super(MemcacheForkJoinQueue, self)._pop_work(
+        rest, index, generation, cursor)
+
+  def _parse_range(self, cursor):
+    """Parses a 'start:end' range cursor; returns None for other cursors."""
+    parts = str(cursor).split(':')
+    if len(parts) != 2:
+      return None
+    try:
+      return int(parts[0]), int(parts[1])
+    except ValueError:
+      return None
+
+  def _get_items(self, index, start, end):
+    """Fetches the in-memory work items in a range with one memcache call.
+
+    Args:
+      index: The work index.
+      start: The first item number to fetch.
+      end: The item number after the last one to fetch.
+
+    Returns:
+      DeferredEntityList of the items that were found in memcache or, for
+      evicted items, in the journal.
+    """
+    key_list = [self._create_index_key(index, n) for n in xrange(start, end)]
+    if key_list:
+      results = self.backend.get_items(key_list)
+    else:
+      results = {}
+    if self.journal:
+      missing_list = [key for key in key_list if not results.get(key)]
+      if missing_list:
+        recovered = self._read_journal(index, missing_list)
+        results.update(recovered)
+        if recovered:
+          self.backend.report('journal_recovered', len(recovered))
+    value_list = [(key, results[key]) for key in key_list if results.get(key)]
+    self._report_batch(len(value_list))
+    return DeferredEntityList(value_list, self.serializer)
+
+  def _read_journal(self, index, key_list):
+    """Reads journaled work items with one batch get.
+
+    Args:
+      index: The work index of the items.
+      key_list: The memcache keys of the items to read.
+
+    Returns:
+      Dictionary mapping memcache keys to encoded work items; empty if the
+      journal could not be read.
+    """
+    try:
+      return self.backend.read_journal(key_list)
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not read journal for index %d', index)
+      self.backend.report('journal_error')
+      return {}
 
   def _query_work(self, index, cursor):
     """Queries for work in memcache."""
@@ -494,19 +1326,5 @@ class MemcacheForkJoinQueue(ShardedForkJoinQueue):
     else:
       cursor = 0
 
-    key_list = [self._create_index_key(index, n)
-                for n in xrange(cursor, cursor + self.batch_size)]
-    results = memcache.get_multi(key_list)
-
-    result_list = []
-    for key in key_list:
-      proto = results.get(key)
-      if not proto:
-        continue
-      try:
-        result_list.append(db.model_from_protobuf(proto))
-      except ProtocolBuffer.ProtocolBufferDecodeError:
-        logging.exception('Could not decode EntityPb at memcache key %r: %r',
-                          key, proto)
-
+    result_list = self._get_items(index, cursor, cursor + self.batch_size)
     return result_list, cursor + self.batch_size
@@ -17,6 +17,7 @@
 
 """Tests for the fork_join_queue module."""
 
+import collections
 import datetime
 import logging
 logging.basicConfig(format='%(levelname)-8s %(filename)s] %(message)s')
@@ -30,6 +31,7 @@ testutil.fix_path()
 
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 
@@ -100,6 +102,22 @@ MEMCACHE_QUEUE = fork_join_queue.MemcacheForkJoinQueue(
     shard_count=4)
 
 
+JOURNAL_QUEUE = fork_join_queue.MemcacheForkJoinQueue(
+    TestModel,
+    TestModel.work_index,
+    '/path/to/my/task',
+    'default',
+    batch_size=3,
+    batch_period_ms=2200,
+    lock_timeout_ms=1000,
+    sync_timeout_ms=250,
+    stall_timeout_ms=30000,
+    acquire_timeout_ms=50,
+    acquire_attempts=20,
+    shard_count=4,
+    journal=True)
+
+
 class ForkJoinQueueTest(unittest.TestCase):
   """Tests for the ForkJoinQueue class."""
 
@@ -434,6 +452,32 @@ class ForkJoinQueueTest(unittest.TestCase):
     finally:
       stub._queues[None]._all_queues_valid = False
 
+  def testShardedIndexCounters(self):
+    """Tests that each shard key maps to its own index counter."""
+    work_index = SHARDED_QUEUE.next_index(shard_key='http://example.com/a')
+    shard = SHARDED_QUEUE.get_shard(work_index)
+    self.assertEquals(
+        work_index, SHARDED_QUEUE.next_index(shard_key=u'http://example.com/a'))
+    self.assertEquals(
+        1, memcache.get(SHARDED_QUEUE.get_index_name(shard)))
+    self.assertEquals(None, memcache.get(SHARDED_QUEUE.index_name))
+
+    # Popping only moves the counter of the work index's shard forward.
+    memcache.decr(SHARDED_QUEUE.add_counter_template % work_index, 2)
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = \
+        self.expect_task(work_index)['name']
+    SHARDED_QUEUE.pop_request(testutil.create_test_request('POST', None))
+    self.assertEquals(
+        2, memcache.get(SHARDED_QUEUE.get_index_name(shard)))
+    self.assertNotEquals(
+        work_index, SHARDED_QUEUE.next_index(shard_key='http://example.com/a'))
+
+    shard_set = set(
+        SHARDED_QUEUE.get_shard(SHARDED_QUEUE.next_index(
+            shard_key='http://example.com/%d' % i))
+        for i in xrange(40))
+    self.assertEquals(set(xrange(4)), shard_set)
+
   def testMemcacheQueue(self):
     """Tests adding and popping from an in-memory queue with continuation."""
     work_index = MEMCACHE_QUEUE.next_index()
@@ -459,7 +503,7 @@ class ForkJoinQueueTest(unittest.TestCase):
     next_task = testutil.get_tasks('default',
                                    expected_count=2,
                                    index=1)
-    self.assertEquals(3, int(next_task['params']['cursor']))
+    self.assertEquals('3:5', next_task['params']['cursor'])
     self.assertTrue(next_task['name'].endswith('-1'))
 
     # Second pop request.
@@ -532,6 +576,404 @@ class ForkJoinQueueTest(unittest.TestCase):
     os.environ['HTTP_X_APPENGINE_TASKNAME'] = \
         self.expect_task(work_index)['name']
     result_list = MEMCACHE_QUEUE.pop_request(request)
+    self.assertEquals([1, 3], [r.number for r in result_list])
+
+  def testMemcacheQueue_FanOut(self):
+    """Tests that the root task enqueues all continuations at once."""
+    work_index = MEMCACHE_QUEUE.next_index()
+    work_items = [TestModel(key=db.Key.from_path(TestModel.kind(), i),
+                            work_index=work_index, number=i)
+                  for i in xrange(1, 9)]
+    MEMCACHE_QUEUE.put(work_index, work_items)
+    MEMCACHE_QUEUE.add(work_index, gettime=self.gettime1)
+
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = \
+        self.expect_task(work_index)['name']
+    result_list = MEMCACHE_QUEUE.pop_request(
+        testutil.create_test_request('POST', None))
+    self.assertEquals([1, 2, 3], [r.number for r in result_list])
+
+    task_list = sorted(testutil.get_tasks('default', expected_count=3),
+                       key=lambda t: t['name'])[1:]
+    self.assertEquals(['3:6', '6:8'],
+                      [t['params']['cursor'] for t in task_list])
+    self.assertTrue(task_list[0]['name'].endswith('-1'))
+    self.assertTrue(task_list[1]['name'].endswith('-2'))
+
+    # Generations run independently and never add more continuations.
+    for task, expected in reversed(zip(task_list, [[4, 5, 6], [7, 8]])):
+      os.environ['HTTP_X_APPENGINE_TASKNAME'] = task['name']
+      result_list = MEMCACHE_QUEUE.pop_request(
+          testutil.create_test_request('POST', None,
+                                       *task['params'].items()))
+      self.assertEquals(expected, [r.number for r in result_list])
+    testutil.get_tasks('default', expected_count=3)
+
+  def testMemcacheQueue_FanOutExisting(self):
+    """Tests that a fan-out skips continuations that already exist."""
+    work_index = MEMCACHE_QUEUE.next_index()
+    work_items = [TestModel(key=db.Key.from_path(TestModel.kind(), i),
+                            work_index=work_index, number=i)
+                  for i in xrange(1, 12)]
+    MEMCACHE_QUEUE.put(work_index, work_items)
+    MEMCACHE_QUEUE.add(work_index, gettime=self.gettime1)
+    root_name = self.expect_task(work_index)['name']
+    existing_name = root_name[:-len('-0')] + '-2'
+    taskqueue.Task(name=existing_name, url='/path/to/my/task',
+                   params={'cursor': '6:9'}).add('default')
+
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = root_name
+    MEMCACHE_QUEUE.pop_request(testutil.create_test_request('POST', None))
+    task_list = sorted(testutil.get_tasks('default', expected_count=4),
+                       key=lambda t: t['name'])
+    self.assertEquals([root_name] + [root_name[:-len('-0')] + '-%d' % i
+                                     for i in (1, 2, 3)],
+                      [t['name'] for t in task_list])
+
+  def testMemcacheQueue_LengthEvicted(self):
+    """Tests popping with a continuation chain when the length is gone."""
+    work_index = MEMCACHE_QUEUE.next_index()
+    work_items = [TestModel(key=db.Key.from_path(TestModel.kind(), i),
+                            work_index=work_index, number=i)
+                  for i in xrange(1, 6)]
+    MEMCACHE_QUEUE.put(work_index, work_items)
+    memcache.delete(MEMCACHE_QUEUE._create_length_key(work_index))
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = \
+        self.expect_task(work_index)['name']
+    result_list = MEMCACHE_QUEUE.pop_request(
+        testutil.create_test_request('POST', None))
+    self.assertEquals([1, 2, 3], [r.number for r in result_list])
+    next_task = testutil.get_tasks('default', expected_count=1)[0]
+    self.assertEquals(3, int(next_task['params']['cursor']))
+
+  def testMemcacheQueue_DeferredDecode(self):
+    """Tests that items are only decoded when the result is used."""
+    work_index = MEMCACHE_QUEUE.next_index()
+    MEMCACHE_QUEUE.put(work_index, [
+        TestModel(key=db.Key.from_path(TestModel.kind(), 1),
+                  work_index=work_index, number=1)])
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = \
+        self.expect_task(work_index)['name']
+    result_list = MEMCACHE_QUEUE.pop_request(
+        testutil.create_test_request('POST', None))
+    self.assertEquals(None, result_list.entity_list)
+    self.assertEquals(1, result_list[0].number)
+    self.assertEquals(1, len(result_list.entity_list))
+
+  def put_journal_items(self, count, **kwargs):
+    """Puts TestModel items numbered from 1 on the journaled queue."""
+    work_index = JOURNAL_QUEUE.next_index()
+    work_items = [TestModel(key=db.Key.from_path(TestModel.kind(), i),
+                            work_index=work_index, number=i)
+                  for i in xrange(1, count + 1)]
+    JOURNAL_QUEUE.put(work_index, work_items, **kwargs)
+    return work_index
+
+  def pop_journal(self, task_name, params=()):
+    """Pops a task from the journaled queue; returns the item numbers."""
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = task_name
+    result_list = JOURNAL_QUEUE.pop_request(
+        testutil.create_test_request('POST', None, *params))
+    return [r.number for r in result_list]
+
+  def testJournal_Recover(self):
+    """Tests that evicted items and length are read from the journal."""
+    work_index = self.put_journal_items(5)
+    memcache.flush_all()
+
+    # Without the length, the items are read with a continuation chain.
+    self.assertEquals([1, 2, 3], self.pop_journal(
+        self.expect_task(work_index)['name']))
+    next_task = testutil.get_tasks('default', expected_count=1)[0]
+    self.assertEquals('3', next_task['params']['cursor'])
+    self.assertEquals([4, 5], self.pop_journal(
+        next_task['name'], next_task['params'].items()))
+    testutil.get_tasks('default', expected_count=1)
+
+  def testJournal_RootEntities(self):
+    """Tests that each item is journaled in its own entity group."""
+    work_index = self.put_journal_items(2)
+    JOURNAL_QUEUE.put(work_index, [TestModel(
+        key=db.Key.from_path(TestModel.kind(), 3),
+        work_index=work_index, number=3)])
+    journal_list = list(fork_join_queue.ForkJoinJournal.all())
+    self.assertEquals(
+        sorted(JOURNAL_QUEUE._create_index_key(work_index, n)
+               for n in xrange(3)),
+        sorted(j.key().name() for j in journal_list))
+    self.assertEquals([None] * 3, [j.key().parent() for j in journal_list])
+
+  def testJournal_RecoverHoles(self):
+    """Tests that only the missing items are read from the journal."""
+    work_index = self.put_journal_items(3)
+    memcache.delete(JOURNAL_QUEUE._create_index_key(work_index, 1))
+    self.assertEquals([1, 2, 3], self.pop_journal(
+        self.expect_task(work_index)['name']))
+
+  def testJournal_PutSetError(self):
+    """Tests that put() succeeds when only the memcache set fails."""
+    work_index = self.put_journal_items(2, memset=lambda *a, **k: ['blah'])
+    self.assertEquals([1, 2], self.pop_journal(
+        self.expect_task(work_index)['name']))
+
+  def testJournal_WriteError(self):
+    """Tests put() when the journal write fails."""
+    def fail(*args, **kwargs):
+      raise db.Error('Datastore is down')
+    JOURNAL_QUEUE.backend.write_journal = fail
+    try:
+      self.assertRaises(fork_join_queue.MemcacheError,
+                        self.put_journal_items,
+                        1, memset=lambda *a, **k: ['blah'])
+      # Memcache alone is still enough to enqueue the work.
+      work_index = self.put_journal_items(1)
+    finally:
+      del JOURNAL_QUEUE.backend.write_journal
+    self.assertEquals([1], self.pop_journal(
+        self.expect_task(work_index)['name']))
+
+
+class CompactModel(db.Model):
+  topic = db.TextProperty()
+  source_keys = db.StringListProperty()
+  work_index = db.IntegerProperty()
+
+
+class CompactSerializerTest(unittest.TestCase):
+  """Tests for the CompactSerializer class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing(require_indexes=False)
+    self.serializer = fork_join_queue.CompactSerializer(
+        CompactModel, ['topic', 'source_keys', 'work_index'])
+    self.entity = CompactModel(key_name='hash_1234',
+                               topic=u'http://example.com/f\u00fc\u00fc',
+                               source_keys=['one', u'tw\u00f6'],
+                               work_index=2654435761 * 8 + 3)
+
+  def testRoundTrip(self):
+    """Tests encoding and decoding all supported property types."""
+    for work_index in (0, -5, None, self.entity.work_index):
+      self.entity.work_index = work_index
+      result = self.serializer.decode(self.serializer.encode(self.entity))
+      self.assertEquals('hash_1234', result.key().name())
+      self.assertEquals(self.entity.topic, result.topic)
+      self.assertEquals(self.entity.source_keys, result.source_keys)
+      self.assertEquals(work_index, result.work_index)
+    self.entity.topic = None
+    result = self.serializer.decode(self.serializer.encode(self.entity))
+    self.assertEquals(None, result.topic)
+
+  def testSize(self):
+    """Tests that the encoding is much smaller than an EntityProto."""
+    compact = self.serializer.encode(self.entity)
+    proto = db.model_to_protobuf(self.entity).Encode()
+    self.assertTrue(2 * len(compact) < len(proto),
+                    '%d vs. %d bytes' % (len(compact), len(proto)))
+
+  def testEntityProtoFallback(self):
+    """Tests decoding values written by the EntityProtoSerializer."""
+    value = fork_join_queue.EntityProtoSerializer().encode(self.entity)
+    result = self.serializer.decode(value)
+    self.assertEquals(self.entity.topic, result.topic)
+
+  def testBadValues(self):
+    """Tests decoding unknown versions and truncated values."""
+    value = self.serializer.encode(self.entity)
+    self.assertRaises(fork_join_queue.DecodeError,
+                      self.serializer.decode,
+                      value[0] + chr(99) + value[2:])
+    self.assertRaises(fork_join_queue.DecodeError,
+                      self.serializer.decode,
+                      value[:-3])
+
+  def testRequiresKeyName(self):
+    """Tests that entities without a root key name cannot be encoded."""
+    self.assertRaises(ValueError, self.serializer.encode,
+                      CompactModel(topic='foo'))
+
+  def testQueue(self):
+    """Tests putting and popping compact items from a queue."""
+    queue = fork_join_queue.MemcacheForkJoinQueue(
+        CompactModel,
+        CompactModel.work_index,
+        '/path/to/my/task',
+        'default',
+        batch_size=3,
+        batch_period_ms=2200,
+        lock_timeout_ms=1000,
+        sync_timeout_ms=250,
+        stall_timeout_ms=30000,
+        acquire_timeout_ms=50,
+        acquire_attempts=20,
+        shard_count=1,
+        serializer=self.serializer,
+        backend=fork_join_queue.LocalBackend())
+    work_index = queue.next_index()
+    self.entity.work_index = work_index
+    queue.put(work_index, [self.entity])
+    queue.add(work_index)
+    task_name = 'fjq-CompactModel-local-0-%d-0' % work_index
+    (result,) = queue.pop(task_name)
+    self.assertEquals(self.entity.topic, result.topic)
+    self.assertEquals(work_index, result.work_index)
+
+
+class LocalBackendTest(unittest.TestCase):
+  """Tests for replaying work through a queue with the LocalBackend."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing(require_indexes=False)
+    self.backend = fork_join_queue.LocalBackend(start_time=1274078068.0)
+    self.queue = fork_join_queue.MemcacheForkJoinQueue(
+        TestModel,
+        TestModel.work_index,
+        '/path/to/my/task',
+        'default',
+        batch_size=3,
+        batch_period_ms=2200,
+        lock_timeout_ms=1000,
+        sync_timeout_ms=250,
+        stall_timeout_ms=30000,
+        acquire_timeout_ms=50,
+        acquire_attempts=20,
+        shard_count=1,
+        backend=self.backend)
+
+  def put_work(self, count):
+    """Writes a number of work items to the queue; returns the work index."""
+    work_index = self.queue.next_index()
+    self.queue.put(work_index, [
+        TestModel(key=db.Key.from_path(TestModel.kind(), i + 1),
+                  work_index=work_index, number=i)
+        for i in xrange(count)])
+    self.queue.add(work_index)
+    return work_index
+
+  def testReplay(self):
+    """Tests batching, continuations, and stats for a replayed trace."""
+    work_index = self.put_work(2)
+    self.assertEquals(work_index, self.put_work(3))
+    self.assertEquals([], self.backend.take_due_tasks())
+
+    self.backend.sleep(2.2)
+    task_list = self.backend.take_due_tasks()
+    self.assertEquals(1, len(task_list))
+    self.assertEquals('/path/to/my/task', task_list[0]['url'])
+    self.assertEquals(3, len(self.queue.pop(task_list[0]['name'])))
+
+    task_list = self.backend.take_due_tasks()
+    self.assertEquals(1, len(task_list))
+    self.assertEquals({'cursor': '3:5'}, task_list[0]['params'])
+    self.assertEquals(2, len(self.queue.pop(
+        task_list[0]['name'], task_list[0]['params']['cursor'])))
+    self.assertEquals(None, self.backend.next_task_eta())
+
+    self.assertNotEquals(work_index, self.put_work(1))
+    self.assertEquals([1, 1], self.backend.stats['task_added'])
+    self.assertEquals([1], self.backend.stats['task_deduped'])
+    self.assertEquals([1], self.backend.stats['continuation_added'])
+    self.assertEquals([3, 2], self.backend.stats['batch_size'])
+    self.assertEquals([0], self.backend.stats['writer_wait_ms'])
+    self.assertEquals([0, 1], self.backend.stats['generation'])
+    self.assertEquals([1, 1, 1], self.backend.stats['acquire_attempts'])
+    self.assertEquals([0, 0, 0], self.backend.stats['acquire_sleep_ms'])
+    self.assertEquals([], self.backend.stats['empty_pop'])
+
+  def testShardsSpreadCounters(self):
+    """Tests that writers spread evenly across the index counters."""
+    queue = fork_join_queue.MemcacheForkJoinQueue(
+        TestModel,
+        TestModel.work_index,
+        '/path/to/my/task',
+        'default',
+        batch_size=3,
+        batch_period_ms=2200,
+        lock_timeout_ms=1000,
+        sync_timeout_ms=250,
+        stall_timeout_ms=30000,
+        acquire_timeout_ms=50,
+        acquire_attempts=20,
+        shard_count=8,
+        backend=self.backend)
+    writes = collections.defaultdict(int)
+    for i in xrange(800):
+      work_index = queue.next_index(shard_key='http://example.com/%d' % i)
+      writes[queue.get_shard(work_index)] += 1
+      queue.add(work_index)
+    self.assertEquals(8, len(writes))
+    self.assertTrue(max(writes.values()) < 2 * 800 / 8, writes)
+    # One joined task per shard.
+    self.backend.sleep(2.2)
+    self.assertEquals(8, len(self.backend.take_due_tasks()))
+
+  def make_deferring_queue(self, reader_deferrals):
+    """Creates a queue whose readers defer instead of waiting for writers."""
+    return fork_join_queue.MemcacheForkJoinQueue(
+        TestModel,
+        TestModel.work_index,
+        '/path/to/my/task',
+        'default',
+        batch_size=3,
+        batch_period_ms=2200,
+        lock_timeout_ms=1000,
+        sync_timeout_ms=250,
+        stall_timeout_ms=30000,
+        acquire_timeout_ms=50,
+        acquire_attempts=20,
+        shard_count=1,
+        reader_deferrals=reader_deferrals,
+        backend=self.backend)
+
+  def testReaderDeferred(self):
+    """Tests that readers re-enqueue themselves while writers are active."""
+    queue = self.make_deferring_queue(4)
+    work_index = queue.next_index()
+    queue.put(work_index, [
+        TestModel(key=db.Key.from_path(TestModel.kind(), 1),
+                  work_index=work_index, number=1)])
+    start = self.backend.time()
+    task_name = 'fjq-TestModel-local-0-%d-0' % work_index
+    self.assertEquals([], queue.pop(task_name))
+    self.assertEquals(start, self.backend.time())
+    deferred_eta = self.backend.next_task_eta()
+    self.assertTrue(deferred_eta > start)
+
+    queue.add(work_index)
+    self.backend.sleep(deferred_eta - start)
+    (task,) = self.backend.take_due_tasks()
+    self.assertEquals(task_name + '-w1', task['name'])
+    result_list = queue.pop(task['name'])
+    self.assertEquals([1], [r.number for r in result_list])
+    self.assertEquals([1], self.backend.stats['reader_deferred'])
+    self.assertEquals([250], self.backend.stats['writer_wait_ms'])
+    self.assertEquals([0], self.backend.stats['generation'])
+
+  def testReaderDeferredGivesUp(self):
+    """Tests that readers proceed after the maximum number of deferrals."""
+    queue = self.make_deferring_queue(1)
+    work_index = queue.next_index()
+    task_name = 'fjq-TestModel-local-0-%d-0' % work_index
+    self.assertEquals([], queue.pop(task_name))
+    self.backend.sleep(self.backend.next_task_eta() - self.backend.time())
+    (task,) = self.backend.take_due_tasks()
+    self.assertEquals([], queue.pop(task['name']))
+    self.assertEquals(None, self.backend.next_task_eta())
+    self.assertEquals([1], self.backend.stats['reader_lock_timeout'])
+    self.assertEquals([1], self.backend.stats['empty_pop'])
+
+  def testReaderWaitsForWriter(self):
+    """Tests that a reader times out waiting for a writer on the clock."""
+    work_index = self.queue.next_index()
+    start = self.backend.time()
+    task_name = 'fjq-TestModel-local-0-%d-0' % work_index
+    self.assertEquals([], self.queue.pop(task_name))
+    self.assertEquals(1.0, self.backend.time() - start)
+    self.assertEquals([1], self.backend.stats['reader_lock_timeout'])
+    self.assertEquals([1000], self.backend.stats['writer_wait_ms'])
+    self.assertEquals([1], self.backend.stats['empty_pop'])
 
 ################################################################################
 
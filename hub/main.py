@@ -22,6 +22,9 @@
 * Subscription: A single subscriber's lease on a topic URL. Also represents a
   work item of a subscription that is awaiting confirmation (sub. or unsub).
 
+* SubscriptionToConfirm: Work item for a pending asynchronous confirmation of
+  a Subscription. Child of the Subscription; verified in fork-join batches.
+
 * FeedToFetch: Work item inserted when a publish event occurs. This will be
   moved to the Task Queue API once available.
 
@@ -38,6 +41,9 @@
 * KnownFeedStats: Statistics about a topic URL. Used to provide subscriber
   counts to publishers on feed fetch.
 
+* KnownFeedStatsShard: Sharded counter of the change in a topic's subscriber
+  count since KnownFeedStats was last recounted.
+
 * FeedRecord: Metadata information about a feed, the last time it was polled,
   and any headers that may affect future polling. Also contains any debugging
   information about the last feed fetch and why it may have failed.
@@ -50,6 +56,12 @@
   failures. Used to coordinate delivery retries. Will be deleted in successful
   cases or stick around in the event of complete failures for debugging.
 
+* EventPayload: Large event payload shared by all EventToDeliver instances
+  with the same content. Expires some time after it was last referenced.
+
+* DeliveryRetry: A failed delivery of an event to one subscriber that is
+  waiting for its next attempt. Child of the EventToDeliver.
+
 * PollingMarker: Work item that keeps track of the last time all KnownFeed
   instances were fetched. Used to do bootstrap polling.
 
@@ -83,6 +95,7 @@ and will be retried at a later time.
 # - Do not poll a feed if we've gotten an event from the publisher in less
 #   than the polling period.
 
+import calendar
 import datetime
 import gc
 import hashlib
@@ -97,6 +110,7 @@ import urllib
 import urlparse
 import wsgiref.handlers
 import xml.sax
+import zlib
 
 from google.appengine import runtime
 from google.appengine.api import datastore_types
@@ -115,9 +129,10 @@ import dos
 import feed_diff
 import feed_identifier
 import fork_join_queue
+import request_cache
+import task_batcher
 import urlfetch_async
 
-import mapreduce.control
 import mapreduce.model
 
 import webapp2
@@ -147,26 +162,137 @@ MAX_FEED_PULL_FAILURES = 4
 # Period to use for exponential backoff on feed pulling.
 FEED_PULL_RETRY_PERIOD = 30 # seconds
 
+# Maximum number of entity groups a cross-group transaction may touch.
+MAX_XG_ENTITY_GROUPS = 25
+
+# Names of the fork-join lanes that in-memory feed fetches are batched in.
+FEED_LANE_PRIORITY = 'priority'
+FEED_LANE_NORMAL = 'normal'
+FEED_LANE_POLLING = 'polling'
+
+# Topics with at least this many subscribers are fetched in the priority lane.
+FEED_PRIORITY_SUBSCRIBERS = 1000
+
+# How long a topic's fetching lane is cached before its subscriber count is
+# read again.
+FEED_LANE_CACHE_SECONDS = 600
+
+# Memcache key prefix for the cached fetching lane of each topic.
+FEED_LANE_CACHE_PREFIX = 'feed_lane:'
+
 # Maximum number of times to attempt to deliver a feed event.
 MAX_DELIVERY_FAILURES = 4
 
 # Period to use for exponential backoff on feed event delivery.
 DELIVERY_RETRY_PERIOD = 30 # seconds
 
+# Fraction of each delivery retry's backoff period to add as random jitter.
+DELIVERY_RETRY_JITTER = 0.25
+
+# How many due delivery retries to attempt at a time in the retry worker.
+DELIVERY_RETRY_CHUNK_SIZE = 50
+
+# Delay before a retry worker's continuation picks up the next chunk.
+DELIVERY_RETRY_CONTINUATION_SECONDS = 1
+
 # Period at which feed IDs should be refreshed.
 FEED_IDENTITY_UPDATE_PERIOD = (20 * 24 * 60 * 60) # 20 days
 
 # Number of polling feeds to fetch from the Datastore at a time.
 BOOSTRAP_FEED_CHUNK_SIZE = 50
 
-# How many old Subscription instances to clean up at a time.
-SUBSCRIPTION_CLEANUP_CHUNK_SIZE = 100
+# How many old Subscription instances to clean up per cleanup task.
+SUBSCRIPTION_CLEANUP_CHUNK_SIZE = 1000
+
+# How many Subscription keys to delete in each asynchronous Datastore call.
+SUBSCRIPTION_CLEANUP_DELETE_BATCH_SIZE = 250
+
+# Maximum average rate at which old Subscription instances are deleted.
+SUBSCRIPTION_CLEANUP_MAX_DELETES_PER_SECOND = 100
+
+# How long a running chain of cleanup tasks blocks new chains from starting
+# after its last task, in case that task never finishes.
+SUBSCRIPTION_CLEANUP_LOCK_SECONDS = 300
+
+# Memcache key marking a chain of cleanup tasks as running.
+SUBSCRIPTION_CLEANUP_LOCK_KEY = 'subscription_cleanup_running'
+
+# Maximum number of subscription requests accepted by one bulk request.
+MAX_BULK_SUBSCRIBE_REQUESTS = 1000
+
+# Rate limit on subscription requests for each callback from one address,
+# shared by single and bulk requests.
+SUBSCRIBE_CALLBACK_LIMIT = 10
+SUBSCRIBE_CALLBACK_LIMIT_PERIOD = 1 # seconds
+
+# Number of bulk subscription requests to write and enqueue per batched call.
+# The task queue accepts at most 100 tasks in a single add.
+BULK_SUBSCRIBE_CHUNK_SIZE = 100
+
+# How long a cached chunk of a topic's subscriber list may live in memcache.
+SUBSCRIBER_CACHE_SECONDS = 300
+
+# How long after a topic's subscriptions change its subscriber list queries
+# may still miss the change, since they are eventually consistent.
+SUBSCRIBER_CACHE_SETTLE_SECONDS = 30
+
+# How long a chunk of a topic's subscriber list is cached while its
+# subscriptions are settling.
+SUBSCRIBER_CACHE_UNSETTLED_SECONDS = 5
+
+# Memcache key prefix for cached subscriber lists and their statistics.
+SUBSCRIBER_CACHE_PREFIX = 'subscribers:'
+
+# Number of counter shards for each topic's subscriber count.
+SUBSCRIBER_COUNT_SHARDS = 10
+
+# Event payloads of at least this many bytes are stored once in a shared
+# EventPayload entity instead of inside each EventToDeliver.
+MIN_SHARED_PAYLOAD_BYTES = 10 * 1024
+
+# Event payloads of at least this many bytes are stored compressed with zlib.
+MIN_COMPRESSED_PAYLOAD_BYTES = 4 * 1024
+
+# Encoding marker for payloads stored compressed with zlib. Payloads without
+# an encoding marker are stored as-is.
+ZLIB_PAYLOAD = 'zlib'
+
+# How long a shared EventPayload is kept after it was last referenced.
+EVENT_PAYLOAD_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# How many expired EventPayload instances to clean up at a time.
+EVENT_PAYLOAD_CLEANUP_CHUNK_SIZE = 100
+
+# How long fork-join journal entries are kept; longer than the memcache
+# expiration of the work items they back up.
+FORK_JOIN_JOURNAL_TTL_SECONDS = 20 * 60
+
+# How many expired fork-join journal entries to clean up per cleanup task.
+FORK_JOIN_JOURNAL_CLEANUP_CHUNK_SIZE = 1000
+
+# How many fork-join journal entries to delete per Datastore RPC.
+FORK_JOIN_JOURNAL_CLEANUP_DELETE_BATCH_SIZE = 250
+
+# Maximum average rate of fork-join journal deletes; continuation tasks are
+# delayed to stay below it. Must be higher than the rate of publish pings.
+FORK_JOIN_JOURNAL_CLEANUP_MAX_DELETES_PER_SECOND = 1000
+
+# How long a running chain of journal cleanup tasks blocks new chains from
+# starting if it is not continued or finished.
+FORK_JOIN_JOURNAL_CLEANUP_LOCK_SECONDS = 300
+
+# Memcache key marking a chain of journal cleanup tasks as running.
+FORK_JOIN_JOURNAL_CLEANUP_LOCK_KEY = 'fork_join_journal_cleanup_running'
 
 # How far before expiration to refresh subscriptions.
 SUBSCRIPTION_CHECK_BUFFER_SECONDS = (24 * 60 * 60)  # 24 hours
 
-# How many mapper shards to use for reconfirming subscriptions.
-SUBSCRIPTION_RECONFIRM_SHARD_COUNT = 4
+# How far back to look for verified subscriptions that expired before they
+# could be reconfirmed.
+SUBSCRIPTION_RECONFIRM_LOOKBACK_SECONDS = (7 * 24 * 60 * 60)  # 7 days
+
+# How many subscriptions to read per reconfirmation worker task.
+SUBSCRIPTION_RECONFIRM_CHUNK_SIZE = 100
 
 # How often to poll feeds.
 POLLING_BOOTSTRAP_PERIOD = 10800  # in seconds; 3 hours
@@ -209,11 +335,14 @@ FETCH_SCORER = dos.UrlScorer(
   prefix='pull_feed')
 
 # Pushing events
-DELIVERY_SCORER = dos.UrlScorer(
+DELIVERY_SCORER = dos.CircuitBreaker(
   period=300,  # Seconds
   min_requests=0.5,  # per second
   max_failure_percentage=0.8,
-  prefix='deliver_events')
+  prefix='deliver_events',
+  open_period=60,  # Seconds
+  max_open_period=3600,  # Seconds
+  probe_count=2)
 
 
 ################################################################################
@@ -542,6 +671,112 @@ DELIVERY_SAMPLER = dos.MultiSampler([
     DELIVERY_DOMAIN_SAMPLE_DAY_LATENCY,
 ])
 
+################################################################################
+# Fork-join queue samplers
+
+FORK_JOIN_SAMPLE_MINUTE = dos.ReservoirConfig(
+    'fork_join_1m',
+    period=60,
+    samples=1000,
+    by_url=True,
+    key_name='Queue metric')
+
+FORK_JOIN_SAMPLE_HOUR = dos.ReservoirConfig(
+    'fork_join_1h',
+    period=3600,
+    samples=10000,
+    by_url=True,
+    key_name='Queue metric')
+
+FORK_JOIN_SAMPLER = dos.MultiSampler([
+    FORK_JOIN_SAMPLE_MINUTE,
+    FORK_JOIN_SAMPLE_HOUR,
+])
+
+# Events reported by fork-join queues that are shown on /stats.
+FORK_JOIN_SAMPLED_EVENTS = frozenset([
+    'acquire_attempts',
+    'acquire_sleep_ms',
+    'writer_wait_ms',
+    'batch_size',
+    'empty_pop',
+    'generation',
+    'reader_deferred',
+    'journal_recovered',
+    'journal_error',
+])
+
+_fork_join_reporter = dos.Reporter()
+
+
+class ForkJoinStatsBackend(fork_join_queue.AppEngineBackend):
+  """Fork-join backend that samples queue metrics for the /stats page.
+
+  Each metric is sampled at most once per request, keyed by the queue name
+  and event; when reported repeatedly, the largest value is kept.
+  """
+
+  def __init__(self, queue_name):
+    """Initializer.
+
+    Args:
+      queue_name: Name of the fork-join queue to use in sampling keys.
+    """
+    self.queue_name = queue_name
+
+  def report(self, event, value=1):
+    if event not in FORK_JOIN_SAMPLED_EVENTS:
+      return
+    key = '%s %s' % (self.queue_name, event)
+    for config in FORK_JOIN_SAMPLER.configs:
+      current = _fork_join_reporter.get(key, config)
+      if current is None or value > current:
+        _fork_join_reporter.set(key, config, value)
+
+
+def sample_fork_join_stats():
+  """Samples the fork-join queue metrics reported during this request."""
+  global _fork_join_reporter
+  reporter, _fork_join_reporter = _fork_join_reporter, dos.Reporter()
+  if reporter.all_keys():
+    FORK_JOIN_SAMPLER.sample(reporter)
+
+
+SUBSCRIBER_CACHE_SAMPLE_HOUR = dos.ReservoirConfig(
+    'subscriber_cache_1h',
+    period=3600,
+    samples=10000,
+    by_url=True,
+    key_name='Cache result',
+    value_units='lookups')
+
+SUBSCRIBER_CACHE_SAMPLER = dos.MultiSampler([
+    SUBSCRIBER_CACHE_SAMPLE_HOUR,
+])
+
+_subscriber_cache_reporter = dos.Reporter()
+
+
+def report_subscriber_cache(hit):
+  """Counts a subscriber list cache lookup for sampling with this request.
+
+  Args:
+    hit: True if the lookup was served from the cache.
+  """
+  key = hit and 'hits' or 'misses'
+  for config in SUBSCRIBER_CACHE_SAMPLER.configs:
+    _subscriber_cache_reporter.set(
+        key, config, (_subscriber_cache_reporter.get(key, config) or 0) + 1)
+
+
+def sample_subscriber_cache_stats():
+  """Samples the subscriber list cache lookups made during this request."""
+  global _subscriber_cache_reporter
+  reporter, _subscriber_cache_reporter = (
+      _subscriber_cache_reporter, dos.Reporter())
+  if reporter.all_keys():
+    SUBSCRIBER_CACHE_SAMPLER.sample(reporter)
+
 ################################################################################
 # Constants
 
@@ -559,6 +794,8 @@ EVENT_RETRIES_QUEUE = 'event-delivery-retries'
 
 FEED_QUEUE = 'feed-pulls'
 
+FEED_PRIORITY_QUEUE = 'feed-pulls-priority'
+
 FEED_RETRIES_QUEUE = 'feed-pulls-retries'
 
 POLLING_QUEUE = 'polling'
@@ -775,14 +1012,20 @@ class Subscription(db.Model):
                   hash_func=hash_func,
                   lease_seconds=lease_seconds,
                   expiration_time=now_time)
+      was_verified = sub.subscription_state == cls.STATE_VERIFIED
       sub.subscription_state = cls.STATE_VERIFIED
       sub.expiration_time = now_time + datetime.timedelta(seconds=lease_seconds)
       sub.confirm_failures = 0
       sub.verify_token = verify_token
       sub.secret = secret
       sub.put()
+      if not was_verified:
+        KnownFeedStatsShard.add_delta(topic, 1)
       return sub_is_new
-    return db.run_in_transaction(txn)
+    sub_is_new = db.run_in_transaction_options(
+        db.create_transaction_options(xg=True), txn)
+    cls.invalidate_cache(topic)
+    return sub_is_new
 
   @classmethod
   def request_insert(cls,
@@ -837,13 +1080,16 @@ class Subscription(db.Model):
                   expiration_time=(
                       now() + datetime.timedelta(seconds=lease_seconds)))
       sub.confirm_failures = 0
-      sub.put()
-      sub.enqueue_task(cls.STATE_VERIFIED,
-                       verify_token,
-                       secret=secret,
-                       auto_reconfirm=auto_reconfirm)
+      db.put([sub, SubscriptionToConfirm.create(
+          sub, cls.STATE_VERIFIED, verify_token, work_index,
+          secret=secret, auto_reconfirm=auto_reconfirm)])
       return sub_is_new
-    return db.run_in_transaction(txn)
+
+    work_index = SubscriptionToConfirm.next_index(auto_reconfirm)
+    try:
+      return db.run_in_transaction(txn)
+    finally:
+      SubscriptionToConfirm.get_fork_join_queue(auto_reconfirm).add(work_index)
 
   @classmethod
   def remove(cls, callback, topic):
@@ -862,11 +1108,16 @@ class Subscription(db.Model):
     key_name = cls.create_key_name(callback, topic)
     def txn():
       sub = cls.get_by_key_name(key_name)
-      if sub is not None:
-        sub.delete()
-        return True
-      return False
-    return db.run_in_transaction(txn)
+      if sub is None:
+        return False
+      sub.delete()
+      if sub.subscription_state == cls.STATE_VERIFIED:
+        KnownFeedStatsShard.add_delta(topic, -1)
+      return True
+    existed = db.run_in_transaction_options(
+        db.create_transaction_options(xg=True), txn)
+    cls.invalidate_cache(topic)
+    return existed
 
   @classmethod
   def request_remove(cls, callback, topic, verify_token):
@@ -890,12 +1141,132 @@ class Subscription(db.Model):
       sub = cls.get_by_key_name(key_name)
       if sub is not None:
         sub.confirm_failures = 0
-        sub.put()
-        sub.enqueue_task(cls.STATE_TO_DELETE, verify_token)
+        db.put([sub, SubscriptionToConfirm.create(
+            sub, cls.STATE_TO_DELETE, verify_token, work_index)])
         return True
       else:
         return False
-    return db.run_in_transaction(txn)
+
+    work_index = SubscriptionToConfirm.next_index()
+    try:
+      return db.run_in_transaction(txn)
+    finally:
+      SubscriptionToConfirm.FORK_JOIN_QUEUE.add(work_index)
+
+  @classmethod
+  def request_bulk(cls, request_list, now=datetime.datetime.now):
+    """Records many subscribe and unsubscribe requests for verification.
+
+    Behaves like request_insert() and request_remove() for each request, but
+    reads and writes Subscriptions and their SubscriptionToConfirm entities
+    with batched datastore calls, and adds each chunk of confirmations to the
+    fork-join queue as a single batch. The writes are not transactional; if a
+    chunk cannot be written or queued, the chunk is reported as failed and
+    the subscriber may retry it without harm.
+
+    Args:
+      request_list: List of tuples (mode, callback, topic, verify_token,
+        secret, lease_seconds) where mode is 'subscribe' or 'unsubscribe'.
+        Each (callback, topic) pair may only appear once.
+      now: Callable that returns the current time as a datetime instance. Used
+        for testing.
+
+    Returns:
+      List with the outcome of each request, in order: True if the request
+      was queued for verification; False if it was an unsubscribe request for
+      a Subscription that does not exist; None if it could not be recorded
+      due to a datastore, task queue, or fork-join queue error.
+    """
+    result_list = []
+    for index in xrange(0, len(request_list), BULK_SUBSCRIBE_CHUNK_SIZE):
+      chunk = request_list[index:index+BULK_SUBSCRIBE_CHUNK_SIZE]
+      try:
+        result_list.extend(cls._request_bulk_chunk(chunk, now))
+      except (apiproxy_errors.Error, db.Error, taskqueue.Error,
+              fork_join_queue.Error):
+        logging.exception('Could not record %d bulk subscription requests',
+                          len(chunk))
+        result_list.extend([None] * len(chunk))
+    return result_list
+
+  @classmethod
+  def _request_bulk_chunk(cls, request_list, now):
+    """Records a chunk of requests for request_bulk() with one batch each.
+
+    Args:
+      request_list: List of at most BULK_SUBSCRIBE_CHUNK_SIZE request tuples.
+      now: Callable that returns the current time as a datetime instance.
+
+    Returns:
+      List of True or False outcomes; see request_bulk().
+    """
+    sub_list = cls.get_by_key_name(
+        [cls.create_key_name(callback, topic)
+         for (mode, callback, topic, verify_token, secret, lease_seconds)
+         in request_list])
+
+    result_list = []
+    to_confirm = []
+    for request, sub in zip(request_list, sub_list):
+      mode, callback, topic, verify_token, secret, lease_seconds = request
+      if mode == 'subscribe':
+        if sub is None:
+          sub = cls(key_name=cls.create_key_name(callback, topic),
+                    callback=callback,
+                    callback_hash=sha1_hash(callback),
+                    topic=topic,
+                    topic_hash=sha1_hash(topic),
+                    secret=secret,
+                    verify_token=verify_token,
+                    lease_seconds=lease_seconds,
+                    expiration_time=(
+                        now() + datetime.timedelta(seconds=lease_seconds)))
+        to_confirm.append((sub, cls.STATE_VERIFIED, verify_token, secret))
+      elif sub is not None:
+        to_confirm.append((sub, cls.STATE_TO_DELETE, verify_token, None))
+      else:
+        result_list.append(False)
+        continue
+      sub.confirm_failures = 0
+      result_list.append(True)
+
+    if to_confirm:
+      work_index = SubscriptionToConfirm.next_index()
+      try:
+        put_list = []
+        for sub, next_state, verify_token, secret in to_confirm:
+          put_list.append(sub)
+          put_list.append(SubscriptionToConfirm.create(
+              sub, next_state, verify_token, work_index, secret=secret))
+        db.put(put_list)
+      finally:
+        SubscriptionToConfirm.FORK_JOIN_QUEUE.add(work_index)
+    return result_list
+
+  @classmethod
+  def request_reconfirm(cls, sub_list):
+    """Requests reconfirmation of many verified Subscriptions as one batch.
+
+    Like calling request_insert() with auto_reconfirm=True and each
+    Subscription's current verify_token and secret, but all confirmations are
+    written with one batched put and run in the same fork-join batch.
+
+    Args:
+      sub_list: List of Subscription instances to reconfirm.
+    """
+    work_index = SubscriptionToConfirm.next_index(auto_reconfirm=True)
+    try:
+      put_list = []
+      for sub in sub_list:
+        if sub.confirm_failures:
+          sub.confirm_failures = 0
+          put_list.append(sub)
+        put_list.append(SubscriptionToConfirm.create(
+            sub, cls.STATE_VERIFIED, sub.verify_token, work_index,
+            secret=sub.secret, auto_reconfirm=True))
+      db.put(put_list)
+    finally:
+      SubscriptionToConfirm.RECONFIRM_FORK_JOIN_QUEUE.add(work_index)
 
   @classmethod
   def archive(cls, callback, topic):
@@ -908,11 +1279,16 @@ class Subscription(db.Model):
     key_name = cls.create_key_name(callback, topic)
     def txn():
       sub = cls.get_by_key_name(key_name)
-      if sub is not None:
-        sub.subscription_state = cls.STATE_TO_DELETE
-        sub.confirm_failures = 0
-        sub.put()
-    return db.run_in_transaction(txn)
+      if sub is None:
+        return
+      if sub.subscription_state == cls.STATE_VERIFIED:
+        KnownFeedStatsShard.add_delta(topic, -1)
+      sub.subscription_state = cls.STATE_TO_DELETE
+      sub.confirm_failures = 0
+      sub.put()
+    db.run_in_transaction_options(
+        db.create_transaction_options(xg=True), txn)
+    cls.invalidate_cache(topic)
 
   @classmethod
   def has_subscribers(cls, topic):
@@ -930,6 +1306,18 @@ class Subscription(db.Model):
     else:
       return False
 
+  @classmethod
+  def has_cached_subscribers(cls, topic):
+    """Like has_subscribers(), but answered from the subscriber list cache.
+
+    Args:
+      topic: The topic URL to check for subscribers.
+
+    Returns:
+      True if it has verified subscribers, False otherwise.
+    """
+    return bool(cls.get_cached_subscribers(topic, 1))
+
   @classmethod
   def get_subscribers(cls, topic, count, starting_at_callback=None):
     """Gets the list of subscribers starting at an offset.
@@ -955,6 +1343,87 @@ class Subscription(db.Model):
 
     return query.fetch(count)
 
+  @classmethod
+  def get_cached_subscribers(cls, topic, count, starting_at_callback=None):
+    """Gets the list of subscribers starting at an offset, using memcache.
+
+    Each chunk of subscribers is cached under the topic's current cache
+    version, which is changed by invalidate_cache() whenever a subscription
+    for the topic changes. Falls back to get_subscribers() on a cache miss.
+    The query may not see a change yet, so for SUBSCRIBER_CACHE_SETTLE_SECONDS
+    after one, chunks are only cached for SUBSCRIBER_CACHE_UNSETTLED_SECONDS.
+
+    Args:
+      See get_subscribers().
+
+    Returns:
+      See get_subscribers().
+    """
+    topic_hash = sha1_hash(topic)
+    version_key = 'version:' + topic_hash
+    settling_key = 'settling:' + topic_hash
+    values = memcache.get_multi([version_key, settling_key],
+                                key_prefix=SUBSCRIBER_CACHE_PREFIX)
+    version = values.get(version_key)
+    if version is None:
+      # Start from a random version so chunks cached before the version was
+      # evicted can never be mistaken for current ones.
+      version = random.getrandbits(48)
+      if not memcache.add(version_key, version,
+                          key_prefix=SUBSCRIBER_CACHE_PREFIX):
+        version = memcache.get(version_key, key_prefix=SUBSCRIBER_CACHE_PREFIX)
+    if version is None:
+      logging.warning('Could not get subscriber cache version for topic %r',
+                      topic)
+      return cls.get_subscribers(topic, count, starting_at_callback)
+
+    chunk_key = 'chunk:%s:%d:%d:%s' % (
+        topic_hash, version, count, sha1_hash(starting_at_callback or ''))
+    packed = memcache.get(chunk_key, key_prefix=SUBSCRIBER_CACHE_PREFIX)
+    if packed is not None:
+      report_subscriber_cache(True)
+      return [db.model_from_protobuf(p) for p in packed]
+
+    report_subscriber_cache(False)
+    subscription_list = cls.get_subscribers(topic, count, starting_at_callback)
+    if settling_key in values:
+      cache_seconds = SUBSCRIBER_CACHE_UNSETTLED_SECONDS
+    else:
+      cache_seconds = SUBSCRIBER_CACHE_SECONDS
+    memcache.set(chunk_key,
+                 [db.model_to_protobuf(s).Encode() for s in subscription_list],
+                 time=cache_seconds,
+                 key_prefix=SUBSCRIBER_CACHE_PREFIX)
+    return subscription_list
+
+  @staticmethod
+  def invalidate_cache(topic):
+    """Invalidates all cached subscriber lists for a topic.
+
+    Must be called after the change to the Subscription is committed.
+
+    Args:
+      topic: The topic URL whose subscribers changed.
+    """
+    topic_hash = sha1_hash(topic)
+    memcache.set('settling:' + topic_hash, True,
+                 time=SUBSCRIBER_CACHE_SETTLE_SECONDS,
+                 key_prefix=SUBSCRIBER_CACHE_PREFIX)
+    memcache.incr('version:' + topic_hash,
+                  key_prefix=SUBSCRIBER_CACHE_PREFIX)
+
+  @staticmethod
+  def get_cache_stats():
+    """Returns a tuple (hits, misses) for the subscriber list cache.
+
+    The totals are summed from the lookups sampled over the last hour, so
+    they are estimates once more requests were made than there are samples.
+    """
+    result = SUBSCRIBER_CACHE_SAMPLER.get(SUBSCRIBER_CACHE_SAMPLE_HOUR)
+    def total(key):
+      return sum(value for when, value in result.get_samples(key))
+    return total('hits'), total('misses')
+
   def enqueue_task(self,
                    next_state,
                    verify_token,
@@ -972,13 +1441,11 @@ class Subscription(db.Model):
         The new secret to use for this subscription after successful
         confirmation.
     """
-    RETRIES = 3
     if auto_reconfirm:
       target_queue = POLLING_QUEUE
     else:
       target_queue = SUBSCRIPTION_QUEUE
-    for i in xrange(RETRIES):
-      try:
+    task_batcher.add(
         taskqueue.Task(
             url='/work/subscriptions',
             eta=self.eta,
@@ -986,16 +1453,8 @@ class Subscription(db.Model):
                     'next_state': next_state,
                     'verify_token': verify_token,
                     'secret': secret or '',
-                    'auto_reconfirm': str(auto_reconfirm)}
-            ).add(target_queue, transactional=True)
-      except (taskqueue.Error, apiproxy_errors.Error):
-        logging.exception('Could not insert task to confirm '
-                          'topic = %s, callback = %s',
-                          self.topic, self.callback)
-        if i == (RETRIES - 1):
-          raise
-      else:
-        return
+                    'auto_reconfirm': str(auto_reconfirm)}),
+        target_queue)
 
   def confirm_failed(self,
                      next_state,
@@ -1026,20 +1485,235 @@ class Subscription(db.Model):
       False if we should give up and never try again.
     """
     def txn():
-      if self.confirm_failures >= max_failures:
-        logging.debug('Max subscription failures exceeded, giving up.')
+      if not self._record_confirm_failure(max_failures, retry_period, now):
         return False
-      else:
-        retry_delay = retry_period * (2 ** self.confirm_failures)
-        self.eta = now() + datetime.timedelta(seconds=retry_delay)
-        self.confirm_failures += 1
       self.put()
       self.enqueue_task(next_state,
                         verify_token,
                         auto_reconfirm=auto_reconfirm,
                         secret=secret)
       return True
-    return db.run_in_transaction(txn)
+    should_retry = task_batcher.run_in_transaction(txn)
+    Subscription.invalidate_cache(self.topic)
+    return should_retry
+
+  def _record_confirm_failure(self, max_failures, retry_period, now):
+    """Updates this entity for a failed confirmation without saving it.
+
+    Args:
+      max_failures: Maximum failures to allow before giving up.
+      retry_period: Initial period for doing exponential (base-2) backoff.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      True if the confirmation should be retried at the new ETA, False if
+      we should give up.
+    """
+    if self.confirm_failures >= max_failures:
+      logging.debug('Max subscription failures exceeded, giving up.')
+      return False
+    retry_delay = retry_period * (2 ** self.confirm_failures)
+    self.eta = now() + datetime.timedelta(seconds=retry_delay)
+    self.confirm_failures += 1
+    return True
+
+  @classmethod
+  def confirm_failed_all(cls,
+                         failure_list,
+                         max_failures=MAX_SUBSCRIPTION_CONFIRM_FAILURES,
+                         retry_period=SUBSCRIPTION_RETRY_PERIOD,
+                         now=datetime.datetime.utcnow):
+    """Reports that a batch of asynchronous confirmations has failed.
+
+    Has the same effect as calling confirm_failed() for each failure, but
+    adds all retry tasks with one call per queue and then writes all of the
+    Subscriptions with one put. The retry tasks have an ETA of at least
+    retry_period in the future, so they are added first instead of
+    transactionally.
+
+    Args:
+      failure_list: List of (subscription, next_state, verify_token,
+        auto_reconfirm, secret) tuples, with the arguments of confirm_failed()
+        for each Subscription.
+      max_failures: Maximum failures to allow before giving up.
+      retry_period: Initial period for doing exponential (base-2) backoff.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      List of booleans in the same order as failure_list; True if that
+      confirmation will be retried, False if we should give up.
+    """
+    retry_list = []
+    put_list = []
+    for sub, next_state, verify_token, auto_reconfirm, secret in failure_list:
+      if sub._record_confirm_failure(max_failures, retry_period, now):
+        sub.enqueue_task(next_state,
+                         verify_token,
+                         auto_reconfirm=auto_reconfirm,
+                         secret=secret)
+        put_list.append(sub)
+        retry_list.append(True)
+      else:
+        retry_list.append(False)
+    if put_list:
+      task_batcher.flush()
+      db.put(put_list)
+      for topic in set(sub.topic for sub in put_list):
+        cls.invalidate_cache(topic)
+    return retry_list
+
+
+class SubscriptionToConfirm(db.Model):
+  """A pending asynchronous confirmation of a Subscription.
+
+  Confirmations are verified in batches by the SubscriptionConfirmHandler
+  through a fork-join queue. Each entity is a child of the Subscription it
+  confirms, so it can be written in the same transaction; its key name is
+  derived from the work index, so repeated requests for a Subscription in the
+  same batch replace each other.
+
+  Auto-reconfirmations run on their own fork-join queue, whose index counter
+  is separate from the one for user requests, so their work index is kept in
+  a property of its own.
+  """
+
+  next_state = db.StringProperty(indexed=False)
+  verify_token = db.TextProperty()
+  secret = db.TextProperty()
+  auto_reconfirm = db.BooleanProperty(default=False, indexed=False)
+  work_index = db.IntegerProperty()
+  reconfirm_index = db.IntegerProperty()
+
+  # Queues for user-requested confirmations and for auto-reconfirmations.
+  FORK_JOIN_QUEUE = None
+  RECONFIRM_FORK_JOIN_QUEUE = None
+
+  @classmethod
+  def create(cls,
+             sub,
+             next_state,
+             verify_token,
+             work_index,
+             secret=None,
+             auto_reconfirm=False):
+    """Creates a new, unsaved SubscriptionToConfirm.
+
+    Args:
+      sub: The Subscription to confirm.
+      next_state: The next state the Subscription should be in.
+      verify_token: The verify_token to use when confirming the request.
+      work_index: The fork-join work index from next_index().
+      secret: Only required for subscription confirmation (not unsubscribe).
+        The new secret to use for the subscription after confirmation.
+      auto_reconfirm: True if this confirmation is being requested by the
+        auto-reconfirmation offline process; False if it is user-requested.
+
+    Returns:
+      The SubscriptionToConfirm instance.
+    """
+    if auto_reconfirm:
+      return cls(parent=sub,
+                 key_name='reconfirm-%d' % work_index,
+                 next_state=next_state,
+                 verify_token=verify_token,
+                 secret=secret,
+                 auto_reconfirm=True,
+                 reconfirm_index=work_index)
+    return cls(parent=sub,
+               key_name='work-%d' % work_index,
+               next_state=next_state,
+               verify_token=verify_token,
+               secret=secret,
+               work_index=work_index)
+
+  @classmethod
+  def next_index(cls, auto_reconfirm=False):
+    """Reserves the next work index for confirmations.
+
+    The caller must call add() on the get_fork_join_queue() queue with the
+    index once the confirmations have been written, even if writing them
+    failed.
+
+    Args:
+      auto_reconfirm: True if the confirmations are being requested by the
+        auto-reconfirmation offline process.
+
+    Returns:
+      The work index to use.
+
+    Raises:
+      fork_join_queue.Error if the index could not be reserved.
+    """
+    return cls.get_fork_join_queue(auto_reconfirm).next_index()
+
+  @classmethod
+  def get_fork_join_queue(cls, auto_reconfirm=False):
+    """Returns the fork-join queue for a kind of confirmation.
+
+    Args:
+      auto_reconfirm: True for the auto-reconfirmation queue, whose batches
+        run on the polling queue instead of the subscriptions queue.
+
+    Returns:
+      The ForkJoinQueue instance.
+    """
+    if auto_reconfirm:
+      return cls.RECONFIRM_FORK_JOIN_QUEUE
+    return cls.FORK_JOIN_QUEUE
+
+  @classmethod
+  def get_task_queue(cls, task_name):
+    """Returns the fork-join queue that a work task was enqueued on.
+
+    Args:
+      task_name: Name of the fork-join task.
+
+    Returns:
+      The ForkJoinQueue instance that owns the task.
+    """
+    return cls.get_fork_join_queue(task_name.startswith(
+        cls.RECONFIRM_FORK_JOIN_QUEUE.name + '-'))
+
+  @property
+  def subscription_key(self):
+    """Returns the key of the Subscription to confirm."""
+    return self.parent_key()
+
+
+def create_confirm_queue(name, index_property, queue_name):
+  """Creates a fork-join queue for SubscriptionToConfirm work.
+
+  Args:
+    name: Prefix for the queue's memcache keys and task names.
+    index_property: SubscriptionToConfirm property holding the work index.
+    queue_name: Task queue the confirmation batches run on.
+
+  Returns:
+    The ForkJoinQueue instance.
+  """
+  return fork_join_queue.ForkJoinQueue(
+      SubscriptionToConfirm,
+      index_property,
+      '/work/subscriptions',
+      queue_name,
+      name=name,
+      batch_size=20,
+      batch_period_ms=1000,
+      lock_timeout_ms=10000,
+      sync_timeout_ms=250,
+      stall_timeout_ms=30000,
+      acquire_timeout_ms=10,
+      acquire_attempts=50,
+      reader_deferrals=40,
+      backend=ForkJoinStatsBackend(name))
+
+
+SubscriptionToConfirm.FORK_JOIN_QUEUE = create_confirm_queue(
+    'fjq-SubscriptionToConfirm', SubscriptionToConfirm.work_index,
+    SUBSCRIPTION_QUEUE)
+SubscriptionToConfirm.RECONFIRM_FORK_JOIN_QUEUE = create_confirm_queue(
+    'fjq-SubscriptionToConfirm-reconfirm',
+    SubscriptionToConfirm.reconfirm_index, POLLING_QUEUE)
 
 
 class FeedToFetch(db.Expando):
@@ -1060,7 +1734,21 @@ class FeedToFetch(db.Expando):
   # TODO(bslatkin): Add fetching failure reason (urlfetch, parsing, etc) and
   # surface it on the topic details page.
 
+  # The queue of the normal lane and the queues of all lanes by name.
   FORK_JOIN_QUEUE = None
+  FORK_JOIN_LANES = None
+
+  @classmethod
+  def create_key(cls, topic):
+    """Creates the key for a FeedToFetch.
+
+    Args:
+      topic: The URL for the feed.
+
+    Returns:
+      db.Key of the FeedToFetch for the topic.
+    """
+    return db.Key.from_path(cls.kind(), get_hash_key_name(topic))
 
   @classmethod
   def get_by_topic(cls, topic):
@@ -1072,10 +1760,10 @@ class FeedToFetch(db.Expando):
     Returns:
       The FeedToFetch or None if it does not exist.
     """
-    return cls.get_by_key_name(get_hash_key_name(topic))
+    return request_cache.get(cls.create_key(topic))
 
   @classmethod
-  def insert(cls, topic_list, source_dict=None, memory_only=True):
+  def insert(cls, topic_list, source_dict=None, memory_only=True, lane=None):
     """Inserts a set of FeedToFetch entities for a set of topics.
 
     Overwrites any existing entities that are already there.
@@ -1085,6 +1773,8 @@ class FeedToFetch(db.Expando):
       source_dict: Dictionary of sources for the feed. Defaults to an empty
         dictionary.
       memory_only: Only save FeedToFetch records to memory, not to disk.
+      lane: Name of the fork-join lane to use for in-memory work; by default
+        it is chosen for each topic by _assign_lanes().
 
     Returns:
       The list of FeedToFetch records that was created.
@@ -1097,35 +1787,109 @@ class FeedToFetch(db.Expando):
     else:
       source_keys, source_values = [], []
 
-    if os.environ.get('HTTP_X_APPENGINE_QUEUENAME') == POLLING_QUEUE:
-      cls.FORK_JOIN_QUEUE.queue_name = POLLING_QUEUE
-    else:
-      cls.FORK_JOIN_QUEUE.queue_name = FEED_QUEUE
-
-    if memory_only:
-      work_index = cls.FORK_JOIN_QUEUE.next_index()
-    else:
-      work_index = None
-    try:
-      feed_list = [
-          cls(key=db.Key.from_path(cls.kind(), get_hash_key_name(topic)),
-              topic=topic,
-              source_keys=list(source_keys),
-              source_values=list(source_values),
-              work_index=work_index)
-          for topic in set(topic_list)]
-      if memory_only:
-        cls.FORK_JOIN_QUEUE.put(work_index, feed_list)
-      else:
-        # TODO(bslatkin): Insert fetching tasks here to fix the polling
-        # mode for this codebase.
-        db.put(feed_list)
-    finally:
-      if memory_only:
-        cls.FORK_JOIN_QUEUE.add(work_index)
+    topic_set = set(topic_list)
+    if not memory_only:
+      feed_list = [cls._create(topic, source_keys, source_values, None)
+                   for topic in topic_set]
+      # TODO(bslatkin): Insert fetching tasks here to fix the polling
+      # mode for this codebase.
+      db.put(feed_list)
+      return feed_list
+
+    feed_list = []
+    lane_dict = cls._assign_lanes(topic_set, lane)
+    for lane_name in sorted(lane_dict):
+      lane_topics = lane_dict[lane_name]
+      queue = cls.FORK_JOIN_LANES[lane_name]
+      # All topics in a lane share one work index; shard on the smallest so
+      # the same set of topics, and every single-topic ping, maps to the same
+      # counter.
+      work_index = queue.next_index(shard_key=min(lane_topics))
+      try:
+        lane_feeds = [
+            cls._create(topic, source_keys, source_values, work_index)
+            for topic in lane_topics]
+        queue.put(work_index, lane_feeds)
+        feed_list.extend(lane_feeds)
+      finally:
+        queue.add(work_index)
 
     return feed_list
 
+  @classmethod
+  def _create(cls, topic, source_keys, source_values, work_index):
+    """Creates a FeedToFetch for a topic without saving it."""
+    return cls(key=cls.create_key(topic),
+               topic=topic,
+               source_keys=list(source_keys),
+               source_values=list(source_values),
+               work_index=work_index)
+
+  @classmethod
+  def _assign_lanes(cls, topic_set, lane=None):
+    """Assigns each topic to the fork-join lane it should be fetched in.
+
+    Work inserted while running on the polling queue goes to the polling
+    lane; otherwise topics with at least FEED_PRIORITY_SUBSCRIBERS
+    subscribers go to the priority lane and all others to the normal lane.
+    Each topic's lane is cached for FEED_LANE_CACHE_SECONDS, so most inserts
+    do not read subscriber counts from the Datastore.
+
+    Args:
+      topic_set: Set of topic URLs.
+      lane: Name of the lane to use for all topics, or None to choose.
+
+    Returns:
+      Dictionary mapping lane names to lists of topics, in the iteration
+      order of the topic set.
+    """
+    if (lane is None and
+        os.environ.get('HTTP_X_APPENGINE_QUEUENAME') == POLLING_QUEUE):
+      lane = FEED_LANE_POLLING
+    if lane is not None:
+      return {lane: list(topic_set)}
+
+    topic_list = list(topic_set)
+    key_list = [sha1_hash(topic) for topic in topic_list]
+    lane_cache = memcache.get_multi(key_list, key_prefix=FEED_LANE_CACHE_PREFIX)
+    missing = [(topic, key) for topic, key in zip(topic_list, key_list)
+               if key not in lane_cache]
+    if missing:
+      new_lanes = {}
+      stats_list = KnownFeedStats.get_or_create_all(
+          [topic for topic, key in missing])
+      for (topic, key), stats in zip(missing, stats_list):
+        if stats.subscriber_count >= FEED_PRIORITY_SUBSCRIBERS:
+          new_lanes[key] = FEED_LANE_PRIORITY
+        else:
+          new_lanes[key] = FEED_LANE_NORMAL
+      memcache.set_multi(new_lanes, time=FEED_LANE_CACHE_SECONDS,
+                         key_prefix=FEED_LANE_CACHE_PREFIX)
+      lane_cache.update(new_lanes)
+
+    lane_dict = {}
+    for topic, key in zip(topic_list, key_list):
+      lane_dict.setdefault(lane_cache[key], []).append(topic)
+    return lane_dict
+
+  @classmethod
+  def get_fork_join_queue(cls, task_name):
+    """Returns the lane's fork-join queue that a work task was enqueued on.
+
+    Args:
+      task_name: Name of the fork-join task.
+
+    Returns:
+      The MemcacheForkJoinQueue that owns the task.
+    """
+    # Longest names first, since the normal lane's name is a prefix of the
+    # names of the other lanes.
+    for queue in sorted(cls.FORK_JOIN_LANES.itervalues(),
+                        key=lambda q: len(q.name), reverse=True):
+      if task_name.startswith(queue.name + '-'):
+        return queue
+    return cls.FORK_JOIN_QUEUE
+
   def fetch_failed(self,
                    max_failures=MAX_FEED_PULL_FAILURES,
                    retry_period=FEED_PULL_RETRY_PERIOD,
@@ -1142,23 +1906,91 @@ class FeedToFetch(db.Expando):
     """
     orig_failures = self.fetching_failures
     def txn():
-      if self.fetching_failures >= max_failures:
-        logging.debug('Max fetching failures exceeded, giving up.')
-        self.totally_failed = True
-      else:
-        retry_delay = retry_period * (2 ** orig_failures)
-        logging.debug('Fetching failed. Will retry in %s seconds',
-                      retry_delay)
-        self.eta = now() + datetime.timedelta(seconds=retry_delay)
-        self.fetching_failures = orig_failures + 1
+      self.fetching_failures = orig_failures
+      if self._record_failure(max_failures, retry_period, now):
         self._enqueue_retry_task()
       self.put()
     try:
-      db.run_in_transaction_custom_retries(2, txn)
+      task_batcher.run_in_transaction_custom_retries(2, txn)
     except:
       logging.exception('Could not mark feed fetching as a failure: topic=%r',
                         self.topic)
 
+  def _record_failure(self, max_failures, retry_period, now):
+    """Updates this entity for a failed fetch without saving it.
+
+    Args:
+      max_failures: Maximum failures to allow before giving up.
+      retry_period: Initial period for doing exponential (base-2) backoff.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      True if the fetch should be retried at the new ETA, False otherwise.
+    """
+    if self.fetching_failures >= max_failures:
+      logging.debug('Max fetching failures exceeded, giving up.')
+      self.totally_failed = True
+      return False
+    retry_delay = retry_period * (2 ** self.fetching_failures)
+    logging.debug('Fetching failed. Will retry in %s seconds', retry_delay)
+    self.eta = now() + datetime.timedelta(seconds=retry_delay)
+    self.fetching_failures += 1
+    return True
+
+  @classmethod
+  def finish_all(cls,
+                 done_list,
+                 failed_list,
+                 memory_only=False,
+                 max_failures=MAX_FEED_PULL_FAILURES,
+                 retry_period=FEED_PULL_RETRY_PERIOD,
+                 now=datetime.datetime.utcnow):
+    """Reports the outcome of a batch of feed fetches.
+
+    Has the same effect as calling done() on each entity in done_list and
+    fetch_failed() on each entity in failed_list. Successful fetches of saved
+    entities are deleted with one cross-group transaction per
+    MAX_XG_ENTITY_GROUPS entities. When the entities came from the in-memory
+    work queue, none of them are in the Datastore: successful fetches need no
+    Datastore access at all, and the failures are written with one batched
+    put after their retry tasks are enqueued in one call.
+
+    Args:
+      done_list: List of FeedToFetch entities that were fetched successfully.
+      failed_list: List of FeedToFetch entities that failed to fetch.
+      memory_only: True if all entities came from the in-memory work queue
+        and were never written to the Datastore.
+      max_failures: Maximum failures to allow before giving up.
+      retry_period: Initial period for doing exponential (base-2) backoff.
+      now: Returns the current time as a UTC datetime.
+    """
+    if not memory_only:
+      for i in xrange(0, len(done_list), MAX_XG_ENTITY_GROUPS):
+        cls._delete_unchanged(done_list[i:i + MAX_XG_ENTITY_GROUPS])
+      # Saved failures still take one transaction each: every retry task is
+      # added transactionally with its entity, and a transaction may only
+      # add five tasks.
+      for work in failed_list:
+        work.fetch_failed(max_failures=max_failures,
+                          retry_period=retry_period,
+                          now=now)
+      return
+
+    if not failed_list:
+      return
+    queue_name = cls._get_retry_queue_name()
+    try:
+      for work in failed_list:
+        if work._record_failure(max_failures, retry_period, now):
+          task_batcher.add(work._create_retry_task(), queue_name)
+      # The retry tasks have an ETA of at least retry_period in the future,
+      # leaving plenty of time for the entities to be written.
+      task_batcher.flush()
+      db.put(failed_list)
+    except (db.Error, taskqueue.Error, apiproxy_errors.Error):
+      logging.exception('Could not mark %d feed fetches as failures',
+                        len(failed_list))
+
   def done(self):
     """The feed fetch has completed successfully.
 
@@ -1172,51 +2004,120 @@ class FeedToFetch(db.Expando):
       FeedToFetch record never made it into the Datastore (because it only
       ever lived in the in-memory cache), this function will return False.
     """
+    return bool(self._delete_unchanged([self]))
+
+  @staticmethod
+  def _delete_unchanged(work_list):
+    """Deletes saved entities whose ETA has not changed, in one transaction.
+
+    Args:
+      work_list: List of at most MAX_XG_ENTITY_GROUPS FeedToFetch entities.
+
+    Returns:
+      The number of entities that were deleted.
+    """
     def txn():
-      other = db.get(self.key())
-      if other and other.eta == self.eta:
-        other.delete()
-        return True
-      else:
-        return False
-    return db.run_in_transaction(txn)
+      stored_list = db.get([work.key() for work in work_list])
+      delete_list = [stored for work, stored in zip(work_list, stored_list)
+                     if stored and stored.eta == work.eta]
+      db.delete(delete_list)
+      return len(delete_list)
+    return db.run_in_transaction_options(
+        db.create_transaction_options(xg=True), txn)
+
+  @staticmethod
+  def _get_retry_queue_name():
+    """Returns the name of the queue to use for fetch retry tasks."""
+    if os.environ.get('HTTP_X_APPENGINE_QUEUENAME') == POLLING_QUEUE:
+      return POLLING_QUEUE
+    else:
+      return FEED_RETRIES_QUEUE
+
+  def _create_retry_task(self):
+    """Creates a task to retry fetching this feed at its ETA."""
+    return taskqueue.Task(
+        url='/work/pull_feeds',
+        eta=self.eta,
+        params={'topic': self.topic})
 
   def _enqueue_retry_task(self):
     """Enqueues a task to retry fetching this feed."""
-    RETRIES = 3
+    task_batcher.add(self._create_retry_task(), self._get_retry_queue_name())
 
-    if os.environ.get('HTTP_X_APPENGINE_QUEUENAME') == POLLING_QUEUE:
-      queue_name = POLLING_QUEUE
-    else:
-      queue_name = FEED_RETRIES_QUEUE
 
-    for i in xrange(RETRIES):
-      try:
-        taskqueue.Task(
-            url='/work/pull_feeds',
-            eta=self.eta,
-            params={'topic': self.topic}).add(queue_name, transactional=True)
-      except (taskqueue.Error, apiproxy_errors.Error):
-        if i == (RETRIES - 1):
-          raise
-      else:
-        return
+def create_feed_lane(name, queue_name, batch_period_ms, shard_count):
+  """Creates the fork-join queue for one lane of FeedToFetch work.
 
+  Args:
+    name: Prefix for the lane's memcache keys and task names.
+    queue_name: Task queue the lane's work runs on. The relative rates of
+      these queues in queue.yaml decide how lanes share fetching capacity.
+    batch_period_ms: How long to coalesce pings into a batch.
+    shard_count: How many index counters to spread writers across.
 
-FeedToFetch.FORK_JOIN_QUEUE = fork_join_queue.MemcacheForkJoinQueue(
-    FeedToFetch,
-    FeedToFetch.work_index,
-    '/work/pull_feeds',
-    FEED_QUEUE,
-    batch_size=15,
-    batch_period_ms=500,
-    lock_timeout_ms=10000,
-    sync_timeout_ms=250,
-    stall_timeout_ms=30000,
-    acquire_timeout_ms=10,
-    acquire_attempts=50,
-    shard_count=1,
-    expiration_seconds=600)  # Give up on fetches after 10 minutes.
+  Returns:
+    The MemcacheForkJoinQueue for the lane.
+  """
+  return fork_join_queue.MemcacheForkJoinQueue(
+      FeedToFetch,
+      FeedToFetch.work_index,
+      '/work/pull_feeds',
+      queue_name,
+      name=name,
+      batch_size=15,
+      batch_period_ms=batch_period_ms,
+      lock_timeout_ms=10000,
+      sync_timeout_ms=250,
+      stall_timeout_ms=30000,
+      acquire_timeout_ms=10,
+      acquire_attempts=50,
+      # Check for writers every sync_timeout_ms for up to lock_timeout_ms
+      # without holding a request open.
+      reader_deferrals=40,
+      backend=ForkJoinStatsBackend(name),
+      # Spreads the index counters and writer locks across memcache keys; the
+      # work still runs on a single task queue.
+      shard_count=shard_count,
+      expiration_seconds=600,  # Give up on fetches after 10 minutes.
+      # Pings evicted from memcache before their batch runs are recovered
+      # from the Datastore.
+      journal=True,
+      serializer=fork_join_queue.CompactSerializer(
+          FeedToFetch,
+          ['topic', 'source_keys', 'source_values', 'work_index']))
+
+
+FeedToFetch.FORK_JOIN_LANES = {
+  FEED_LANE_PRIORITY: create_feed_lane(
+      'fjq-FeedToFetch-priority', FEED_PRIORITY_QUEUE, 100, 8),
+  FEED_LANE_NORMAL: create_feed_lane('fjq-FeedToFetch', FEED_QUEUE, 500, 8),
+  FEED_LANE_POLLING: create_feed_lane(
+      'fjq-FeedToFetch-polling', POLLING_QUEUE, 5000, 1),
+}
+FeedToFetch.FORK_JOIN_QUEUE = FeedToFetch.FORK_JOIN_LANES[FEED_LANE_NORMAL]
+
+
+def find_envelope_split(header_footer):
+  """Finds where entries should be spliced into a feed's header and footer.
+
+  Args:
+    header_footer: The header and footer of a feed document.
+
+  Returns:
+    The index in 'header_footer' of the closing tags that should follow the
+    entries, or None if the closing tags could not be found.
+  """
+  close_index = header_footer.rfind('</')
+  if close_index == -1:
+    return None
+  if 'rss' in header_footer[close_index:]:
+    # RSS needs special handling, since it actually closes with
+    # a combination of </channel></rss> we need to traverse one
+    # level higher.
+    close_index = header_footer.rfind('</', 0, close_index)
+    if close_index == -1:
+      return None
+  return close_index
 
 
 class FeedRecord(db.Model):
@@ -1231,6 +2132,7 @@ class FeedRecord(db.Model):
 
   topic = db.TextProperty(required=True)
   header_footer = db.TextProperty()
+  envelope_split = db.IntegerProperty(indexed=False)  # See header_footer
   last_updated = db.DateTimeProperty(auto_now=True, indexed=False)
   format = db.TextProperty()  # 'atom', 'rss', or 'arbitrary'
 
@@ -1251,6 +2153,18 @@ class FeedRecord(db.Model):
     """
     return get_hash_key_name(topic)
 
+  @classmethod
+  def create_key(cls, topic):
+    """Creates the key for a FeedRecord.
+
+    Args:
+      topic: The topic URL for the FeedRecord.
+
+    Returns:
+      db.Key of the FeedRecord for the topic.
+    """
+    return db.Key.from_path(cls.kind(), cls.create_key_name(topic))
+
   @classmethod
   def get_or_create_all(cls, topic_list):
     """Retrieves and/or creates FeedRecord entities for the supplied topics.
@@ -1262,9 +2176,8 @@ class FeedRecord(db.Model):
       The list of FeedRecords corresponding to the input topic list in the
       same order they were supplied.
     """
-    key_list = [db.Key.from_path(cls.kind(), cls.create_key_name(t))
-                for t in topic_list]
-    found_list = db.get(key_list)
+    key_list = [cls.create_key(t) for t in topic_list]
+    found_list = request_cache.get(key_list)
     results = []
     for topic, key, found in zip(topic_list, key_list, found_list):
       if found:
@@ -1318,6 +2231,7 @@ class FeedRecord(db.Model):
       self.format = format
     if header_footer is not None and self.format != ARBITRARY:
       self.header_footer = header_footer
+      self.envelope_split = find_envelope_split(header_footer)
 
   def get_request_headers(self, subscriber_count):
     """Returns the request headers that should be used to pull this feed.
@@ -1412,6 +2326,84 @@ class FeedEntryRecord(db.Expando):
     return cls(key=key, entry_content_hash=content_hash)
 
 
+def encode_payload(payload):
+  """Encodes an event payload for storage, compressing it when worthwhile.
+
+  Args:
+    payload: The payload bytes.
+
+  Returns:
+    Tuple (data, encoding) where 'data' is the db.Blob to store and
+    'encoding' is ZLIB_PAYLOAD for compressed data or None otherwise.
+  """
+  if len(payload) >= MIN_COMPRESSED_PAYLOAD_BYTES:
+    compressed = zlib.compress(payload)
+    if len(compressed) < len(payload):
+      return db.Blob(compressed), ZLIB_PAYLOAD
+  return db.Blob(payload), None
+
+
+def decode_payload(data, encoding):
+  """Decodes an event payload that was encoded with encode_payload().
+
+  Args:
+    data: The stored payload data.
+    encoding: The encoding marker that was stored with the data.
+
+  Returns:
+    The original payload bytes.
+  """
+  if encoding == ZLIB_PAYLOAD:
+    return zlib.decompress(data)
+  return data
+
+
+class EventPayload(db.Model):
+  """Represents an event payload shared by any number of EventToDeliver.
+
+  The key_name is a hash of the payload, so identical content delivered for
+  several topics (e.g., feed aliases) is only stored once. These entities are
+  written outside of the EventToDeliver transactions and are never reference
+  counted; instead each new reference extends the expiration time and expired
+  payloads are periodically cleaned up.
+  """
+
+  payload = db.BlobProperty(required=True)
+  encoding = db.StringProperty(indexed=False)
+  expiration_time = db.DateTimeProperty(required=True)
+
+  @staticmethod
+  def create_key_name(payload):
+    """Creates the key name for a payload."""
+    return get_hash_key_name(payload)
+
+  @classmethod
+  def store(cls, payload, now=datetime.datetime.utcnow):
+    """Stores a payload or extends the expiration of an existing copy.
+
+    To save on writes, an existing copy is only rewritten once half of its
+    time to live has passed.
+
+    Args:
+      payload: The payload bytes.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      The key name of the stored EventPayload.
+    """
+    key_name = cls.create_key_name(payload)
+    ttl = datetime.timedelta(seconds=EVENT_PAYLOAD_TTL_SECONDS)
+    current = now()
+    existing = cls.get_by_key_name(key_name)
+    if existing is None or existing.expiration_time < current + ttl / 2:
+      data, encoding = encode_payload(payload)
+      cls(key_name=key_name,
+          payload=data,
+          encoding=encoding,
+          expiration_time=current + ttl).put()
+    return key_name
+
+
 class EventToDeliver(db.Expando):
   """Represents a publishing event to deliver to subscribers.
 
@@ -1421,6 +2413,9 @@ class EventToDeliver(db.Expando):
   through all Subscription entities for this topic, sending them the event
   payload. The update() method should be used to track the progress of the
   background worker as well as any Subscription entities that failed delivery.
+  Each failed Subscription gets its own DeliveryRetry child entity; once the
+  first pass through all subscribers is done, the event is in the 'scheduled'
+  mode and only sticks around to hold the payload for those retries.
 
   The key_name for each of these entities is unique. It is up to the event
   injection side of the system to de-dupe events to deliver. For example, when
@@ -1428,11 +2423,15 @@ class EventToDeliver(db.Expando):
   Later, when the feed puller comes through to grab feed diffs, it should insert
   a single event to deliver, collapsing any overlapping publish events during
   the delay from publish time to feed pulling time.
+
+  The 'retry' mode and the failed_callbacks list are only used by events that
+  were written before per-subscription retries existed.
   """
 
-  DELIVERY_MODES = ('normal', 'retry')
+  DELIVERY_MODES = ('normal', 'retry', 'scheduled')
   NORMAL = 'normal'
   RETRY = 'retry'
+  SCHEDULED = 'scheduled'
 
   topic = db.TextProperty(required=True)
   topic_hash = db.StringProperty(required=True)
@@ -1445,6 +2444,8 @@ class EventToDeliver(db.Expando):
   totally_failed = db.BooleanProperty(default=False, indexed=False)
   content_type = db.TextProperty(default='')
   max_failures = db.IntegerProperty(indexed=False)
+  payload_hash = db.StringProperty(indexed=False)  # EventPayload key_name
+  payload_encoding = db.StringProperty(indexed=False)
 
   @classmethod
   def create_event_for_topic(cls,
@@ -1455,7 +2456,8 @@ class EventToDeliver(db.Expando):
                              entry_payloads,
                              now=datetime.datetime.utcnow,
                              set_parent=True,
-                             max_failures=None):
+                             max_failures=None,
+                             envelope_split=None):
     """Creates an event to deliver for a topic and set of published entries.
 
     Args:
@@ -1476,36 +2478,38 @@ class EventToDeliver(db.Expando):
         FeedRecord transaction.
       max_failures: Maximum number of failures to allow for this event. When
         None (the default) it will use the MAX_DELIVERY_FAILURES constant.
+      envelope_split: Index in 'header_footer' where the entries should be
+        spliced in, as returned by find_envelope_split(). When None (the
+        default) it will be found from the 'header_footer'.
 
     Returns:
       A new EventToDeliver instance that has not been stored.
     """
     if format in (ATOM, RSS):
       # This is feed XML.
-      close_index = header_footer.rfind('</')
-      assert close_index != -1, 'Could not find "</" in feed envelope'
-      end_tag = header_footer[close_index:]
+      if envelope_split is None:
+        envelope_split = find_envelope_split(header_footer)
+      assert envelope_split is not None, (
+          'Could not find closing tags in feed envelope')
+      end_tag = header_footer[envelope_split:]
       if 'rss' in end_tag:
-        # RSS needs special handling, since it actually closes with
-        # a combination of </channel></rss> we need to traverse one
-        # level higher.
-        close_index = header_footer[:close_index].rfind('</')
-        assert close_index != -1, 'Could not find "</channel>" in feed envelope'
-        end_tag = header_footer[close_index:]
         content_type = 'application/rss+xml'
       elif 'feed' in end_tag:
         content_type = 'application/atom+xml'
       elif 'rdf' in end_tag:
         content_type = 'application/rdf+xml'
 
+      # Only the individual pieces are encoded to UTF-8 so the full payload
+      # is built exactly once, by the final join.
       payload_list = ['<?xml version="1.0" encoding="utf-8"?>',
-                      header_footer[:close_index]]
-      payload_list.extend(entry_payloads)
-      payload_list.append(header_footer[close_index:])
+                      utf8encoded(header_footer[:envelope_split])]
+      payload_list.extend(utf8encoded(e) for e in entry_payloads)
+      payload_list.append(utf8encoded(end_tag))
       payload = '\n'.join(payload_list)
+      del payload_list
     elif format == ARBITRARY:
       # This is an arbitrary payload.
-      payload = header_footer
+      payload = utf8encoded(header_footer)
 
     if set_parent:
       parent = db.Key.from_path(
@@ -1513,18 +2517,68 @@ class EventToDeliver(db.Expando):
     else:
       parent = None
 
-    if isinstance(payload, unicode):
-      payload = payload.encode('utf-8')
+    data, encoding = encode_payload(payload)
 
     return cls(
         parent=parent,
         topic=topic,
         topic_hash=sha1_hash(topic),
-        payload=db.Blob(payload),
+        payload=data,
+        payload_encoding=encoding,
         last_modified=now(),
         content_type=content_type,
         max_failures=max_failures)
 
+  def share_payload(self, now=datetime.datetime.utcnow):
+    """Moves a large payload out of this event into a shared EventPayload.
+
+    Must be called before this event is stored. Small payloads and payloads
+    that could not be shared are left inside the event.
+
+    Args:
+      now: Returns the current time as a UTC datetime.
+    """
+    payload = self.get_payload()
+    if payload is None or len(payload) < MIN_SHARED_PAYLOAD_BYTES:
+      return
+    try:
+      self.payload_hash = EventPayload.store(payload, now=now)
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not share payload for topic = %s', self.topic)
+      return
+    del self.payload
+    self.payload_encoding = None
+
+  def get_payload(self):
+    """Returns the payload of this event, wherever and however it is stored.
+
+    The decoded payload is cached on this instance, so the payload is only
+    retrieved and decompressed once no matter how often this is called.
+
+    Returns:
+      The payload bytes, or None if the shared payload no longer exists.
+    """
+    payload = getattr(self, '_decoded_payload', None)
+    if payload is not None:
+      return payload
+
+    try:
+      data = self.payload
+    except AttributeError:
+      data = None
+    if data is not None:
+      payload = decode_payload(data, self.payload_encoding)
+    elif self.payload_hash:
+      shared = EventPayload.get_by_key_name(self.payload_hash)
+      if shared is None:
+        logging.error('Shared payload %s for topic = %s has expired',
+                      self.payload_hash, self.topic)
+      else:
+        payload = decode_payload(shared.payload, shared.encoding)
+
+    self._decoded_payload = payload
+    return payload
+
   def get_next_subscribers(self, chunk_size=None):
     """Retrieve the next set of subscribers to attempt delivery for this event.
 
@@ -1544,7 +2598,7 @@ class EventToDeliver(db.Expando):
       chunk_size = EVENT_SUBSCRIBER_CHUNK_SIZE
 
     if self.delivery_mode == EventToDeliver.NORMAL:
-      all_subscribers = Subscription.get_subscribers(
+      all_subscribers = Subscription.get_cached_subscribers(
           self.topic, chunk_size + 1, starting_at_callback=self.last_callback)
       if all_subscribers:
         self.last_callback = all_subscribers[-1].callback
@@ -1584,6 +2638,9 @@ class EventToDeliver(db.Expando):
       # If the failed callbacks fail again, they will be added back to the
       # end of the list.
       self.failed_callbacks = self.failed_callbacks[len(next_chunk):]
+    else:
+      # All remaining deliveries are handled by DeliveryRetry entities.
+      more_subscribers, subscription_list = False, []
 
     return more_subscribers, subscription_list
 
@@ -1601,11 +2658,69 @@ class EventToDeliver(db.Expando):
       more_callbacks: True if there are more callbacks to deliver, False if
         there are no more subscribers to deliver for this feed.
       more_failed_callbacks: Iterable of Subscription entities for this event
-        that failed to deliver.
+        that failed to deliver. A DeliveryRetry will be scheduled for each.
       max_failures: Maximum failures to allow before giving up.
       retry_period: Initial period for doing exponential (base-2) backoff.
       now: Returns the current time as a UTC datetime.
     """
+    if self.delivery_mode == EventToDeliver.RETRY:
+      self._update_legacy_retry(more_callbacks,
+                                more_failed_callbacks,
+                                now=now,
+                                max_failures=max_failures,
+                                retry_period=retry_period)
+      return
+
+    self.last_modified = now()
+    if self.max_failures is not None:
+      max_failures = self.max_failures
+
+    retry_list = []
+    if max_failures > 0:
+      retry_list = [DeliveryRetry.create(self, sub,
+                                         max_failures=max_failures,
+                                         retry_period=retry_period,
+                                         now=now)
+                    for sub in more_failed_callbacks]
+    elif more_failed_callbacks:
+      self.totally_failed = True
+
+    if more_callbacks:
+      def txn():
+        self.put()
+        if retry_list:
+          db.put(retry_list)
+        self.enqueue()
+      task_batcher.run_in_transaction(txn)
+    elif retry_list or DeliveryRetry.has_pending(self.key()):
+      logging.debug('Normal delivery done; scheduled %d more retries for '
+                    'topic = %s', len(retry_list), self.topic)
+      self.last_callback = ''
+      self.delivery_mode = EventToDeliver.SCHEDULED
+      def txn():
+        self.put()
+        if retry_list:
+          db.put(retry_list)
+      db.run_in_transaction(txn)
+    elif self.totally_failed:
+      logging.debug('EventToDeliver totally failed: topic = %s', self.topic)
+      self.put()
+    else:
+      logging.info('EventToDeliver complete: topic = %s, delivery_mode = %s',
+                   self.topic, self.delivery_mode)
+      self.delete()
+
+  def _update_legacy_retry(self,
+                           more_callbacks,
+                           more_failed_callbacks,
+                           now=datetime.datetime.utcnow,
+                           max_failures=MAX_DELIVERY_FAILURES,
+                           retry_period=DELIVERY_RETRY_PERIOD):
+    """Updates an event still using the failed_callbacks list for retries.
+
+    Args:
+      See the update() method.
+    """
     self.last_modified = now()
 
     # Ensure the list of failed callbacks is in sorted order so we keep track
@@ -1633,46 +2748,174 @@ class EventToDeliver(db.Expando):
         except OverflowError:
           pass
 
-      if self.delivery_mode == EventToDeliver.NORMAL:
-        logging.debug('Normal delivery done; %d broken callbacks remain',
-                      len(self.failed_callbacks))
-        self.delivery_mode = EventToDeliver.RETRY
-      else:
-        logging.debug('End of attempt %d; topic = %s, subscribers = %d, '
-                      'waiting until %s or totally_failed = %s',
-                      self.retry_attempts, self.topic,
-                      len(self.failed_callbacks), self.last_modified,
-                      self.totally_failed)
+      logging.debug('End of attempt %d; topic = %s, subscribers = %d, '
+                    'waiting until %s or totally_failed = %s',
+                    self.retry_attempts, self.topic,
+                    len(self.failed_callbacks), self.last_modified,
+                    self.totally_failed)
 
     def txn():
       self.put()
       if not self.totally_failed:
         self.enqueue()
-    db.run_in_transaction(txn)
+    task_batcher.run_in_transaction(txn)
 
   def enqueue(self):
     """Enqueues a Task that will execute this EventToDeliver."""
-    RETRIES = 3
     if self.delivery_mode == EventToDeliver.RETRY:
       target_queue = EVENT_RETRIES_QUEUE
     elif os.environ.get('HTTP_X_APPENGINE_QUEUENAME') == POLLING_QUEUE:
       target_queue = POLLING_QUEUE
     else:
       target_queue = EVENT_QUEUE
-    for i in xrange(RETRIES):
-      try:
+    task_batcher.add(
         taskqueue.Task(
             url='/work/push_events',
             eta=self.last_modified,
-            params={'event_key': self.key()}
-            ).add(target_queue, transactional=True)
-      except (taskqueue.Error, apiproxy_errors.Error):
-        logging.exception('Could not insert task to deliver '
-                          'events for topic = %s', self.topic)
-        if i == (RETRIES - 1):
-          raise
-      else:
-        return
+            params={'event_key': self.key()}),
+        target_queue)
+
+
+class DeliveryRetry(db.Model):
+  """Represents a pending retry of an event delivery to a single subscriber.
+
+  The parent of this entity is the EventToDeliver that holds the payload and
+  its key name is the key name of the Subscription that failed delivery, so
+  there is at most one pending retry for each (event, subscription) pair. Each
+  retry has its own exponential backoff schedule with jitter and is indexed
+  by the time of its next attempt, letting the retry worker drain all due
+  retries in bulk across events and callback domains.
+  """
+
+  subscription = db.ReferenceProperty(Subscription, required=True,
+                                      collection_name='delivery_retries')
+  callback = db.TextProperty(required=True)
+  attempts = db.IntegerProperty(default=0, indexed=False)
+  max_failures = db.IntegerProperty(indexed=False)
+  next_attempt = db.DateTimeProperty(required=True)
+
+  @property
+  def event_key(self):
+    """Returns the Key of the EventToDeliver this retry is for."""
+    return self.key().parent()
+
+  @property
+  def subscription_key(self):
+    """Returns the Key of the Subscription without retrieving it."""
+    return DeliveryRetry.subscription.get_value_for_datastore(self)
+
+  @classmethod
+  def create(cls,
+             event,
+             sub,
+             max_failures=MAX_DELIVERY_FAILURES,
+             retry_period=DELIVERY_RETRY_PERIOD,
+             now=datetime.datetime.utcnow,
+             getrandom=random.random):
+    """Creates a DeliveryRetry for an event that failed to deliver.
+
+    Does not actually insert the entity into the Datastore. This is left to
+    the caller so it can be part of the event's transaction.
+
+    Args:
+      event: The EventToDeliver that failed to deliver; must have a key.
+      sub: The Subscription the event failed to deliver to.
+      max_failures: Maximum retry failures to allow before giving up.
+      retry_period: Initial period for doing exponential (base-2) backoff.
+      now: Returns the current time as a UTC datetime.
+      getrandom: Used for testing.
+
+    Returns:
+      A new DeliveryRetry instance that has not been stored.
+    """
+    retry = cls(parent=event.key(),
+                key_name=sub.key().name(),
+                subscription=sub.key(),
+                callback=sub.callback,
+                max_failures=max_failures,
+                next_attempt=now())
+    retry._schedule(retry_period, now, getrandom)
+    return retry
+
+  def _schedule(self, retry_period, now, getrandom):
+    """Sets the time of the next attempt based on the attempts so far."""
+    retry_delay = retry_period * (2 ** self.attempts)
+    retry_delay += retry_delay * DELIVERY_RETRY_JITTER * getrandom()
+    try:
+      self.next_attempt = now() + datetime.timedelta(seconds=retry_delay)
+    except OverflowError:
+      self.next_attempt = datetime.datetime.max
+
+  def retry_failed(self,
+                   retry_period=DELIVERY_RETRY_PERIOD,
+                   now=datetime.datetime.utcnow,
+                   getrandom=random.random):
+    """Reports that a retry attempt has failed and schedules the next one.
+
+    This method will *not* write this instance to the Datastore.
+
+    Args:
+      retry_period: Initial period for doing exponential (base-2) backoff.
+      now: Returns the current time as a UTC datetime.
+      getrandom: Used for testing.
+
+    Returns:
+      True if this retry should be attempted again; False if we should give
+      up and never try again.
+    """
+    self.attempts += 1
+    max_failures = self.max_failures
+    if max_failures is None:
+      max_failures = MAX_DELIVERY_FAILURES
+    if self.attempts >= max_failures:
+      logging.debug('Max delivery failures exceeded for callback = %s, '
+                    'giving up.', self.callback)
+      return False
+    self._schedule(retry_period, now, getrandom)
+    return True
+
+  def postpone(self,
+               retry_period=DELIVERY_RETRY_PERIOD,
+               now=datetime.datetime.utcnow,
+               getrandom=random.random):
+    """Moves the next attempt out without counting it as a failure.
+
+    Args:
+      retry_period: Initial period for doing exponential (base-2) backoff.
+      now: Returns the current time as a UTC datetime.
+      getrandom: Used for testing.
+    """
+    self._schedule(retry_period, now, getrandom)
+
+  @classmethod
+  def get_due(cls, count, now=datetime.datetime.utcnow):
+    """Gets the retries whose next attempt is due, oldest first.
+
+    Args:
+      count: Maximum number of retries to retrieve.
+      now: Returns the current time as a UTC datetime.
+
+    Returns:
+      List of DeliveryRetry entities, which may be empty.
+    """
+    return cls.due_query(now()).fetch(count)
+
+  @classmethod
+  def due_query(cls, cutoff):
+    """Returns a query for retries due at or before the cutoff, oldest first.
+
+    Args:
+      cutoff: UTC datetime; holding this fixed across a chain of workers keeps
+        the query cursor valid between them.
+    """
+    return (cls.all()
+            .filter('next_attempt <=', cutoff)
+            .order('next_attempt'))
+
+  @classmethod
+  def has_pending(cls, event_key):
+    """Returns True if an event has any pending DeliveryRetry entities."""
+    return cls.all(keys_only=True).ancestor(event_key).get() is not None
 
 
 class KnownFeed(db.Model):
@@ -1782,10 +3025,29 @@ class KnownFeedStats(db.Model):
     return db.Key.from_path(KnownFeed.kind(), topic_hash,
                             cls.kind(), 'overall')
 
+  @classmethod
+  def create_count_keys(cls, topic_list):
+    """Creates the keys of all entities needed to count subscribers.
+
+    Args:
+      topic_list: List of topics to count subscribers for.
+
+    Returns:
+      List of the KnownFeedStats keys for the topics in the order they were
+      supplied, followed by the KnownFeedStatsShard keys of each topic.
+    """
+    key_list = [cls.create_key(t) for t in topic_list]
+    for topic in topic_list:
+      key_list.extend(KnownFeedStatsShard.create_keys(topic))
+    return key_list
+
   @classmethod
   def get_or_create_all(cls, topic_list):
     """Retrieves and/or creates KnownFeedStats entities for the supplied topics.
 
+    The subscriber_count of each result includes the changes counted in the
+    topic's KnownFeedStatsShard entities, so these entities must not be put.
+
     Args:
       topic_list: List of topics to retrieve.
 
@@ -1793,17 +3055,78 @@ class KnownFeedStats(db.Model):
       The list of KnownFeedStats corresponding to the input topic list in
       the same order they were supplied.
     """
-    key_list = [cls.create_key(t) for t in topic_list]
-    found_list = db.get(key_list)
+    found_list = request_cache.get(cls.create_count_keys(topic_list))
+    shard_list = found_list[len(topic_list):]
     results = []
-    for topic, key, found in zip(topic_list, key_list, found_list):
+    for index, topic in enumerate(topic_list):
+      found = found_list[index]
+      shards = shard_list[index * SUBSCRIBER_COUNT_SHARDS:
+                          (index + 1) * SUBSCRIBER_COUNT_SHARDS]
+      subscriber_count = sum(s.subscriber_delta for s in shards if s)
       if found:
-        results.append(found)
+        # Copy instead of modifying the cached entity.
+        results.append(cls(key=found.key(),
+                           subscriber_count=(found.subscriber_count or 0) +
+                                            subscriber_count,
+                           update_time=found.update_time))
       else:
-        results.append(cls(key=key, subscriber_count=0))
+        results.append(cls(key=cls.create_key(topic),
+                           subscriber_count=subscriber_count))
     return results
 
 
+class KnownFeedStatsShard(db.Model):
+  """One shard of the change in a feed's subscriber count.
+
+  Each shard is a root entity keyed by the topic hash and shard number, so
+  writes to different shards of a topic do not contend. The shards count
+  subscriptions entering or leaving the verified state since the
+  KnownFeedStats for the topic was last recounted, which subtracts what it
+  has already counted from them.
+  """
+
+  subscriber_delta = db.IntegerProperty(default=0, indexed=False)
+
+  @staticmethod
+  def create_keys(topic_url=None, topic_hash=None):
+    """Creates the keys for all shards of a topic.
+
+    Args:
+      topic_url: The topic URL to create the keys for.
+      topic_hash: The hash of the topic URL to create the keys for. May only
+        be supplied if topic_url is None.
+
+    Returns:
+      List of db.Key instances.
+    """
+    if topic_url and topic_hash:
+      raise TypeError('Must specify topic_url or topic_hash.')
+    if topic_url:
+      topic_hash = sha1_hash(topic_url)
+    return [db.Key.from_path(KnownFeedStatsShard.kind(),
+                             '%s-shard-%d' % (topic_hash, i))
+            for i in xrange(SUBSCRIBER_COUNT_SHARDS)]
+
+  @classmethod
+  def add_delta(cls, topic, delta, getrandom=random.random):
+    """Adds a change to a random shard of a topic's subscriber count.
+
+    Must be called in the cross-group transaction that writes the
+    Subscription whose change is being counted.
+
+    Args:
+      topic: The topic URL.
+      delta: The change in the number of verified subscriptions.
+      getrandom: Used for testing.
+    """
+    key = cls.create_keys(topic)[int(getrandom() * SUBSCRIBER_COUNT_SHARDS)]
+    shard = cls.get(key)
+    if shard is None:
+      shard = cls(key=key)
+    shard.subscriber_delta += delta
+    shard.put()
+
+
 class PollingMarker(db.Model):
   """Keeps track of the current position in the bootstrap polling process."""
 
@@ -1987,6 +3310,41 @@ class KnownFeedIdentity(db.Model):
 ################################################################################
 # Subscription handlers and workers
 
+def create_confirm_url(mode, topic, callback, verify_token, challenge,
+                       lease_seconds):
+  """Creates the URL to fetch to confirm a subscription request.
+
+  Args:
+    mode: The mode of subscription confirmation ('subscribe' or 'unsubscribe').
+    topic: URL of the topic being subscribed to.
+    callback: URL of the callback handler to confirm the subscription with.
+    verify_token: Opaque token passed to the callback.
+    challenge: The challenge string the callback must echo.
+    lease_seconds: Number of seconds the subscription will last before
+      expiring; should already be capped to MAX_LEASE_SECONDS.
+
+  Returns:
+    The callback URL with the confirmation parameters added.
+  """
+  parsed_url = list(urlparse.urlparse(utf8encoded(callback)))
+  params = {
+    'hub.mode': mode,
+    'hub.topic': utf8encoded(topic),
+    'hub.challenge': challenge,
+    'hub.lease_seconds': lease_seconds,
+  }
+  if verify_token:
+    params['hub.verify_token'] = utf8encoded(verify_token)
+
+  if parsed_url[4]:
+    # Preserve subscriber-supplied callback parameters.
+    parsed_url[4] = '%s&%s' % (parsed_url[4], urllib.urlencode(params))
+  else:
+    parsed_url[4] = urllib.urlencode(params)
+
+  return urlparse.urlunparse(parsed_url)
+
+
 def confirm_subscription(mode, topic, callback, verify_token,
                          secret, lease_seconds, record_topic=True):
   """Confirms a subscription request and updates a Subscription instance.
@@ -2011,25 +3369,10 @@ def confirm_subscription(mode, topic, callback, verify_token,
                 'verify_token = %r, secret = %r, lease_seconds = %s',
                 mode, topic, callback, verify_token, secret, lease_seconds)
 
-  parsed_url = list(urlparse.urlparse(utf8encoded(callback)))
   challenge = get_random_challenge()
   real_lease_seconds = min(lease_seconds, MAX_LEASE_SECONDS)
-  params = {
-    'hub.mode': mode,
-    'hub.topic': utf8encoded(topic),
-    'hub.challenge': challenge,
-    'hub.lease_seconds': real_lease_seconds,
-  }
-  if verify_token:
-    params['hub.verify_token'] = utf8encoded(verify_token)
-
-  if parsed_url[4]:
-    # Preserve subscriber-supplied callback parameters.
-    parsed_url[4] = '%s&%s' % (parsed_url[4], urllib.urlencode(params))
-  else:
-    parsed_url[4] = urllib.urlencode(params)
-
-  adjusted_url = urlparse.urlunparse(parsed_url)
+  adjusted_url = create_confirm_url(
+      mode, topic, callback, verify_token, challenge, real_lease_seconds)
 
   try:
     response = urlfetch.fetch(adjusted_url, method='get',
@@ -2042,28 +3385,118 @@ def confirm_subscription(mode, topic, callback, verify_token,
                   topic, callback, error_traceback)
     return False
 
-  if 200 <= response.status_code < 300 and response.content == challenge:
-    if mode == 'subscribe':
-      Subscription.insert(callback, topic, verify_token, secret,
-                          lease_seconds=real_lease_seconds)
-      if record_topic:
-        # Enqueue a task to record the feed and do discovery for it's ID.
-        KnownFeed.record(topic)
-    else:
-      Subscription.remove(callback, topic)
-    logging.info('Subscription action verified, '
-                 'callback = %s, topic = %s: %s', callback, topic, mode)
-    return True
-  elif mode == 'subscribe' and response.status_code == 404:
-    Subscription.archive(callback, topic)
-    logging.info('Subscribe request returned 404 for callback = %s, '
-                 'topic = %s; subscription archived', callback, topic)
-    return True
+  if 200 <= response.status_code < 300 and response.content == challenge:
+    if mode == 'subscribe':
+      Subscription.insert(callback, topic, verify_token, secret,
+                          lease_seconds=real_lease_seconds)
+      if record_topic:
+        # Enqueue a task to record the feed and do discovery for it's ID.
+        KnownFeed.record(topic)
+    else:
+      Subscription.remove(callback, topic)
+    logging.info('Subscription action verified, '
+                 'callback = %s, topic = %s: %s', callback, topic, mode)
+    return True
+  elif mode == 'subscribe' and response.status_code == 404:
+    Subscription.archive(callback, topic)
+    logging.info('Subscribe request returned 404 for callback = %s, '
+                 'topic = %s; subscription archived', callback, topic)
+    return True
+  else:
+    logging.debug('Could not confirm subscription; encountered '
+                  'status %d with content: %s', response.status_code,
+                  response.content)
+    return False
+
+
+def confirm_subscription_async(confirm_url, async_proxy, callback):
+  """Fetches a subscription confirmation URL asynchronously.
+
+  The callback's prototype is:
+    Args:
+      status_code: The response status code.
+      content: The body of the response.
+      exception: apiproxy_errors.Error if any RPC errors are encountered.
+        urlfetch.Error if there are any fetching API errors. None if there
+        were no errors.
+
+  Args:
+    confirm_url: The URL to fetch, from create_confirm_url().
+    async_proxy: AsyncAPIProxy to use for fetching and waiting.
+    callback: Callback function to call after a response has been received.
+  """
+  def wrapper(response, exception):
+    callback(getattr(response, 'status_code', None),
+             getattr(response, 'content', None),
+             exception)
+  urlfetch_async.fetch(confirm_url,
+                       follow_redirects=False,
+                       async_proxy=async_proxy,
+                       callback=wrapper,
+                       deadline=MAX_FETCH_SECONDS)
+
+
+def parse_subscribe_params(get_all):
+  """Parses and validates the parameters of a subscription request.
+
+  Args:
+    get_all: Callable that takes a parameter name and returns the list of
+      unicode values supplied for it.
+
+  Returns:
+    Tuple (mode, callback, topic, verify_type, verify_token, secret,
+    lease_seconds, error_message) where the URLs are normalized and
+    error_message is None if the parameters are valid. When error_message is
+    set, the other values are only suitable for logging.
+  """
+  def get(name, default=''):
+    return (get_all(name) or [default])[0]
+
+  callback = get('hub.callback')
+  topic = get('hub.topic')
+  verify_type_list = [s.lower() for s in get_all('hub.verify')]
+  verify_token = unicode(get('hub.verify_token'))
+  secret = unicode(get('hub.secret')) or None
+  lease_seconds = get('hub.lease_seconds') or str(DEFAULT_LEASE_SECONDS)
+  mode = get('hub.mode').lower()
+  verify_type = None
+
+  error_message = None
+  if not callback or not is_valid_url(callback):
+    error_message = ('Invalid parameter: hub.callback; '
+                     'must be valid URI with no fragment and '
+                     'optional port %s' % ','.join(VALID_PORTS))
+  else:
+    callback = normalize_iri(callback)
+
+  if not topic or not is_valid_url(topic):
+    error_message = ('Invalid parameter: hub.topic; '
+                     'must be valid URI with no fragment and '
+                     'optional port %s' % ','.join(VALID_PORTS))
   else:
-    logging.debug('Could not confirm subscription; encountered '
-                  'status %d with content: %s', response.status_code,
-                  response.content)
-    return False
+    topic = normalize_iri(topic)
+
+  enabled_types = [vt for vt in verify_type_list if vt in ('async', 'sync')]
+  if not enabled_types:
+    error_message = 'Invalid values for hub.verify: %s' % (verify_type_list,)
+  else:
+    verify_type = enabled_types[0]
+
+  if mode not in ('subscribe', 'unsubscribe'):
+    error_message = 'Invalid value for hub.mode: %s' % mode
+
+  if lease_seconds:
+    try:
+      old_lease_seconds = lease_seconds
+      lease_seconds = int(old_lease_seconds)
+      if not old_lease_seconds == str(lease_seconds):
+        raise ValueError
+    except ValueError:
+      error_message = ('Invalid value for hub.lease_seconds: %s' %
+                       old_lease_seconds)
+
+  return (mode, callback, topic, verify_type, verify_token, secret,
+          lease_seconds, error_message)
 
 
 class SubscribeHandler(webapp2.RequestHandler):
@@ -2072,52 +3505,15 @@ class SubscribeHandler(webapp2.RequestHandler):
   def get(self):
     self.response.out.write(str(template.render('subscribe_debug.html', {})))
 
-  @dos.limit(param='hub.callback', count=10, period=1)
+  @dos.limit(param='hub.callback',
+             count=SUBSCRIBE_CALLBACK_LIMIT,
+             period=SUBSCRIBE_CALLBACK_LIMIT_PERIOD)
   def post(self):
     self.response.headers['Content-Type'] = 'text/plain'
 
-    callback = self.request.get('hub.callback', '')
-    topic = self.request.get('hub.topic', '')
-    verify_type_list = [s.lower() for s in self.request.get_all('hub.verify')]
-    verify_token = unicode(self.request.get('hub.verify_token', ''))
-    secret = unicode(self.request.get('hub.secret', '')) or None
-    lease_seconds = (
-       self.request.get('hub.lease_seconds', '') or str(DEFAULT_LEASE_SECONDS))
-    mode = self.request.get('hub.mode', '').lower()
-
-    error_message = None
-    if not callback or not is_valid_url(callback):
-      error_message = ('Invalid parameter: hub.callback; '
-                       'must be valid URI with no fragment and '
-                       'optional port %s' % ','.join(VALID_PORTS))
-    else:
-      callback = normalize_iri(callback)
-
-    if not topic or not is_valid_url(topic):
-      error_message = ('Invalid parameter: hub.topic; '
-                       'must be valid URI with no fragment and '
-                       'optional port %s' % ','.join(VALID_PORTS))
-    else:
-      topic = normalize_iri(topic)
-
-    enabled_types = [vt for vt in verify_type_list if vt in ('async', 'sync')]
-    if not enabled_types:
-      error_message = 'Invalid values for hub.verify: %s' % (verify_type_list,)
-    else:
-      verify_type = enabled_types[0]
-
-    if mode not in ('subscribe', 'unsubscribe'):
-      error_message = 'Invalid value for hub.mode: %s' % mode
-
-    if lease_seconds:
-      try:
-        old_lease_seconds = lease_seconds
-        lease_seconds = int(old_lease_seconds)
-        if not old_lease_seconds == str(lease_seconds):
-          raise ValueError
-      except ValueError:
-        error_message = ('Invalid value for hub.lease_seconds: %s' %
-                         old_lease_seconds)
+    (mode, callback, topic, verify_type, verify_token, secret,
+     lease_seconds, error_message) = parse_subscribe_params(
+        self.request.get_all)
 
     if error_message:
       logging.debug('Bad request for mode = %s, topic = %s, '
@@ -2129,8 +3525,8 @@ class SubscribeHandler(webapp2.RequestHandler):
 
     try:
       # Retrieve any existing subscription for this callback.
-      sub = Subscription.get_by_key_name(
-          Subscription.create_key_name(callback, topic))
+      sub = request_cache.get(db.Key.from_path(
+          Subscription.kind(), Subscription.create_key_name(callback, topic)))
 
       # Deletions for non-existant subscriptions will be ignored.
       if mode == 'unsubscribe' and not sub:
@@ -2156,20 +3552,263 @@ class SubscribeHandler(webapp2.RequestHandler):
                       mode, callback, topic, verify_token, lease_seconds)
         return self.response.set_status(202)
 
-    except (apiproxy_errors.Error, db.Error,
-            runtime.DeadlineExceededError, taskqueue.Error), e:
+    except (apiproxy_errors.Error, db.Error, runtime.DeadlineExceededError,
+            taskqueue.Error, fork_join_queue.Error), e:
       logging.debug('Could not verify subscription request. %s: %s',
                     e.__class__.__name__, e)
       self.response.headers['Retry-After'] = '120'
       return self.response.set_status(503)
 
 
+class BulkSubscribeHandler(webapp2.RequestHandler):
+  """End-user accessible handler for many Subscribe and Unsubscribe events.
+
+  Each 'hub.subscription' parameter is one URL-encoded request with the same
+  parameters as the SubscribeHandler takes. Every request is confirmed with
+  its own callback by asynchronous verification of intent, so synchronous
+  verification is not supported. The response has one line per request, in
+  order, with a status code and message as the single request would get.
+  Each request counts against the same per-callback rate limit as a request
+  to the SubscribeHandler.
+  """
+
+  @dos.limit(count=10, period=1)
+  def post(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+
+    item_list = self.request.get_all('hub.subscription')
+    if not item_list:
+      self.response.out.write(
+          'MUST supply at least one hub.subscription parameter')
+      return self.response.set_status(400)
+    if len(item_list) > MAX_BULK_SUBSCRIBE_REQUESTS:
+      self.response.out.write('MUST supply at most %d hub.subscription '
+                              'parameters' % MAX_BULK_SUBSCRIBE_REQUESTS)
+      return self.response.set_status(400)
+
+    status_list = [None] * len(item_list)
+    request_list = []
+    request_index_list = []
+    callback_param_list = []
+    seen_key_names = set()
+    for index, item in enumerate(item_list):
+      try:
+        params = dict(
+            (name, [v.decode('utf-8') for v in values])
+            for name, values in urlparse.parse_qs(
+                utf8encoded(item), keep_blank_values=True).iteritems())
+      except UnicodeDecodeError:
+        status_list[index] = (400, 'Invalid parameter encoding; must be UTF-8')
+        continue
+
+      params.setdefault('hub.verify', [u'async'])
+      (mode, callback, topic, verify_type, verify_token, secret,
+       lease_seconds, error_message) = parse_subscribe_params(
+          lambda name: params.get(name, []))
+      if not error_message:
+        if 'async' not in [vt.lower() for vt in params['hub.verify']]:
+          error_message = 'Bulk requests only support hub.verify=async'
+        else:
+          key_name = Subscription.create_key_name(callback, topic)
+          if key_name in seen_key_names:
+            error_message = 'Duplicate request for hub.callback and hub.topic'
+          seen_key_names.add(key_name)
+
+      if error_message:
+        status_list[index] = (400, error_message)
+      else:
+        request_list.append(
+            (mode, callback, topic, verify_token, secret, lease_seconds))
+        request_index_list.append(index)
+        callback_param_list.append(params['hub.callback'][0])
+
+    count_list = dos.count_param_values(
+        'POST', '/subscribe', 'hub.callback', callback_param_list,
+        SUBSCRIBE_CALLBACK_LIMIT_PERIOD)
+    allowed = []
+    for request, index, count in zip(
+        request_list, request_index_list, count_list):
+      if count is not None and count > SUBSCRIBE_CALLBACK_LIMIT:
+        status_list[index] = (503, 'Too many requests for hub.callback; '
+                                   'try again later')
+      else:
+        allowed.append((request, index))
+    request_list = [request for request, index in allowed]
+    request_index_list = [index for request, index in allowed]
+
+    result_list = Subscription.request_bulk(request_list)
+    for index, result in zip(request_index_list, result_list):
+      if result is None:
+        status_list[index] = (503, 'Could not record request; try again later')
+      elif result:
+        status_list[index] = (202, 'Queued for verification')
+      else:
+        status_list[index] = (204, 'No such subscription')
+
+    logging.debug('Bulk subscription request with %d items, %d queued',
+                  len(item_list), result_list.count(True))
+    for status in status_list:
+      self.response.out.write('%d %s\n' % status)
+
+
 class SubscriptionConfirmHandler(webapp2.RequestHandler):
   """Background worker for asynchronously confirming subscriptions."""
 
+  def _handle_confirmations(self, work_list):
+    """Verifies a batch of SubscriptionToConfirm records in parallel."""
+    if not work_list:
+      return
+
+    sub_list = db.get([work.subscription_key for work in work_list])
+    pending = {}
+    verified = []
+    archived = []
+    failed = []
+
+    def create_callback(work, sub, challenge):
+      return lambda *args: callback(work, sub, challenge, *args)
+
+    def callback(work, sub, challenge, status_code, content, exception):
+      del pending[work.key()]
+      if exception:
+        logging.debug('Error encountered while confirming subscription '
+                      'to %s for callback %s. %s: %s', sub.topic,
+                      sub.callback, exception.__class__.__name__, exception)
+        failed.append((work, sub))
+      elif 200 <= status_code < 300 and content == challenge:
+        verified.append((work, sub))
+      elif (work.next_state == Subscription.STATE_VERIFIED and
+            status_code == 404):
+        logging.info('Subscribe request returned 404 for callback = %s, '
+                     'topic = %s; subscription archived',
+                     sub.callback, sub.topic)
+        archived.append((work, sub))
+      else:
+        logging.debug('Could not confirm subscription; encountered '
+                      'status %d with content: %s', status_code, content)
+        failed.append((work, sub))
+
+    for work, sub in zip(work_list, sub_list):
+      if sub is None:
+        logging.debug('No subscriptions to confirm '
+                      'for subscription key = %s', work.subscription_key)
+        continue
+      if work.next_state == Subscription.STATE_TO_DELETE:
+        mode = 'unsubscribe'
+      else:
+        mode = 'subscribe'
+      challenge = get_random_challenge()
+      pending[work.key()] = (work, sub)
+      hooks.execute(confirm_subscription_async,
+          create_confirm_url(mode, sub.topic, sub.callback, work.verify_token,
+                             challenge,
+                             min(sub.lease_seconds, MAX_LEASE_SECONDS)),
+          async_proxy,
+          create_callback(work, sub, challenge))
+
+    try:
+      async_proxy.wait()
+    except runtime.DeadlineExceededError:
+      logging.error('Could not finish all confirmations due to deadline.')
+    # Confirmations cut off by the deadline will be retried like failures.
+    failed.extend(pending.values())
+
+    # Retries are scheduled per Subscription with their own backoff.
+    retry_list = Subscription.confirm_failed_all(
+        [(sub, work.next_state, work.verify_token, work.auto_reconfirm,
+          work.secret) for work, sub in failed])
+    for (work, sub), should_retry in zip(failed, retry_list):
+      if (not should_retry and
+          work.auto_reconfirm and
+          work.next_state == Subscription.STATE_VERIFIED):
+        logging.info('Auto-renewal subscribe request failed the maximum '
+                     'number of times for callback = %s, topic = %s; '
+                     'subscription archived', sub.callback, sub.topic)
+        Subscription.archive(sub.callback, sub.topic)
+
+    # Each successful state transition is committed on its own, and only if
+    # nothing else changed the Subscription while it was being confirmed.
+    applied = set()
+    changed_topics = set()
+    for (work, sub), archive in ([(result, False) for result in verified] +
+                                 [(result, True) for result in archived]):
+      if self._commit_confirmation(work, sub, archive=archive):
+        applied.add(work.key())
+        changed_topics.add(sub.topic)
+      else:
+        logging.info('Subscription for callback = %s, topic = %s changed '
+                     'while being confirmed; dropping the result',
+                     sub.callback, sub.topic)
+
+    db.delete([work.key() for work in work_list
+               if work.key() not in applied])
+    for topic in changed_topics:
+      Subscription.invalidate_cache(topic)
+    logging.info('Confirmed %d, archived %d, failed %d of %d subscription '
+                 'requests', len(verified), len(archived), len(failed),
+                 len(work_list))
+
+  def _commit_confirmation(self, work, sub, archive=False):
+    """Commits the result of a single confirmation.
+
+    The Subscription and its SubscriptionToConfirm are read again in a
+    cross-group transaction with the topic's subscriber count, and the result
+    is only written if the Subscription still has the state and verify_token
+    it had when it was confirmed.
+
+    Args:
+      work: The SubscriptionToConfirm that was confirmed.
+      sub: The Subscription as it was read before confirming.
+      archive: True if the callback returned a 404 for a subscribe request,
+        in which case the Subscription is archived instead of verified.
+
+    Returns:
+      True if the result was committed, False if it was stale.
+    """
+    now = datetime.datetime.now()
+    def txn():
+      current_work, current = db.get([work.key(), sub.key()])
+      if (current_work is None or current is None or
+          current_work.verify_token != work.verify_token or
+          current.subscription_state != sub.subscription_state or
+          current.verify_token != sub.verify_token):
+        return False
+
+      was_verified = current.subscription_state == Subscription.STATE_VERIFIED
+      if archive:
+        current.subscription_state = Subscription.STATE_TO_DELETE
+        current.confirm_failures = 0
+        current.put()
+        delta = -int(was_verified)
+      elif work.next_state == Subscription.STATE_TO_DELETE:
+        current.delete()
+        delta = -int(was_verified)
+      else:
+        current.subscription_state = Subscription.STATE_VERIFIED
+        current.expiration_time = now + datetime.timedelta(
+            seconds=min(current.lease_seconds, MAX_LEASE_SECONDS))
+        current.confirm_failures = 0
+        current.verify_token = work.verify_token
+        current.secret = work.secret
+        current.put()
+        delta = int(not was_verified)
+      current_work.delete()
+      if delta:
+        KnownFeedStatsShard.add_delta(current.topic, delta)
+      return True
+
+    return db.run_in_transaction_options(
+        db.create_transaction_options(xg=True), txn)
+
   @work_queue_only
   def post(self):
     sub_key_name = self.request.get('subscription_key_name')
+    if not sub_key_name:
+      self._handle_confirmations(SubscriptionToConfirm.get_task_queue(
+          os.environ['HTTP_X_APPENGINE_TASKNAME']).pop_request(self.request))
+      return
+
+    # Retry tasks from confirm_failed() confirm a single Subscription.
     next_state = self.request.get('next_state')
     verify_token = self.request.get('verify_token')
     secret = self.request.get('secret') or None
@@ -2207,22 +3846,32 @@ class SubscriptionConfirmHandler(webapp2.RequestHandler):
 
 
 class SubscriptionReconfirmHandler(webapp2.RequestHandler):
-  """Periodic handler causes reconfirmation for almost expired subscriptions."""
+  """Periodic handler causes reconfirmation for almost expired subscriptions.
+
+  Only Subscriptions whose expiration_time falls in the reconfirmation window
+  are read, so the cost of a run is proportional to the number of expiring
+  subscriptions instead of the total number of subscriptions.
+  """
 
-  def __init__(self, request, response, now=time.time, start_map=mapreduce.control.start_map):
+  def __init__(self, request, response, now=time.time):
     """Initializer."""
     webapp2.RequestHandler.__init__(self, request, response)
     self.now = now
-    self.start_map = start_map
 
   @work_queue_only
   def get(self):
     # Use the name, such that only one of these tasks runs per calendar day.
-    name = 'reconfirm-%s' % time.strftime('%Y-%m-%d' , time.gmtime(self.now()))
+    now = self.now()
+    name = 'reconfirm-%s' % time.strftime('%Y-%m-%d' , time.gmtime(now))
+    start_timestamp = int(now - SUBSCRIPTION_RECONFIRM_LOOKBACK_SECONDS)
+    threshold_timestamp = int(now + SUBSCRIPTION_CHECK_BUFFER_SECONDS)
     try:
       taskqueue.Task(
           url='/work/reconfirm_subscriptions',
-          name=name
+          name=name,
+          params=dict(sequence=name,
+                      start_timestamp=start_timestamp,
+                      threshold_timestamp=threshold_timestamp)
       ).add(POLLING_QUEUE)
     except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
       logging.exception('Could not enqueue FIRST reconfirmation task; '
@@ -2230,37 +3879,229 @@ class SubscriptionReconfirmHandler(webapp2.RequestHandler):
 
   @work_queue_only
   def post(self):
-    self.start_map(
-        name='Reconfirm expiring subscriptions',
-        handler_spec='offline_jobs.SubscriptionReconfirmMapper.run',
-        reader_spec='mapreduce.input_readers.DatastoreInputReader',
-        mapper_parameters=dict(
-            processing_rate=100000,
-            entity_kind='main.Subscription',
-            threshold_timestamp=int(
-                self.now() + SUBSCRIPTION_CHECK_BUFFER_SECONDS)),
-        shard_count=SUBSCRIPTION_RECONFIRM_SHARD_COUNT,
-        queue_name=POLLING_QUEUE,
-        mapreduce_parameters=dict(
-          done_callback='/work/cleanup_mapper',
-          done_callback_queue=POLLING_QUEUE))
-
-
-# TODO(bslatkin): Move this to an offline job.
+    sequence = self.request.get('sequence')
+    start_timestamp = self.request.get('start_timestamp')
+    threshold_timestamp = self.request.get('threshold_timestamp')
+    cursor = self.request.get('cursor')
+
+    query = (Subscription.all()
+        .filter('expiration_time >=',
+                datetime.datetime.utcfromtimestamp(int(start_timestamp)))
+        .filter('expiration_time <',
+                datetime.datetime.utcfromtimestamp(int(threshold_timestamp))))
+    if cursor:
+      query.with_cursor(cursor)
+    sub_list = query.fetch(SUBSCRIPTION_RECONFIRM_CHUNK_SIZE)
+
+    reconfirm_list = [sub for sub in sub_list
+                      if sub.subscription_state == Subscription.STATE_VERIFIED]
+    if reconfirm_list:
+      Subscription.request_reconfirm(reconfirm_list)
+    logging.info('Requested reconfirmation for %d of %d expiring '
+                 'subscriptions', len(reconfirm_list), len(sub_list))
+
+    # Only continue once this chunk has been requested, so a retry of this
+    # task after a failure still covers the chunk.
+    if len(sub_list) == SUBSCRIPTION_RECONFIRM_CHUNK_SIZE:
+      cursor = query.cursor()
+      name = '%s-%s' % (sequence, sha1_hash(cursor))
+      try:
+        taskqueue.Task(
+            url='/work/reconfirm_subscriptions',
+            name=name,
+            params=dict(sequence=sequence,
+                        start_timestamp=start_timestamp,
+                        threshold_timestamp=threshold_timestamp,
+                        cursor=cursor)).add(POLLING_QUEUE)
+      except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.debug('Continued reconfirmation task %s already present', name)
+
+
 class SubscriptionCleanupHandler(webapp2.RequestHandler):
-  """Background worker for cleaning up deleted Subscription instances."""
+  """Background worker for cleaning up deleted Subscription instances.
+
+  The periodic GET starts a chain of tasks unless one is already running.
+  Each task deletes a chunk of archived Subscriptions and then continues with
+  the query cursor until none are left. Continuations are delayed so the
+  deletes stay within SUBSCRIPTION_CLEANUP_MAX_DELETES_PER_SECOND.
+  """
+
+  def __init__(self, request, response, now=time.time):
+    """Initializer."""
+    webapp2.RequestHandler.__init__(self, request, response)
+    self.now = now
+
+  @work_queue_only
+  def get(self):
+    if not memcache.add(SUBSCRIPTION_CLEANUP_LOCK_KEY, True,
+                        time=SUBSCRIPTION_CLEANUP_LOCK_SECONDS):
+      logging.debug('Subscription cleanup is already running')
+      return
+    name = 'subscription-cleanup-%d' % self.now()
+    try:
+      taskqueue.Task(
+          url='/work/subscription_cleanup',
+          name=name,
+          params=dict(sequence=name)).add(POLLING_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.exception('Could not enqueue FIRST subscription cleanup task')
+
+  @work_queue_only
+  def post(self):
+    sequence = self.request.get('sequence')
+    cursor = self.request.get('cursor')
+
+    query = (Subscription.all(keys_only=True)
+        .filter('subscription_state =', Subscription.STATE_TO_DELETE))
+    if cursor:
+      query.with_cursor(cursor)
+    key_list = query.fetch(SUBSCRIPTION_CLEANUP_CHUNK_SIZE)
+
+    if len(key_list) == SUBSCRIPTION_CLEANUP_CHUNK_SIZE:
+      cursor = query.cursor()
+      countdown = (float(len(key_list)) /
+                   SUBSCRIPTION_CLEANUP_MAX_DELETES_PER_SECOND)
+      memcache.set(SUBSCRIPTION_CLEANUP_LOCK_KEY, True,
+                   time=int(countdown) + SUBSCRIPTION_CLEANUP_LOCK_SECONDS)
+      try:
+        taskqueue.Task(
+            url='/work/subscription_cleanup',
+            name='%s-%s' % (sequence, sha1_hash(cursor)),
+            countdown=countdown,
+            params=dict(sequence=sequence, cursor=cursor)).add(POLLING_QUEUE)
+      except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # Deletes are idempotent, so a retried task still finishes its chunk.
+        logging.debug('Continued subscription cleanup task already present')
+    else:
+      memcache.delete(SUBSCRIPTION_CLEANUP_LOCK_KEY)
+
+    if not key_list:
+      return
+    deleted = delete_in_batches(
+        key_list, SUBSCRIPTION_CLEANUP_DELETE_BATCH_SIZE)
+    logging.info('Cleaned up %d of %d subscriptions', deleted, len(key_list))
+
+
+def delete_in_batches(key_list, batch_size):
+  """Deletes entities with parallel Datastore RPCs of batch_size keys each.
+
+  Args:
+    key_list: List of db.Key instances to delete.
+    batch_size: Maximum number of keys to delete per RPC.
+
+  Returns:
+    How many of the entities were deleted; failed batches are logged.
+  """
+  rpc_list = []
+  for i in xrange(0, len(key_list), batch_size):
+    batch = key_list[i:i+batch_size]
+    rpc_list.append((len(batch), db.delete_async(batch)))
+  deleted = 0
+  for count, rpc in rpc_list:
+    try:
+      rpc.get_result()
+      deleted += count
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not clean-up %s instances', key_list[0].kind())
+  return deleted
+
+
+class EventPayloadCleanupHandler(webapp2.RequestHandler):
+  """Background worker for cleaning up expired EventPayload instances."""
+
+  def __init__(self, request, response, now=datetime.datetime.utcnow):
+    """Initializer.
+
+    Args:
+      now: Callable that returns the current time as a UTC datetime.
+    """
+    webapp2.RequestHandler.__init__(self, request, response)
+    self.now = now
 
   @work_queue_only
   def get(self):
-    subscriptions = (Subscription.all()
-              .filter('subscription_state =', Subscription.STATE_TO_DELETE)
-              .fetch(SUBSCRIPTION_CLEANUP_CHUNK_SIZE))
-    if subscriptions:
-      logging.info('Cleaning up %d subscriptions', len(subscriptions))
+    payload_keys = (EventPayload.all(keys_only=True)
+              .filter('expiration_time <', self.now())
+              .fetch(EVENT_PAYLOAD_CLEANUP_CHUNK_SIZE))
+    if payload_keys:
+      logging.info('Cleaning up %d event payloads', len(payload_keys))
       try:
-        db.delete(subscriptions)
+        db.delete(payload_keys)
       except (db.Error, apiproxy_errors.Error, runtime.DeadlineExceededError):
-        logging.exception('Could not clean-up Subscription instances')
+        logging.exception('Could not clean-up EventPayload instances')
+
+
+class ForkJoinJournalCleanupHandler(webapp2.RequestHandler):
+  """Background worker for cleaning up expired fork-join journal entries.
+
+  Works like SubscriptionCleanupHandler: the periodic GET starts a chain of
+  tasks unless one is already running, and each task deletes a chunk of the
+  entries created before the chain's cutoff time, then continues with the
+  query cursor until none are left.
+  """
+
+  def __init__(self, request, response, now=time.time):
+    """Initializer.
+
+    Args:
+      now: Callable that returns the current time as a UNIX timestamp.
+    """
+    webapp2.RequestHandler.__init__(self, request, response)
+    self.now = now
+
+  @work_queue_only
+  def get(self):
+    if not memcache.add(FORK_JOIN_JOURNAL_CLEANUP_LOCK_KEY, True,
+                        time=FORK_JOIN_JOURNAL_CLEANUP_LOCK_SECONDS):
+      logging.debug('Fork-join journal cleanup is already running')
+      return
+    cutoff = int(self.now() - FORK_JOIN_JOURNAL_TTL_SECONDS)
+    name = 'journal-cleanup-%d' % cutoff
+    try:
+      taskqueue.Task(
+          url='/work/journal_cleanup',
+          name=name,
+          params=dict(sequence=name, cutoff=cutoff)).add(POLLING_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.exception('Could not enqueue FIRST journal cleanup task')
+
+  @work_queue_only
+  def post(self):
+    sequence = self.request.get('sequence')
+    cutoff = int(self.request.get('cutoff'))
+    cursor = self.request.get('cursor')
+
+    query = (fork_join_queue.ForkJoinJournal.all(keys_only=True)
+        .filter('created <', datetime.datetime.utcfromtimestamp(cutoff)))
+    if cursor:
+      query.with_cursor(cursor)
+    key_list = query.fetch(FORK_JOIN_JOURNAL_CLEANUP_CHUNK_SIZE)
+
+    if len(key_list) == FORK_JOIN_JOURNAL_CLEANUP_CHUNK_SIZE:
+      cursor = query.cursor()
+      countdown = (float(len(key_list)) /
+                   FORK_JOIN_JOURNAL_CLEANUP_MAX_DELETES_PER_SECOND)
+      memcache.set(FORK_JOIN_JOURNAL_CLEANUP_LOCK_KEY, True,
+                   time=int(countdown) + FORK_JOIN_JOURNAL_CLEANUP_LOCK_SECONDS)
+      try:
+        taskqueue.Task(
+            url='/work/journal_cleanup',
+            name='%s-%s' % (sequence, sha1_hash(cursor)),
+            countdown=countdown,
+            params=dict(sequence=sequence, cutoff=cutoff, cursor=cursor)
+            ).add(POLLING_QUEUE)
+      except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # Deletes are idempotent, so a retried task still finishes its chunk.
+        logging.debug('Continued journal cleanup task already present')
+    else:
+      memcache.delete(FORK_JOIN_JOURNAL_CLEANUP_LOCK_KEY)
+
+    if not key_list:
+      return
+    deleted = delete_in_batches(
+        key_list, FORK_JOIN_JOURNAL_CLEANUP_DELETE_BATCH_SIZE)
+    logging.info('Cleaned up %d of %d fork-join journal entries',
+                 deleted, len(key_list))
 
 
 class CleanupMapperHandler(webapp2.RequestHandler):
@@ -2613,9 +4454,15 @@ def parse_feed(feed_record,
         'format=%r, content_type=%r, header_footer_bytes=%d',
         len(entities_to_save), format, feed_record.content_type,
         len(header_footer))
+    if parse_successful and format != ARBITRARY:
+      # The FeedRecord has already found the split for this header_footer.
+      envelope_split = feed_record.envelope_split
+    else:
+      envelope_split = None
     event_to_deliver = EventToDeliver.create_event_for_topic(
         feed_record.topic, format, feed_record.content_type,
-        header_footer, entry_payloads)
+        header_footer, entry_payloads, envelope_split=envelope_split)
+    event_to_deliver.share_payload()
     entities_to_save.insert(0, event_to_deliver)
 
   entities_to_save.insert(0, feed_record)
@@ -2653,7 +4500,7 @@ def parse_feed(feed_record,
   try:
     for i in xrange(PUT_SPLITTING_ATTEMPTS):
       try:
-        db.run_in_transaction(txn)
+        task_batcher.run_in_transaction(txn)
         break
       except (db.BadRequestError, apiproxy_errors.RequestTooLargeError):
         pass
@@ -2679,26 +4526,42 @@ def parse_feed(feed_record,
 class PullFeedHandler(webapp2.RequestHandler):
   """Background worker for pulling feeds."""
 
-  def _handle_fetches(self, feed_list):
-    """Handles a set of FeedToFetch records that need to be fetched."""
+  def _handle_fetches(self, feed_list, memory_only=False):
+    """Handles a set of FeedToFetch records that need to be fetched.
+
+    Args:
+      feed_list: List of FeedToFetch records to fetch.
+      memory_only: True if the records came from the in-memory work queue.
+    """
+    # Start reading the records and stats for all topics in one batch while
+    # the topics without subscribers are filtered out.
+    topic_list = [f.topic for f in feed_list]
+    records_rpc = request_cache.get_async(
+        [FeedRecord.create_key(t) for t in topic_list] +
+        KnownFeedStats.create_count_keys(topic_list))
+
+    done_list = []
+    failed_list = []
     ready_feed_list = []
-    scorer_results = FETCH_SCORER.filter([f.topic for f in feed_list])
+    scorer_results = FETCH_SCORER.filter(topic_list)
     for to_fetch, (allow, percent) in zip(feed_list, scorer_results):
       if not allow:
         logging.warning('Scoring prevented fetch of %r '
                         'with failure rate %.2f%%',
                         to_fetch.topic, 100 * percent)
-        to_fetch.done()
+        done_list.append(to_fetch)
       elif not Subscription.has_subscribers(to_fetch.topic):
         logging.debug('Ignoring event because there are no subscribers '
                       'for topic %s', to_fetch.topic)
-        to_fetch.done()
+        done_list.append(to_fetch)
       else:
         ready_feed_list.append(to_fetch)
 
     if not ready_feed_list:
+      FeedToFetch.finish_all(done_list, failed_list, memory_only=memory_only)
       return
 
+    records_rpc.get_result()
     topic_list = [f.topic for f in ready_feed_list]
     feed_record_list = FeedRecord.get_or_create_all(topic_list)
     feed_stats_list = KnownFeedStats.get_or_create_all(topic_list)
@@ -2719,19 +4582,19 @@ class PullFeedHandler(webapp2.RequestHandler):
         if isinstance(exception, urlfetch.ResponseTooLargeError):
           logging.warning('Feed response too large for topic %r at url %r; '
                           'skipping', work.topic, fetch_url)
-          work.done()
+          done_list.append(work)
         elif isinstance(exception, urlfetch.InvalidURLError):
           logging.warning('Invalid redirection for topic %r to url %r; '
                           'skipping', work.topic, fetch_url)
-          work.done()
+          done_list.append(work)
         elif isinstance(exception, (apiproxy_errors.Error, urlfetch.Error)):
           logging.warning('Failed to fetch topic %r at url %r. %s: %s',
                           work.topic, fetch_url, exception.__class__, exception)
-          work.fetch_failed()
+          failed_list.append(work)
         else:
           logging.critical('Unexpected exception fetching topic %r. %s: %s',
                            work.topic, exception.__class__, exception)
-          work.fetch_failed()
+          failed_list.append(work)
       else:
         if status_code == 200:
           should_parse = True
@@ -2741,7 +4604,7 @@ class PullFeedHandler(webapp2.RequestHandler):
                         'redirect to %r', work.topic, status_code, fetch_url)
           if attempts >= MAX_REDIRECTS:
             logging.warning('Too many redirects for topic %r', work.topic)
-            work.fetch_failed()
+            failed_list.append(work)
           else:
             # Recurse to do the refetch.
             hooks.execute(pull_feed_async,
@@ -2755,13 +4618,13 @@ class PullFeedHandler(webapp2.RequestHandler):
         elif status_code == 304:
           logging.debug('Feed publisher for topic %r returned '
                         '304 response (cache hit)', work.topic)
-          work.done()
+          done_list.append(work)
           fetch_success = True
         else:
           logging.debug('Received bad response for topic = %r, '
                         'status_code = %s, response_headers = %r',
                         work.topic, status_code, headers)
-          work.fetch_failed()
+          failed_list.append(work)
 
       # Fetch is done one way or another.
       end_time = time.time()
@@ -2769,9 +4632,9 @@ class PullFeedHandler(webapp2.RequestHandler):
       if should_parse:
         if parse_feed(feed_record, headers, content):
           fetch_success = True
-          work.done()
+          done_list.append(work)
         else:
-          work.fetch_failed()
+          failed_list.append(work)
 
       if fetch_success:
         successful_topics.append(work.topic)
@@ -2798,6 +4661,7 @@ class PullFeedHandler(webapp2.RequestHandler):
       # Only update stats if we are not dealing with a deadlined request.
       FETCH_SCORER.report(successful_topics, failed_topics)
       FETCH_SAMPLER.sample(reporter)
+    FeedToFetch.finish_all(done_list, failed_list, memory_only=memory_only)
 
   @work_queue_only
   def post(self):
@@ -2810,8 +4674,9 @@ class PullFeedHandler(webapp2.RequestHandler):
         return
       self._handle_fetches([work])
     else:
-      work_list = FeedToFetch.FORK_JOIN_QUEUE.pop_request(self.request)
-      self._handle_fetches(work_list)
+      work_list = FeedToFetch.get_fork_join_queue(
+          os.environ['HTTP_X_APPENGINE_TASKNAME']).pop_request(self.request)
+      self._handle_fetches(work_list, memory_only=True)
 
 ################################################################################
 # Event delivery
@@ -2847,6 +4712,10 @@ class PushEventHandler(webapp2.RequestHandler):
     if not work:
       logging.debug('No events to deliver.')
       return
+    if work.delivery_mode == EventToDeliver.SCHEDULED:
+      logging.debug('Remaining deliveries for event %s are scheduled as '
+                    'DeliveryRetry entities.', work.key())
+      return
 
     # Retrieve the first N + 1 subscribers; note if we have more to contact.
     more_subscribers, subscription_list = work.get_next_subscribers()
@@ -2860,6 +4729,7 @@ class PushEventHandler(webapp2.RequestHandler):
     # callback urls as still pending (and thus failed).
     all_callbacks = set(subscription_list)
     failed_callbacks = all_callbacks.copy()
+    parked_callbacks = set()
     reporter = dos.Reporter()
     start_time = time.time()
 
@@ -2879,7 +4749,14 @@ class PushEventHandler(webapp2.RequestHandler):
     def create_callback(sub):
       return lambda *args: callback(sub, *args)
 
-    payload_utf8 = utf8encoded(work.payload)
+    payload = work.get_payload()
+    if payload is None:
+      logging.error('No payload left for event %s; giving up', work.key())
+      work.totally_failed = True
+      work.put()
+      return
+
+    payload_utf8 = utf8encoded(payload)
     scores = DELIVERY_SCORER.filter(s.callback for s in all_callbacks)
     for sub, (allowed, percent) in zip(all_callbacks, scores):
       if not allowed:
@@ -2888,11 +4765,12 @@ class PushEventHandler(webapp2.RequestHandler):
             work.topic, sub.callback, 100 * percent)
         # Remove it from the list of all callbacks and failured callbacks.
         # When a callback domain is hurting, we do not further penalize it
-        # with more failures, but we leave its standing the same. So it's
-        # as if this callback was never even seen. At the beginning of
-        # the next scoring period this callback will be allowed again.
+        # with more failures, but we leave its standing the same. The
+        # delivery is parked as a retry so it goes out once the domain's
+        # circuit lets probes through again.
         all_callbacks.remove(sub)
         failed_callbacks.remove(sub)
+        parked_callbacks.add(sub)
         continue
 
       headers = {
@@ -2917,7 +4795,190 @@ class PushEventHandler(webapp2.RequestHandler):
           [s.callback for s in failed_callbacks])
       DELIVERY_SAMPLER.sample(reporter)
 
-    work.update(more_subscribers, failed_callbacks)
+    work.update(more_subscribers, failed_callbacks | parked_callbacks)
+
+
+class DeliveryRetryHandler(webapp2.RequestHandler):
+  """Background worker for retrying failed event deliveries.
+
+  Each failed (event, subscription) pair is retried on its own backoff
+  schedule; this worker attempts all DeliveryRetry entities that are due,
+  regardless of which event or callback domain they belong to.
+  """
+
+  def __init__(self, request, response, now=datetime.datetime.utcnow):
+    """Initializer.
+
+    Args:
+      now: Callable that returns the current time as a UTC datetime.
+    """
+    webapp2.RequestHandler.__init__(self, request, response)
+    self.now = now
+
+  @work_queue_only
+  def get(self):
+    # Naming the task by the current minute keeps overlapping cron runs from
+    # starting more than one chain of retry workers.
+    name = 'retry-deliveries-%d' % (int(time.mktime(
+        self.now().utctimetuple())) / 60)
+    try:
+      taskqueue.Task(
+          url='/work/retry_deliveries',
+          name=name,
+          params=dict(sequence=name)).add(EVENT_RETRIES_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.debug('Delivery retry task %s already present', name)
+
+  @work_queue_only
+  def post(self):
+    sequence = self.request.get('sequence')
+    cutoff = self.request.get('cutoff')
+    if cutoff:
+      cutoff = datetime.datetime.utcfromtimestamp(float(cutoff))
+    else:
+      cutoff = self.now()
+    query = DeliveryRetry.due_query(cutoff)
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+    retry_list = query.fetch(DELIVERY_RETRY_CHUNK_SIZE)
+    if not retry_list:
+      logging.debug('No delivery retries are due.')
+      return
+    logging.info('%d delivery retries are due', len(retry_list))
+    next_cursor = None
+    if len(retry_list) == DELIVERY_RETRY_CHUNK_SIZE:
+      next_cursor = query.cursor()
+
+    event_list = db.get([r.event_key for r in retry_list])
+    sub_list = db.get([r.subscription_key for r in retry_list])
+
+    # Retries for events or subscriptions that have since gone away are
+    # dropped without being attempted.
+    to_delete = []
+    attempts = []
+    for retry, event, sub in zip(retry_list, event_list, sub_list):
+      if (event is None or sub is None or
+          sub.subscription_state != Subscription.STATE_VERIFIED or
+          event.get_payload() is None):
+        to_delete.append(retry)
+      else:
+        attempts.append((retry, event, sub))
+
+    failed_retries = set(retry for retry, event, sub in attempts)
+    reporter = dos.Reporter()
+    start_time = time.time()
+
+    def callback(retry, result, exception):
+      end_time = time.time()
+      latency = int((end_time - start_time) * 1000)
+      if exception or not (200 <= result.status_code <= 299):
+        logging.debug('Could not deliver to target url %s: '
+                      'Exception = %r, status_code = %s',
+                      retry.callback, exception,
+                      getattr(result, 'status_code', 'unknown'))
+        report_delivery(reporter, retry.callback, False, latency)
+      else:
+        failed_retries.remove(retry)
+        report_delivery(reporter, retry.callback, True, latency)
+
+    def create_callback(retry):
+      return lambda sub, *args: callback(retry, *args)
+
+    postponed = []
+    scores = DELIVERY_SCORER.filter(retry.callback for retry, e, s in attempts)
+    for (retry, event, sub), (allowed, percent) in zip(attempts, scores):
+      if not allowed:
+        # Deliveries to domains with an open circuit stay parked without
+        # using up an attempt until the circuit allows probes again.
+        logging.warning(
+            'Scoring prevented retry of %s to %s with failure rate %.2f%%',
+            event.topic, retry.callback, 100 * percent)
+        failed_retries.remove(retry)
+        retry.postpone(now=self.now)
+        postponed.append(retry)
+        continue
+
+      payload_utf8 = utf8encoded(event.get_payload())
+      headers = {
+        # In case there was no content type header.
+        'Content-Type': event.content_type or 'text/xml',
+        'X-Hub-Signature': 'sha1=%s' % sha1_hmac(
+            sub.secret or sub.verify_token or '', payload_utf8),
+      }
+      hooks.execute(push_event,
+          sub, headers, payload_utf8, async_proxy, create_callback(retry))
+
+    attempted = set(retry for retry, e, s in attempts) - set(postponed)
+    try:
+      async_proxy.wait()
+    except runtime.DeadlineExceededError:
+      logging.error('Could not finish all retries due to deadline. '
+                    'Remaining are: %r', [r.callback for r in failed_retries])
+    else:
+      # Only update stats if we're not dealing with a terminating request.
+      DELIVERY_SCORER.report(
+          [r.callback for r in (attempted - failed_retries)],
+          [r.callback for r in failed_retries])
+      DELIVERY_SAMPLER.sample(reporter)
+
+    to_put = postponed
+    given_up_events = set()
+    for retry in attempted:
+      if retry not in failed_retries:
+        to_delete.append(retry)
+      elif retry.retry_failed(now=self.now):
+        to_put.append(retry)
+      else:
+        to_delete.append(retry)
+        given_up_events.add(retry.event_key)
+
+    db.put(to_put)
+    db.delete(to_delete)
+
+    # Only continue once this chunk's next_attempt updates have committed, so
+    # the next worker never sees these retries as still due.
+    if next_cursor:
+      self._continue(sequence, cutoff, next_cursor)
+
+    # Clean up events that no longer have any deliveries pending.
+    event_keys = set(r.event_key for r in retry_list)
+    for event in db.get(list(event_keys)):
+      if event is None or event.delivery_mode != EventToDeliver.SCHEDULED:
+        continue
+      if event.key() in given_up_events:
+        event.totally_failed = True
+        event.last_modified = self.now()
+      if DeliveryRetry.has_pending(event.key()):
+        if event.totally_failed:
+          event.put()
+      elif event.totally_failed:
+        logging.debug('Giving up on delivery for event %s', event.key())
+        event.put()
+      else:
+        event.delete()
+
+  def _continue(self, sequence, cutoff, cursor):
+    """Enqueues the worker for the next chunk of due retries.
+
+    Args:
+      sequence: Name of the task that started this chain of workers.
+      cutoff: UTC datetime used as the due cutoff for the whole chain.
+      cursor: Query cursor positioned after the current chunk.
+    """
+    name = '%s-%s' % (sequence, sha1_hash(cursor))
+    cutoff_seconds = (calendar.timegm(cutoff.utctimetuple()) +
+                      cutoff.microsecond / 1e6)
+    try:
+      taskqueue.Task(
+          url='/work/retry_deliveries',
+          name=name,
+          countdown=DELIVERY_RETRY_CONTINUATION_SECONDS,
+          params=dict(sequence=sequence,
+                      cutoff=repr(cutoff_seconds),
+                      cursor=cursor)).add(EVENT_RETRIES_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.debug('Continued retry task %s already present', name)
 
 ################################################################################
 
@@ -3128,7 +5189,10 @@ class TopicDetailHandler(webapp2.RequestHandler):
   @dos.limit(count=5, period=60)
   def get(self):
     topic_url = normalize_iri(self.request.get('hub.url'))
-    feed = FeedRecord.get_by_key_name(FeedRecord.create_key_name(topic_url))
+    # Read everything shown on the page in one batch.
+    feed = request_cache.get([FeedRecord.create_key(topic_url),
+                              FeedToFetch.create_key(topic_url)] +
+                             KnownFeedStats.create_count_keys([topic_url]))[0]
     if not feed:
       self.response.set_status(400)
       context = {
@@ -3161,8 +5225,8 @@ class TopicDetailHandler(webapp2.RequestHandler):
       }
 
       if users.is_current_user_admin():
-        feed_stats = db.get(KnownFeedStats.create_key(topic_url=topic_url))
-        if feed_stats:
+        feed_stats = KnownFeedStats.get_or_create_all([topic_url])[0]
+        if feed_stats.update_time or feed_stats.subscriber_count:
           context.update({
             'subscriber_count': feed_stats.subscriber_count,
             'feed_stats_update_time': feed_stats.update_time,
@@ -3208,7 +5272,11 @@ class SubscriptionDetailHandler(webapp2.RequestHandler):
       failed_events = (EventToDeliver.all()
         .filter('failed_callbacks =', subscription.key())
         .fetch(25))
-      delivery_score = DELIVERY_SCORER.filter([callback_url])[0]
+      pending_retries = subscription.delivery_retries.fetch(25)
+      retry_events = db.get([r.event_key for r in pending_retries])
+      # Only peek at the circuit here; filtering would use up a probe.
+      delivery_state = DELIVERY_SCORER.get_states([callback_url])[0]
+      success, failure = DELIVERY_SCORER.get_scores([callback_url])[0]
 
       context.update({
         'created_time': subscription.created_time,
@@ -3223,11 +5291,20 @@ class SubscriptionDetailHandler(webapp2.RequestHandler):
             'retry_attempts': e.retry_attempts,
             'totally_failed': e.totally_failed,
             'content_type': e.content_type,
-            'payload_trunc': e.payload[:10000],
+            'payload_trunc': (e.get_payload() or '')[:10000],
           }
-          for e in failed_events],
-        'delivery_blocked': not delivery_score[0],
-        'delivery_errors': delivery_score[1] * 100,
+          for e in failed_events] + [
+          {
+            'last_modified': e.last_modified,
+            'retry_attempts': r.attempts,
+            'totally_failed': e.totally_failed,
+            'content_type': e.content_type,
+            'payload_trunc': (e.get_payload() or '')[:10000],
+          }
+          for r, e in zip(pending_retries, retry_events) if e is not None],
+        'delivery_blocked': delivery_state != dos.CircuitBreaker.CLOSED,
+        'delivery_circuit': delivery_state,
+        'delivery_errors': 100.0 * failure / max(1, success + failure),
         'delivery_url_error': DELIVERY_SAMPLER.get_chain(
             DELIVERY_URL_SAMPLE_MINUTE,
             DELIVERY_URL_SAMPLE_30_MINUTE,
@@ -3313,12 +5390,22 @@ class StatsHandler(webapp2.RequestHandler):
           DELIVERY_DOMAIN_SAMPLE_HOUR_LATENCY,
           DELIVERY_DOMAIN_SAMPLE_DAY_LATENCY),
     }
+    context['fork_join'] = FORK_JOIN_SAMPLER.get_chain(
+        FORK_JOIN_SAMPLE_MINUTE,
+        FORK_JOIN_SAMPLE_HOUR)
     all_configs = []
     all_configs.extend(FETCH_SAMPLER.configs)
     all_configs.extend(DELIVERY_SAMPLER.configs)
+    all_configs.extend(FORK_JOIN_SAMPLER.configs)
+    all_configs.extend(SUBSCRIBER_CACHE_SAMPLER.configs)
+    cache_hits, cache_misses = Subscription.get_cache_stats()
     context.update({
       'all_configs': all_configs,
       'show_everything': True,
+      'subscriber_cache_hits': cache_hits,
+      'subscriber_cache_misses': cache_misses,
+      'subscriber_cache_hit_ratio':
+          100.0 * cache_hits / max(1, cache_hits + cache_misses),
     })
     self.response.out.write(str(template.render('all_stats.html', context)))
 
@@ -3527,6 +5614,7 @@ def main():
       (r'/', HubHandler),
       (r'/publish', PublishHandler),
       (r'/subscribe', SubscribeHandler),
+      (r'/subscribe/bulk', BulkSubscribeHandler),
       (r'/topic-details', TopicDetailHandler),
       (r'/subscription-details', SubscriptionDetailHandler),
       (r'/stats', StatsHandler),
@@ -3534,21 +5622,36 @@ def main():
       (r'/work/subscriptions', SubscriptionConfirmHandler),
       (r'/work/pull_feeds', PullFeedHandler),
       (r'/work/push_events', PushEventHandler),
+      (r'/work/retry_deliveries', DeliveryRetryHandler),
       (r'/work/record_feeds', RecordFeedHandler),
       # Periodic workers
       (r'/work/poll_bootstrap', PollBootstrapHandler),
       (r'/work/subscription_cleanup', SubscriptionCleanupHandler),
+      (r'/work/payload_cleanup', EventPayloadCleanupHandler),
+      (r'/work/journal_cleanup', ForkJoinJournalCleanupHandler),
       (r'/work/reconfirm_subscriptions', SubscriptionReconfirmHandler),
       (r'/work/cleanup_mapper', CleanupMapperHandler),
     ])
   application = webapp2.WSGIApplication(HANDLERS, debug=DEBUG)
-  wsgiref.handlers.CGIHandler().run(application)
+  request_cache.install()
+  request_cache.start()
+  task_batcher.start()
+  try:
+    wsgiref.handlers.CGIHandler().run(application)
+  finally:
+    try:
+      task_batcher.stop()
+    finally:
+      request_cache.stop()
+      sample_fork_join_stats()
+      sample_subscriber_cache_stats()
 
 ################################################################################
 # Declare and load external hooks.
 
 hooks = HookManager()
 hooks.declare(confirm_subscription)
+hooks.declare(confirm_subscription_async)
 hooks.declare(derive_sources)
 hooks.declare(inform_event)
 hooks.declare(modify_handlers)
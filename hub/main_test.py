@@ -17,6 +17,7 @@
 
 """Tests for the main module."""
 
+import calendar
 import datetime
 import logging
 logging.basicConfig(format='%(levelname)-8s %(filename)s] %(message)s')
@@ -42,7 +43,9 @@ from google.appengine.runtime import apiproxy_errors
 import async_apiproxy
 import dos
 import feed_diff
+import fork_join_queue
 import main
+import request_cache
 import urlfetch_test_stub
 
 import mapreduce.control
@@ -385,6 +388,7 @@ class KnownFeedIdentityTest(unittest.TestCase):
 ################################################################################
 
 Subscription = main.Subscription
+SubscriptionToConfirm = main.SubscriptionToConfirm
 
 
 class SubscriptionTest(unittest.TestCase):
@@ -403,25 +407,33 @@ class SubscriptionTest(unittest.TestCase):
     self.callback_key_map = dict(
         (Subscription.create_key_name(cb, self.topic), cb)
         for cb in (self.callback, self.callback2, self.callback3))
+    main._subscriber_cache_reporter = dos.Reporter()
 
   def get_subscription(self):
     """Returns the subscription for the test callback and topic."""
     return Subscription.get_by_key_name(
         Subscription.create_key_name(self.callback, self.topic))
 
-  def verify_tasks(self, next_state, verify_token, secret, **kwargs):
-    """Verifies the required tasks have been submitted.
+  def verify_tasks(self, next_state, verify_token, secret,
+                   queue_name=main.SUBSCRIPTION_QUEUE):
+    """Verifies the required confirmation has been enqueued.
 
     Args:
       next_state: The next state the Subscription should have.
       verify_token: The token that should be used to confirm the
         subscription action.
-      **kwargs: Passed to testutil.get_tasks().
+      secret: The secret the confirmation should have.
+      queue_name: The queue the fork-join task should be on.
     """
-    task = testutil.get_tasks(main.SUBSCRIPTION_QUEUE, **kwargs)
-    self.assertEquals(next_state, task['params']['next_state'])
-    self.assertEquals(verify_token, task['params']['verify_token'])
-    self.assertEquals(secret, task['params']['secret'])
+    testutil.get_tasks(queue_name, expected_count=1)
+    work_list = list(SubscriptionToConfirm.all().ancestor(
+        db.Key.from_path(Subscription.kind(),
+            Subscription.create_key_name(self.callback, self.topic))))
+    self.assertEquals(1, len(work_list))
+    work = work_list[0]
+    self.assertEquals(next_state, work.next_state)
+    self.assertEquals(verify_token, work.verify_token)
+    self.assertEquals(secret, work.secret)
 
   def testRequestInsert_defaults(self):
     now_datetime = datetime.datetime.now()
@@ -431,13 +443,12 @@ class SubscriptionTest(unittest.TestCase):
     self.assertTrue(Subscription.request_insert(
         self.callback, self.topic, self.token,
         self.secret, lease_seconds=lease_seconds, now=now))
-    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret,
-                      expected_count=1, index=0)
+    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret)
     self.assertFalse(Subscription.request_insert(
         self.callback, self.topic, self.token,
         self.secret, lease_seconds=lease_seconds, now=now))
-    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret,
-                      expected_count=2, index=1)
+    # Repeated requests in the same batch replace each other.
+    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret)
 
     sub = self.get_subscription()
     self.assertEquals(Subscription.STATE_NOT_VERIFIED, sub.subscription_state)
@@ -499,8 +510,7 @@ class SubscriptionTest(unittest.TestCase):
     self.assertEquals(second_token, sub.verify_token)
     self.assertEquals(second_secret, sub.secret)
 
-    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret,
-                      expected_count=1, index=0)
+    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret)
 
   def testInsert_expiration(self):
     """Tests that the expiration time is updated on repeated insert() calls."""
@@ -522,8 +532,7 @@ class SubscriptionTest(unittest.TestCase):
     self.assertTrue(Subscription.remove(self.callback, self.topic))
     self.assertFalse(Subscription.remove(self.callback, self.topic))
     # Only task should be the initial insertion request.
-    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret,
-                      expected_count=1, index=0)
+    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret)
 
   def testRequestRemove(self):
     """Tests the request remove method."""
@@ -535,6 +544,7 @@ class SubscriptionTest(unittest.TestCase):
 
     self.assertTrue(Subscription.request_insert(
         self.callback, self.topic, self.token, self.secret))
+    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret)
     second_token = 'this is the second token'
     self.assertTrue(Subscription.request_remove(
         self.callback, self.topic, second_token))
@@ -543,10 +553,8 @@ class SubscriptionTest(unittest.TestCase):
     self.assertEquals(self.token, sub.verify_token)
     self.assertEquals(Subscription.STATE_NOT_VERIFIED, sub.subscription_state)
 
-    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret,
-                      expected_count=2, index=0)
-    self.verify_tasks(Subscription.STATE_TO_DELETE, second_token, '',
-                      expected_count=2, index=1)
+    # The later request replaces the earlier one in the same batch.
+    self.verify_tasks(Subscription.STATE_TO_DELETE, second_token, None)
 
   def testRequestInsertOverride(self):
     """Tests that requesting insertion does not override the verify_token."""
@@ -561,8 +569,7 @@ class SubscriptionTest(unittest.TestCase):
     self.assertEquals(self.token, sub.verify_token)
     self.assertEquals(Subscription.STATE_VERIFIED, sub.subscription_state)
 
-    self.verify_tasks(Subscription.STATE_VERIFIED, second_token, second_secret,
-                      expected_count=1, index=0)
+    self.verify_tasks(Subscription.STATE_VERIFIED, second_token, second_secret)
 
   def testHasSubscribers_unverified(self):
     """Tests that unverified subscribers do not make the subscription active."""
@@ -578,6 +585,21 @@ class SubscriptionTest(unittest.TestCase):
     self.assertTrue(Subscription.remove(self.callback, self.topic))
     self.assertFalse(Subscription.has_subscribers(self.topic))
 
+  def testHasCachedSubscribers(self):
+    """Tests checking for subscribers through the subscriber list cache."""
+    self.assertFalse(Subscription.has_cached_subscribers(self.topic))
+    self.assertTrue(Subscription.request_insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertFalse(Subscription.has_cached_subscribers(self.topic))
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertTrue(Subscription.has_cached_subscribers(self.topic))
+    self.assertTrue(Subscription.has_cached_subscribers(self.topic))
+    main.sample_subscriber_cache_stats()
+    self.assertEquals((2, 2), Subscription.get_cache_stats())
+    self.assertTrue(Subscription.remove(self.callback, self.topic))
+    self.assertFalse(Subscription.has_cached_subscribers(self.topic))
+
   def testGetSubscribers_unverified(self):
     """Tests that unverified subscribers will not be retrieved."""
     self.assertEquals([], Subscription.get_subscribers(self.topic, 10))
@@ -662,6 +684,93 @@ class SubscriptionTest(unittest.TestCase):
         found_keys)
     self.assertEquals(3, len(Subscription.get_subscribers(self.topic, 10)))
 
+  def testGetCachedSubscribers(self):
+    """Tests that subscriber lists are served from the cache."""
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertTrue(Subscription.insert(
+        self.callback2, self.topic, self.token, self.secret))
+
+    def key_list(**kwargs):
+      sub_list = Subscription.get_cached_subscribers(self.topic, 10, **kwargs)
+      return [s.key().name() for s in sub_list]
+
+    expected = [s.key().name()
+                for s in Subscription.get_subscribers(self.topic, 10)]
+    self.assertEquals(expected, key_list())
+    main.sample_subscriber_cache_stats()
+    self.assertEquals((0, 1), Subscription.get_cache_stats())
+    self.assertEquals(expected, key_list())
+    main.sample_subscriber_cache_stats()
+    self.assertEquals((1, 1), Subscription.get_cache_stats())
+
+    cached = Subscription.get_cached_subscribers(self.topic, 10)[0]
+    self.assertEquals(self.secret, cached.secret)
+    self.assertEquals(self.token, cached.verify_token)
+
+    # Different offsets are cached separately.
+    self.assertEquals(expected[1:], key_list(starting_at_callback=
+        self.callback_key_map[expected[1]]))
+    main.sample_subscriber_cache_stats()
+    self.assertEquals((2, 2), Subscription.get_cache_stats())
+
+  def testGetCachedSubscribers_invalidated(self):
+    """Tests that changing subscriptions invalidates the cached lists."""
+    def callbacks():
+      return sorted(s.callback for s in
+                    Subscription.get_cached_subscribers(self.topic, 10))
+
+    self.assertEquals([], callbacks())
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertEquals([self.callback], callbacks())
+    self.assertTrue(Subscription.insert(
+        self.callback2, self.topic, self.token, self.secret))
+    self.assertEquals(sorted([self.callback, self.callback2]), callbacks())
+    Subscription.archive(self.callback, self.topic)
+    self.assertEquals([self.callback2], callbacks())
+    self.assertTrue(Subscription.remove(self.callback2, self.topic))
+    self.assertEquals([], callbacks())
+
+    # Other topics are not affected.
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic2, self.token, self.secret))
+    self.assertEquals([], callbacks())
+    main.sample_subscriber_cache_stats()
+    self.assertEquals((1, 5), Subscription.get_cache_stats())
+
+  def testGetCachedSubscribers_settling(self):
+    """Tests that lists read right after a change are cached briefly."""
+    cache_times = []
+    old_set = memcache.set
+    def set_mock(key, value, time=0, **kwargs):
+      if key.startswith('chunk:'):
+        cache_times.append(time)
+      return old_set(key, value, time=time, **kwargs)
+    memcache.set = set_mock
+    try:
+      self.assertTrue(Subscription.insert(
+          self.callback, self.topic, self.token, self.secret))
+      Subscription.get_cached_subscribers(self.topic, 10)
+      memcache.delete('settling:' + sha1_hash(self.topic),
+                      key_prefix=main.SUBSCRIBER_CACHE_PREFIX)
+      Subscription.get_cached_subscribers(self.topic, 5)
+    finally:
+      memcache.set = old_set
+    self.assertEquals([main.SUBSCRIBER_CACHE_UNSETTLED_SECONDS,
+                       main.SUBSCRIBER_CACHE_SECONDS], cache_times)
+
+  def testGetCachedSubscribers_versionEvicted(self):
+    """Tests that an evicted cache version never serves stale chunks."""
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertEquals(
+        1, len(Subscription.get_cached_subscribers(self.topic, 10)))
+    memcache.delete('version:' + sha1_hash(self.topic),
+                    key_prefix=main.SUBSCRIBER_CACHE_PREFIX)
+    self.assertTrue(Subscription.remove(self.callback, self.topic))
+    self.assertEquals([], Subscription.get_cached_subscribers(self.topic, 10))
+
   def testConfirmFailed(self):
     """Tests retry delay periods when a subscription confirmation fails."""
     start = datetime.datetime.utcnow()
@@ -690,13 +799,43 @@ class SubscriptionTest(unittest.TestCase):
     self.assertEquals(Subscription.STATE_NOT_VERIFIED, sub.subscription_state)
     testutil.get_tasks(main.SUBSCRIPTION_QUEUE, index=0, expected_count=6)
 
+  def testConfirmFailedAll(self):
+    """Tests reporting a batch of failed confirmations."""
+    start = datetime.datetime.utcnow()
+    for callback in (self.callback, self.callback2):
+      self.assertTrue(Subscription.request_insert(
+          callback, self.topic, self.token, self.secret))
+    sub = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback, self.topic))
+    sub2 = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback2, self.topic))
+    sub2.confirm_failures = 5
+
+    self.assertEquals([True, False], Subscription.confirm_failed_all(
+        [(sub, Subscription.STATE_VERIFIED, self.token, True, self.secret),
+         (sub2, Subscription.STATE_VERIFIED, self.token, False, None)],
+        max_failures=5, retry_period=5, now=lambda: start))
+
+    sub = Subscription.get_by_key_name(sub.key().name())
+    self.assertEquals(1, sub.confirm_failures)
+    self.assertEquals(start + datetime.timedelta(seconds=5), sub.eta)
+    task = [t for t in testutil.get_tasks(main.POLLING_QUEUE)
+            if t['url'] == '/work/subscriptions' and 'params' in t][0]
+    self.assertEquals(sub.key().name(),
+                      task['params']['subscription_key_name'])
+    self.assertEquals('True', task['params']['auto_reconfirm'])
+    self.assertEquals(0, Subscription.get_by_key_name(
+        sub2.key().name()).confirm_failures)
+
   def testQueueSelected(self):
     """Tests that auto_reconfirm will put the task on the polling queue."""
     self.assertTrue(Subscription.request_insert(
         self.callback, self.topic, self.token, self.secret,
         auto_reconfirm=True))
     testutil.get_tasks(main.SUBSCRIPTION_QUEUE, expected_count=0)
-    testutil.get_tasks(main.POLLING_QUEUE, expected_count=1)
+    self.verify_tasks(Subscription.STATE_VERIFIED, self.token, self.secret,
+                      queue_name=main.POLLING_QUEUE)
+    self.assertTrue(SubscriptionToConfirm.all().get().auto_reconfirm)
 
     self.assertFalse(Subscription.request_insert(
         self.callback, self.topic, self.token, self.secret,
@@ -704,6 +843,27 @@ class SubscriptionTest(unittest.TestCase):
     testutil.get_tasks(main.SUBSCRIPTION_QUEUE, expected_count=1)
     testutil.get_tasks(main.POLLING_QUEUE, expected_count=1)
 
+  def testReconfirmQueueSeparate(self):
+    """Tests that reconfirmations and user requests are batched apart."""
+    other_callback = 'http://example.com/other-callback'
+    self.assertTrue(Subscription.request_insert(
+        other_callback, self.topic, self.token, self.secret))
+    self.assertTrue(Subscription.request_insert(
+        self.callback, self.topic, self.token, self.secret,
+        auto_reconfirm=True))
+
+    for queue_name, fork_join, callback in (
+        (main.SUBSCRIPTION_QUEUE, SubscriptionToConfirm.FORK_JOIN_QUEUE,
+         other_callback),
+        (main.POLLING_QUEUE, SubscriptionToConfirm.RECONFIRM_FORK_JOIN_QUEUE,
+         self.callback)):
+      task = testutil.get_tasks(queue_name, index=0, expected_count=1)
+      queue = SubscriptionToConfirm.get_task_queue(task['name'])
+      self.assertTrue(queue is fork_join)
+      self.assertEquals(
+          [Subscription.create_key_name(callback, self.topic)],
+          [w.subscription_key.name() for w in queue.pop(task['name'])])
+
   def testArchiveExists(self):
     """Tests the archive method when the subscription exists."""
     Subscription.insert(self.callback, self.topic, self.token, self.secret)
@@ -721,6 +881,49 @@ class SubscriptionTest(unittest.TestCase):
     Subscription.archive(self.callback, self.topic)
     self.assertTrue(Subscription.get_by_key_name(sub_key) is None)
 
+  def get_subscriber_count(self):
+    """Returns the current subscriber count for the test topic."""
+    return main.KnownFeedStats.get_or_create_all(
+        [self.topic])[0].subscriber_count
+
+  def testSubscriberCount(self):
+    """Tests that subscriber counts are updated as subscriptions change."""
+    self.assertEquals(0, self.get_subscriber_count())
+    Subscription.insert(self.callback, self.topic, self.token, self.secret)
+    Subscription.insert(self.callback2, self.topic, self.token, self.secret)
+    Subscription.insert(self.callback3, self.topic, self.token, self.secret)
+    self.assertEquals(3, self.get_subscriber_count())
+
+    # Reconfirming a verified subscription does not change the count.
+    Subscription.insert(self.callback, self.topic, self.token, self.secret)
+    self.assertEquals(3, self.get_subscriber_count())
+
+    Subscription.remove(self.callback, self.topic)
+    Subscription.archive(self.callback2, self.topic)
+    self.assertEquals(1, self.get_subscriber_count())
+
+    # Removing archived or missing subscriptions does not change the count.
+    Subscription.remove(self.callback, self.topic)
+    Subscription.remove(self.callback2, self.topic)
+    self.assertEquals(1, self.get_subscriber_count())
+
+    # Subscriptions awaiting verification are not counted.
+    Subscription.request_insert(
+        self.callback, self.topic, self.token, self.secret)
+    self.assertEquals(1, self.get_subscriber_count())
+
+  def testSubscriberCount_baseline(self):
+    """Tests that shard counts are added to the last full recount."""
+    main.KnownFeedStats(
+        key=main.KnownFeedStats.create_key(self.topic),
+        subscriber_count=10).put()
+    Subscription.insert(self.callback, self.topic, self.token, self.secret)
+    Subscription.insert(self.callback2, self.topic, self.token, self.secret)
+    Subscription.remove(self.callback, self.topic)
+    self.assertEquals(11, self.get_subscriber_count())
+    self.assertEquals(0, main.KnownFeedStats.get_or_create_all(
+        [self.topic2])[0].subscriber_count)
+
 ################################################################################
 
 FeedToFetch = main.FeedToFetch
@@ -747,6 +950,24 @@ class FeedToFetchTest(unittest.TestCase):
       self.assertEquals([], feed_to_fetch.source_values)
       self.assertEquals(found_feeds[0].work_index, feed_to_fetch.work_index)
 
+  def testInsertCompact(self):
+    """Tests that in-memory work is stored compactly and decoded intact."""
+    topic = u'http://example.com/t\u00f6pic'
+    (feed,) = FeedToFetch.insert([topic], {'one': u'tw\u00f6'})
+    task = testutil.get_tasks(main.FEED_QUEUE, index=0, expected_count=1)
+    value = memcache.get(FeedToFetch.FORK_JOIN_QUEUE._create_index_key(
+        feed.work_index, 0))
+    self.assertTrue(isinstance(value, str))
+    self.assertTrue(
+        2 * len(value) < len(db.model_to_protobuf(feed).Encode()))
+
+    (found,) = FeedToFetch.FORK_JOIN_QUEUE.pop(task['name'])
+    self.assertEquals(feed.key(), found.key())
+    self.assertEquals(topic, found.topic)
+    self.assertEquals(['one'], found.source_keys)
+    self.assertEquals([u'tw\u00f6'], found.source_values)
+    self.assertEquals(feed.work_index, found.work_index)
+
   def testEmpty(self):
     """Tests when the list of urls is empty."""
     FeedToFetch.insert([])
@@ -808,6 +1029,42 @@ class FeedToFetchTest(unittest.TestCase):
     found_etas = [t['eta'] for t in tasks[1:]]  # First task is from insert()
     self.assertEquals(etas, found_etas)
 
+  def testFinishAll(self):
+    """Tests reporting the outcome of a batch of in-memory fetches."""
+    start = datetime.datetime.utcnow()
+    feed_list = FeedToFetch.insert([self.topic, self.topic2, self.topic3])
+    feed_dict = dict((f.topic, f) for f in feed_list)
+    feed_dict[self.topic3].fetching_failures = 5
+    FeedToFetch.finish_all(
+        [feed_dict[self.topic]],
+        [feed_dict[self.topic2], feed_dict[self.topic3]],
+        memory_only=True, max_failures=5, retry_period=5, now=lambda: start)
+
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic) is None)
+    failed = FeedToFetch.get_by_topic(self.topic2)
+    self.assertEquals(1, failed.fetching_failures)
+    self.assertEquals(start + datetime.timedelta(seconds=5), failed.eta)
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic3).totally_failed)
+
+    # Only the feed that will be retried has a retry task.
+    task = testutil.get_tasks(main.FEED_RETRIES_QUEUE,
+                              index=0, expected_count=1)
+    self.assertEquals(self.topic2, task['params']['topic'])
+    self.assertEquals(testutil.task_eta(failed.eta), task['eta'])
+
+  def testFinishAll_saved(self):
+    """Tests reporting successful fetches of saved entities in one batch."""
+    feed_list = FeedToFetch.insert([self.topic, self.topic2, self.topic3])
+    db.put(feed_list)
+    # A new publish for the third topic replaced its entity.
+    (newer,) = FeedToFetch.insert([self.topic3])
+    newer.put()
+    FeedToFetch.finish_all(feed_list, [])
+
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic) is None)
+    self.assertTrue(FeedToFetch.get_by_topic(self.topic2) is None)
+    self.assertEquals(newer.eta, FeedToFetch.get_by_topic(self.topic3).eta)
+
   def testQueuePreserved(self):
     """Tests the request's polling queue is preserved for new FeedToFetch."""
     FeedToFetch.insert([self.topic])
@@ -821,6 +1078,46 @@ class FeedToFetchTest(unittest.TestCase):
     finally:
       del os.environ['HTTP_X_APPENGINE_QUEUENAME']
 
+  def testLanes_cached(self):
+    """Tests that each topic's lane is cached in memcache."""
+    self.assertEquals({main.FEED_LANE_NORMAL: [self.topic]},
+                      FeedToFetch._assign_lanes(set([self.topic])))
+    KnownFeedStats(key=KnownFeedStats.create_key(self.topic),
+                   subscriber_count=main.FEED_PRIORITY_SUBSCRIBERS).put()
+    self.assertEquals({main.FEED_LANE_NORMAL: [self.topic]},
+                      FeedToFetch._assign_lanes(set([self.topic])))
+
+    memcache.flush_all()
+    self.assertEquals({main.FEED_LANE_PRIORITY: [self.topic]},
+                      FeedToFetch._assign_lanes(set([self.topic])))
+
+  def testLanes(self):
+    """Tests that high-subscriber topics are fetched in the priority lane."""
+    KnownFeedStats(key=KnownFeedStats.create_key(self.topic),
+                   subscriber_count=main.FEED_PRIORITY_SUBSCRIBERS).put()
+    FeedToFetch.insert([self.topic, self.topic2])
+    priority_task = testutil.get_tasks(main.FEED_PRIORITY_QUEUE,
+                                       index=0, expected_count=1)
+    normal_task = testutil.get_tasks(main.FEED_QUEUE,
+                                     index=0, expected_count=1)
+
+    queue = FeedToFetch.get_fork_join_queue(priority_task['name'])
+    self.assertTrue(
+        queue is FeedToFetch.FORK_JOIN_LANES[main.FEED_LANE_PRIORITY])
+    self.assertEquals([self.topic], [f.topic for f in
+                                     queue.pop(priority_task['name'])])
+    queue = FeedToFetch.get_fork_join_queue(normal_task['name'])
+    self.assertTrue(queue is FeedToFetch.FORK_JOIN_QUEUE)
+    self.assertEquals([self.topic2], [f.topic for f in
+                                      queue.pop(normal_task['name'])])
+
+  def testExplicitLane(self):
+    """Tests inserting work into a specific lane."""
+    FeedToFetch.insert([self.topic], lane=main.FEED_LANE_POLLING)
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+    self.assertTrue(task['name'].startswith('fjq-FeedToFetch-polling-'))
+    testutil.get_tasks(main.FEED_QUEUE, expected_count=0)
+
   def testSources(self):
     """Tests when sources are supplied."""
     source_dict = {'foo': 'bar', 'meepa': 'stuff'}
@@ -835,6 +1132,7 @@ class FeedToFetchTest(unittest.TestCase):
 
 FeedEntryRecord = main.FeedEntryRecord
 EventToDeliver = main.EventToDeliver
+DeliveryRetry = main.DeliveryRetry
 
 
 class EventToDeliverTest(unittest.TestCase):
@@ -942,6 +1240,45 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     self.assertEquals(expected_data, event.payload)
     self.assertEquals('my crazy content type', event.content_type)
 
+  def testCreateEventForTopic_envelopeSplit(self):
+    """Tests creating an event with a precomputed envelope split."""
+    record = FeedRecord.get_or_create(self.topic)
+    record.update({}, self.header_footer, main.ATOM)
+    self.assertEquals(self.header_footer.rfind('</feed>'),
+                      record.envelope_split)
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads,
+        envelope_split=record.envelope_split)
+    self.assertEquals(
+        EventToDeliver.create_event_for_topic(
+            self.topic, main.ATOM, 'application/atom+xml',
+            self.header_footer, self.test_payloads).payload,
+        event.payload)
+
+  def testCreateEventForTopic_unicode(self):
+    """Tests that unicode envelopes and entries are assembled as UTF-8."""
+    self.header_footer = u'<feed><title>caf\xe9</title>\n</feed>'
+    self.test_payloads = [u'<entry>\u30d6\u30ed\u30b0</entry>']
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads)
+    self.assertTrue(isinstance(event.get_payload(), str))
+    self.assertEquals(
+        u'<?xml version="1.0" encoding="utf-8"?>\n'
+        u'<feed><title>caf\xe9</title>\n\n'
+        u'<entry>\u30d6\u30ed\u30b0</entry>\n'
+        u'</feed>',
+        event.get_payload().decode('utf-8'))
+
+  def testFindEnvelopeSplit(self):
+    """Tests finding where to splice entries into feed envelopes."""
+    self.assertEquals(6, main.find_envelope_split('<feed></feed>'))
+    self.assertEquals(
+        14, main.find_envelope_split('<rss><channel></channel></rss>'))
+    self.assertEquals(None, main.find_envelope_split('<feed>no end'))
+    self.assertEquals(None, main.find_envelope_split('</rss>'))
+
   def testCreateEvent_badHeaderFooter(self):
     """Tests when the header/footer data in an event is invalid."""
     self.assertRaises(AssertionError, EventToDeliver.create_event_for_topic,
@@ -956,36 +1293,62 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     event = EventToDeliver.get(work_key)
     self.assertTrue(event is None)
 
+  def make_legacy_retry(self, event, failed_keys, retry_attempts=1):
+    """Puts an event in the legacy 'retry' mode with a failed callbacks list.
+
+    Args:
+      event: The EventToDeliver to modify and store.
+      failed_keys: Keys of the Subscriptions that failed delivery.
+      retry_attempts: How many retry attempts have already happened.
+
+    Returns:
+      The EventToDeliver fetched from the Datastore after storing it.
+    """
+    event.delivery_mode = EventToDeliver.RETRY
+    event.failed_callbacks = failed_keys
+    event.retry_attempts = retry_attempts
+    event.last_callback = ''
+    event.put()
+    return EventToDeliver.get(event.key())
+
+  def get_retries(self, event):
+    """Returns the DeliveryRetry entities pending for an event."""
+    return list(DeliveryRetry.all().ancestor(event.key()))
+
   def testUpdate_failWithNoSubscribersLeft(self):
     """Tests that failures are written correctly by EventToDeliver.update.
 
-    This tests the common case of completing the failed callbacks list extending
-    when there are new Subscriptions that have been found in the latest work
-    queue query.
+    Each failed subscription should be scheduled for retry on its own instead
+    of being kept in the event's failed callbacks list.
     """
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
 
     # Assert that the callback offset is updated and any failed callbacks
-    # are recorded.
+    # are scheduled for retry.
     more, subs = event.get_next_subscribers(chunk_size=1)
     event.update(more, [sub_list[0]])
     event = EventToDeliver.get(event.key())
     self.assertEquals(EventToDeliver.NORMAL, event.delivery_mode)
-    self.assertEquals([sub_list[0].key()], event.failed_callbacks)
+    self.assertEquals([], event.failed_callbacks)
     self.assertEquals(self.callback2, event.last_callback)
+    self.assertEquals([sub_keys[0]],
+                      [r.subscription_key for r in self.get_retries(event)])
 
     more, subs = event.get_next_subscribers(chunk_size=3)
     event.update(more, sub_list[1:])
     event = EventToDeliver.get(event.key())
     self.assertTrue(event is not None)
-    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
+    self.assertEquals(EventToDeliver.SCHEDULED, event.delivery_mode)
     self.assertEquals('', event.last_callback)
 
-    self.assertEquals([s.key() for s in sub_list], event.failed_callbacks)
+    retry_list = self.get_retries(event)
+    self.assertEquals(sorted(s.key().name() for s in sub_list),
+                      sorted(r.key().name() for r in retry_list))
+    self.assertEquals(sorted(s.callback for s in sub_list),
+                      sorted(r.callback for r in retry_list))
     tasks = testutil.get_tasks(main.EVENT_QUEUE, expected_count=1)
-    tasks.extend(testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=1))
-    self.assertEquals([str(work_key)] * 2,
-                      [t['params']['event_key'] for t in tasks])
+    self.assertEquals(str(work_key), tasks[0]['params']['event_key'])
+    testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=0)
 
   def testUpdate_actuallyNoMoreCallbacks(self):
     """Tests when the normal update delivery has no Subscriptions left.
@@ -1002,38 +1365,33 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     self.assertEquals(self.callback4, event.last_callback)
     self.assertEquals(EventToDeliver.NORMAL, event.delivery_mode)
 
-    # This final call to update will transition to retry properly.
+    # This final call to update will hand off to the scheduled retries.
     Subscription.remove(self.callback4, self.topic)
     more, subs = event.get_next_subscribers(chunk_size=1)
     event.update(more, [])
     event = EventToDeliver.get(event.key())
     self.assertEquals([], subs)
     self.assertTrue(event is not None)
-    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
+    self.assertEquals(EventToDeliver.SCHEDULED, event.delivery_mode)
+    self.assertEquals(3, len(self.get_retries(event)))
 
     tasks = testutil.get_tasks(main.EVENT_QUEUE, expected_count=1)
-    tasks.extend(testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=1))
-    self.assertEquals([str(work_key)] * 2,
-                      [t['params']['event_key'] for t in tasks])
+    self.assertEquals(str(work_key), tasks[0]['params']['event_key'])
+    testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=0)
 
-  def testGetNextSubscribers_retriesFinallySuccessful(self):
-    """Tests retries until all subscribers are successful."""
+  def testUpdate_scheduledHasNoMoreSubscribers(self):
+    """Tests that scheduled events do not page through subscribers again."""
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
-
-    # Simulate that callback 2 is successful and the rest fail.
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    event.update(more, sub_list[:1])
+    more, subs = event.get_next_subscribers(chunk_size=4)
+    event.update(more, subs[:1])
     event = EventToDeliver.get(event.key())
-    self.assertTrue(more)
-    self.assertEquals(self.callback3, event.last_callback)
-    self.assertEquals(EventToDeliver.NORMAL, event.delivery_mode)
+    self.assertEquals(EventToDeliver.SCHEDULED, event.delivery_mode)
+    self.assertEquals((False, []), event.get_next_subscribers())
 
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    event.update(more, sub_list[2:])
-    event = EventToDeliver.get(event.key())
-    self.assertEquals('', event.last_callback)
-    self.assertFalse(more)
-    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
+  def testGetNextSubscribers_retriesFinallySuccessful(self):
+    """Tests legacy retries until all subscribers are successful."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    event = self.make_legacy_retry(event, sub_keys[:1] + sub_keys[2:])
 
     # Now getting the next subscribers will returned the failed ones.
     more, subs = event.get_next_subscribers(chunk_size=2)
@@ -1074,35 +1432,22 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     self.assertEquals(expected, [s.key() for s in subs])
     event.update(more, [])
     self.assertFalse(more)
+    self.assertTrue(EventToDeliver.get(work_key) is None)
 
-    tasks = testutil.get_tasks(main.EVENT_QUEUE, expected_count=1)
-    tasks.extend(testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=4))
-    self.assertEquals([str(work_key)] * 5,
+    # Legacy retries never create per-subscription retries.
+    self.assertEquals([], list(DeliveryRetry.all()))
+    tasks = testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=3)
+    self.assertEquals([str(work_key)] * 3,
                       [t['params']['event_key'] for t in tasks])
 
   def testGetNextSubscribers_failedFewerThanChunkSize(self):
     """Tests when there are fewer failed callbacks than the chunk size.
 
-    Ensures that we step through retry attempts when there is only a single
-    chunk to go through on each retry iteration.
+    Ensures that we step through legacy retry attempts when there is only a
+    single chunk to go through on each retry iteration.
     """
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
-
-    # Simulate that callback 2 is successful and the rest fail.
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    event.update(more, sub_list[:1])
-    event = EventToDeliver.get(event.key())
-    self.assertTrue(more)
-    self.assertEquals(self.callback3, event.last_callback)
-    self.assertEquals(EventToDeliver.NORMAL, event.delivery_mode)
-
-    more, subs = event.get_next_subscribers(chunk_size=2)
-    event.update(more, sub_list[2:])
-    event = EventToDeliver.get(event.key())
-    self.assertEquals('', event.last_callback)
-    self.assertFalse(more)
-    self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
-    self.assertEquals(1, event.retry_attempts)
+    event = self.make_legacy_retry(event, sub_keys[:1] + sub_keys[2:])
 
     # Now attempt a retry with a chunk size equal to the number of callbacks.
     more, subs = event.get_next_subscribers(chunk_size=3)
@@ -1112,17 +1457,17 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     self.assertEquals(EventToDeliver.RETRY, event.delivery_mode)
     self.assertEquals(2, event.retry_attempts)
 
-    tasks = testutil.get_tasks(main.EVENT_QUEUE, expected_count=1)
-    tasks.extend(testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=2))
-    self.assertEquals([str(work_key)] * 3,
+    tasks = testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=1)
+    self.assertEquals([str(work_key)],
                       [t['params']['event_key'] for t in tasks])
 
   def testGetNextSubscribers_giveUp(self):
-    """Tests retry delay amounts until we finally give up on event delivery.
+    """Tests legacy retry delay amounts until we finally give up on delivery.
 
     Verifies retry delay logic works properly.
     """
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    event = self.make_legacy_retry(event, sub_keys, retry_attempts=0)
 
     start = datetime.datetime.utcnow()
     now = lambda: start
@@ -1147,6 +1492,90 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     found_etas = [t['eta'] for t in tasks]
     self.assertEquals(etas, found_etas)
 
+  def testSharePayload(self):
+    """Tests that large payloads are stored once for all events."""
+    self.header_footer = 'x' * main.MIN_SHARED_PAYLOAD_BYTES
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ARBITRARY, 'text/plain', self.header_footer, [])
+    event.share_payload()
+    event.put()
+    self.assertEquals(self.header_footer, event.get_payload())
+
+    other_event = EventToDeliver.create_event_for_topic(
+        self.topic + '/alias', main.ARBITRARY, 'text/plain',
+        self.header_footer, [])
+    other_event.share_payload()
+    other_event.put()
+
+    self.assertEquals(1, len(list(main.EventPayload.all())))
+    event = EventToDeliver.get(event.key())
+    other_event = EventToDeliver.get(other_event.key())
+    self.assertFalse(hasattr(event, 'payload'))
+    self.assertEquals(event.payload_hash, other_event.payload_hash)
+    self.assertEquals(self.header_footer, event.get_payload())
+    self.assertEquals(self.header_footer, other_event.get_payload())
+
+    # Payloads that have been cleaned up are reported as missing.
+    db.delete(main.EventPayload.all())
+    event = EventToDeliver.get(event.key())
+    self.assertEquals(None, event.get_payload())
+
+  def testSharePayload_small(self):
+    """Tests that small payloads stay inside the event."""
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads)
+    event.share_payload()
+    event.put()
+    event = EventToDeliver.get(event.key())
+    self.assertEquals(None, event.payload_hash)
+    self.assertEquals(event.payload, event.get_payload())
+    self.assertEquals([], list(main.EventPayload.all()))
+
+  def testCompressedPayload(self):
+    """Tests that large payloads are stored compressed."""
+    self.test_payloads = [
+        '<entry>article%d</entry>' % i
+        for i in xrange(main.MIN_COMPRESSED_PAYLOAD_BYTES / 10)]
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads)
+    event.put()
+    self.assertEquals(main.ZLIB_PAYLOAD, event.payload_encoding)
+
+    event = EventToDeliver.get(event.key())
+    payload = event.get_payload()
+    self.assertTrue(len(event.payload) < len(payload))
+    self.assertTrue('\n'.join(self.test_payloads) in payload)
+    self.assertTrue(payload is event.get_payload())
+
+  def testUncompressedPayload(self):
+    """Tests payloads stored without an encoding marker."""
+    self.test_payloads = ['<entry>%s</entry>' % ('x' * 5000)]
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads)
+    expected_data = event.get_payload()
+    event.payload = db.Blob(expected_data)
+    event.payload_encoding = None
+    event.put()
+    event = EventToDeliver.get(event.key())
+    self.assertEquals(expected_data, event.get_payload())
+
+  def testCompressionCorpus(self):
+    """Tests compressing the feed test corpus; see payload_benchmark.py."""
+    testdata = os.path.join(os.path.dirname(__file__), 'feed_diff_testdata')
+    total_raw = 0
+    total_stored = 0
+    for name in sorted(os.listdir(testdata)):
+      # Repeat each document to get event sizes over the threshold.
+      data = open(os.path.join(testdata, name)).read() * 20
+      stored, encoding = main.encode_payload(data)
+      self.assertEquals(data, main.decode_payload(stored, encoding))
+      total_raw += len(data)
+      total_stored += len(stored)
+    self.assertTrue(total_stored < total_raw)
+
   def testQueuePreserved(self):
     """Tests that enqueueing an EventToDeliver preserves the polling queue."""
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
@@ -1186,9 +1615,149 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     event2 = db.get(event.key())
     self.assertFalse(event2.totally_failed)
 
-    event2.update(False, [])
-    event3 = db.get(event.key())
-    self.assertTrue(event3.totally_failed)
+    retry = DeliveryRetry.all().ancestor(event.key()).get()
+    self.assertEquals(1, retry.max_failures)
+    self.assertFalse(retry.retry_failed())
+
+  def testMaxFailuresZero(self):
+    """Tests that no retries are scheduled when no failures are allowed."""
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads,
+        max_failures=0)
+    Subscription.insert(
+        self.callback, self.topic, self.token, self.secret)
+    subscription_list = list(Subscription.all())
+
+    event.put()
+    event.update(False, subscription_list)
+    event2 = db.get(event.key())
+    self.assertTrue(event2.totally_failed)
+    self.assertEquals([], list(DeliveryRetry.all()))
+
+################################################################################
+
+class DeliveryRetryTest(unittest.TestCase):
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.topic = 'http://example.com/my-topic'
+    self.callback = 'http://example.com/my-callback'
+    self.start = datetime.datetime(2010, 1, 1, 12, 0, 0)
+    self.now = lambda: self.start
+    Subscription.insert(self.callback, self.topic, 'token', 'secret')
+    self.sub = Subscription.all().get()
+    self.event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ARBITRARY, 'text/plain', 'my data', [])
+    self.event.put()
+
+  def testCreate(self):
+    """Tests creating a retry for a failed subscription."""
+    retry = DeliveryRetry.create(self.event, self.sub, retry_period=5,
+                                 now=self.now, getrandom=lambda: 0)
+    self.assertEquals(self.event.key(), retry.event_key)
+    self.assertEquals(self.sub.key(), retry.subscription_key)
+    self.assertEquals(self.sub.key().name(), retry.key().name())
+    self.assertEquals(self.callback, retry.callback)
+    self.assertEquals(0, retry.attempts)
+    self.assertEquals(self.start + datetime.timedelta(seconds=5),
+                      retry.next_attempt)
+
+  def testJitter(self):
+    """Tests that random jitter is added to the backoff period."""
+    retry = DeliveryRetry.create(self.event, self.sub, retry_period=8,
+                                 now=self.now, getrandom=lambda: 1)
+    self.assertEquals(
+        self.start + datetime.timedelta(
+            seconds=8 * (1 + main.DELIVERY_RETRY_JITTER)),
+        retry.next_attempt)
+
+  def testBackoffAndGiveUp(self):
+    """Tests exponential backoff until we finally give up."""
+    retry = DeliveryRetry.create(self.event, self.sub, max_failures=4,
+                                 retry_period=5, now=self.now,
+                                 getrandom=lambda: 0)
+    for delay in (10, 20, 40):
+      self.assertTrue(retry.retry_failed(
+          retry_period=5, now=self.now, getrandom=lambda: 0))
+      self.assertEquals(self.start + datetime.timedelta(seconds=delay),
+                        retry.next_attempt)
+    self.assertFalse(retry.retry_failed(
+        retry_period=5, now=self.now, getrandom=lambda: 0))
+    self.assertEquals(4, retry.attempts)
+
+  def testPostpone(self):
+    """Tests that postponing does not count as a failed attempt."""
+    retry = DeliveryRetry.create(self.event, self.sub, retry_period=5,
+                                 now=self.now, getrandom=lambda: 0)
+    retry.postpone(retry_period=7, now=self.now, getrandom=lambda: 0)
+    self.assertEquals(0, retry.attempts)
+    self.assertEquals(self.start + datetime.timedelta(seconds=7),
+                      retry.next_attempt)
+
+  def testGetDue(self):
+    """Tests retrieving retries that are due in order of their next attempt."""
+    Subscription.insert('http://example.com/other-callback', self.topic,
+                        'token', 'secret')
+    sub2 = Subscription.get_by_key_name(Subscription.create_key_name(
+        'http://example.com/other-callback', self.topic))
+    retry1 = DeliveryRetry.create(self.event, self.sub, retry_period=10,
+                                  now=self.now, getrandom=lambda: 0)
+    retry2 = DeliveryRetry.create(self.event, sub2, retry_period=5,
+                                  now=self.now, getrandom=lambda: 0)
+    db.put([retry1, retry2])
+
+    self.assertEquals([], DeliveryRetry.get_due(10, now=self.now))
+    later = lambda: self.start + datetime.timedelta(seconds=5)
+    self.assertEquals([retry2.key()],
+                      [r.key() for r in DeliveryRetry.get_due(10, now=later)])
+    later = lambda: self.start + datetime.timedelta(seconds=60)
+    self.assertEquals([retry2.key(), retry1.key()],
+                      [r.key() for r in DeliveryRetry.get_due(10, now=later)])
+    self.assertEquals([retry2.key()],
+                      [r.key() for r in DeliveryRetry.get_due(1, now=later)])
+
+  def testHasPending(self):
+    """Tests checking if an event has pending retries."""
+    self.assertFalse(DeliveryRetry.has_pending(self.event.key()))
+    DeliveryRetry.create(self.event, self.sub, now=self.now).put()
+    self.assertTrue(DeliveryRetry.has_pending(self.event.key()))
+
+################################################################################
+
+class ForkJoinStatsTest(unittest.TestCase):
+  """Tests for sampling fork-join queue metrics."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    # Drop metrics reported by earlier tests.
+    main._fork_join_reporter = dos.Reporter()
+    self.topic = 'http://example.com/topic-one'
+    self.queue_name = FeedToFetch.FORK_JOIN_QUEUE.name
+
+  def testSample(self):
+    """Tests that queue metrics are sampled at the end of a request."""
+    FeedToFetch.insert([self.topic])
+    task = testutil.get_tasks(main.FEED_QUEUE, index=0, expected_count=1)
+    FeedToFetch.FORK_JOIN_QUEUE.pop(task['name'])
+    main.sample_fork_join_stats()
+    # Metrics are only sampled once.
+    main.sample_fork_join_stats()
+
+    result = main.FORK_JOIN_SAMPLER.get(main.FORK_JOIN_SAMPLE_MINUTE)
+    for event, value in (('acquire_attempts', 1),
+                         ('acquire_sleep_ms', 0),
+                         ('batch_size', 1),
+                         ('generation', 0)):
+      key = '%s %s' % (self.queue_name, event)
+      self.assertEquals(1, result.get_count(key), key)
+      self.assertEquals(value, result.get_max(key), key)
+    self.assertEquals(
+        0, result.get_count('%s empty_pop' % self.queue_name))
+    self.assertEquals(
+        1, result.get_count('%s writer_wait_ms' % self.queue_name))
 
 ################################################################################
 
@@ -1727,6 +2296,21 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
 
     self.assertEquals([(1, 0)], main.FETCH_SCORER.get_scores([self.topic]))
 
+  def testRequestCache(self):
+    """Tests that feed records and stats are read in a single batch."""
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect('get', self.topic, 304, '')
+    request_cache.install()
+    request_cache.start()
+    try:
+      self.run_fetch_task()
+      stats = request_cache.get_stats()
+    finally:
+      request_cache.stop()
+    key_count = 2 + main.SUBSCRIBER_COUNT_SHARDS
+    self.assertEquals(key_count, stats['misses'])
+    self.assertEquals(key_count, stats['hits'])
+
   def testStatsUserAgent(self):
     """Tests that the user agent string includes feed stats."""
     info = FeedRecord.get_or_create(self.topic)
@@ -1737,9 +2321,10 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
       key=KnownFeedStats.create_key(self.topic),
       subscriber_count=123).put()
 
+    # Includes the subscription inserted by setUp.
     request_headers = {
       'User-Agent':
-          'Public Hub (+http://pubsubhubbub.appspot.com; 123 subscribers)',
+          'Public Hub (+http://pubsubhubbub.appspot.com; 124 subscribers)',
     }
 
     FeedToFetch.insert([self.topic])
@@ -1980,7 +2565,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     work = EventToDeliver.all().get()
     event_key = work.key()
     self.assertEquals(self.topic, work.topic)
-    self.assertTrue('\n'.join(self.entry_payloads) in work.payload)
+    self.assertTrue('\n'.join(self.entry_payloads) in work.get_payload())
     work.delete()
 
     record = FeedRecord.get_or_create(self.topic)
@@ -2017,15 +2602,19 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     old_splitting_attempts = main.PUT_SPLITTING_ATTEMPTS
     old_max_saves = main.MAX_FEED_RECORD_SAVES
     old_max_new = main.MAX_NEW_FEED_ENTRY_RECORDS
+    old_min_compressed = main.MIN_COMPRESSED_PAYLOAD_BYTES
     main.PUT_SPLITTING_ATTEMPTS = 1
     main.MAX_FEED_RECORD_SAVES = len(self.entry_list) + 1
     main.MAX_NEW_FEED_ENTRY_RECORDS = main.MAX_FEED_RECORD_SAVES
+    # This repetitive content would easily fit once compressed.
+    main.MIN_COMPRESSED_PAYLOAD_BYTES = sys.maxint
     try:
       self.run_fetch_task()
     finally:
       main.PUT_SPLITTING_ATTEMPTS = old_splitting_attempts
       main.MAX_FEED_RECORD_SAVES = old_max_saves
       main.MAX_NEW_FEED_ENTRY_RECORDS = old_max_new
+      main.MIN_COMPRESSED_PAYLOAD_BYTES = old_min_compressed
 
     # Verify that *NO* FeedEntryRecords or EventToDeliver has been written,
     # the FeedRecord wasn't updated, and no tasks were enqueued.
@@ -2438,6 +3027,33 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
         main.DELIVERY_SCORER.get_scores(
             [self.callback1, self.callback2, self.callback3]))
 
+  def testSharedPayload(self):
+    """Tests delivering an event whose payload is stored separately."""
+    self.assertTrue(Subscription.insert(
+        self.callback1, self.topic, 'token', 'secret'))
+    payload = 'x' * main.MIN_SHARED_PAYLOAD_BYTES
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload=payload)
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ARBITRARY, 'text/plain', payload, [])
+    event.share_payload()
+    event.put()
+    self.handle('post', ('event_key', str(event.key())))
+    self.assertEquals([], list(EventToDeliver.all()))
+
+  def testSharedPayloadExpired(self):
+    """Tests delivering an event whose shared payload is gone."""
+    self.assertTrue(Subscription.insert(
+        self.callback1, self.topic, 'token', 'secret'))
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ARBITRARY, 'text/plain',
+        'x' * main.MIN_SHARED_PAYLOAD_BYTES, [])
+    event.share_payload()
+    event.put()
+    db.delete(main.EventPayload.all())
+    self.handle('post', ('event_key', str(event.key())))
+    self.assertTrue(EventToDeliver.get(event.key()).totally_failed)
+
   def testHmacData(self):
     """Tests that the content is properly signed with an HMAC."""
     self.assertTrue(Subscription.insert(
@@ -2576,15 +3192,16 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
             [self.callback1, self.callback2, self.callback3]))
 
     work = EventToDeliver.all().get()
-    sub_list = Subscription.get(work.failed_callbacks)
-    callback_list = [sub.callback for sub in sub_list]
+    self.assertEquals(EventToDeliver.SCHEDULED, work.delivery_mode)
+    self.assertEquals([], work.failed_callbacks)
+    callback_list = sorted(
+        r.callback for r in DeliveryRetry.all().ancestor(work.key()))
     self.assertEquals([self.callback1, self.callback2, self.callback3],
                       callback_list)
 
     tasks = testutil.get_tasks(main.EVENT_QUEUE, expected_count=1)
-    tasks.extend(testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=1))
-    self.assertEquals([event_key] * 2,
-                      [t['params']['event_key'] for t in tasks])
+    self.assertEquals([event_key], [t['params']['event_key'] for t in tasks])
+    testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=0)
 
   def testDeadlineError(self):
     """Tests that callbacks in flight at deadline will be marked as failed."""
@@ -2610,8 +3227,8 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
       # All events should be marked as failed even though no urlfetches
       # were made.
       work = EventToDeliver.all().get()
-      sub_list = Subscription.get(work.failed_callbacks)
-      callback_list = [sub.callback for sub in sub_list]
+      callback_list = sorted(
+          r.callback for r in DeliveryRetry.all().ancestor(work.key()))
       self.assertEquals([self.callback1, self.callback2], callback_list)
 
       self.assertEquals(event_key, testutil.get_tasks(
@@ -2672,14 +3289,21 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
         main.DELIVERY_SCORER.get_scores(
             [self.callback1, self.callback2, self.callback3, self.callback4]))
 
-    # Now the retries.
+    # Now the retries, which are attempted by the retry worker.
+    work = EventToDeliver.get(event_key)
+    self.assertEquals(EventToDeliver.SCHEDULED, work.delivery_mode)
+    self.assertEquals(3, len(list(DeliveryRetry.all())))
+    later = [datetime.datetime.utcnow() + datetime.timedelta(days=1)]
+    self.handler_class = lambda: main.DeliveryRetryHandler(
+        now=lambda: later[0])
+
     urlfetch_test_stub.instance.expect(
         'post', self.callback1, 404, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
         'post', self.callback3, 302, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
         'post', self.callback4, 500, '', request_payload=self.expected_payload)
-    self.handle('post', ('event_key', event_key))
+    self.handle('post', ('sequence', 'testing'))
     urlfetch_test_stub.instance.verify_and_reset()
 
     self.assertEquals(
@@ -2687,23 +3311,27 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
         main.DELIVERY_SCORER.get_scores(
             [self.callback1, self.callback2, self.callback3, self.callback4]))
 
+    later[0] += datetime.timedelta(days=1)
     urlfetch_test_stub.instance.expect(
         'post', self.callback1, 204, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
         'post', self.callback3, 302, '', request_payload=self.expected_payload)
     urlfetch_test_stub.instance.expect(
         'post', self.callback4, 200, '', request_payload=self.expected_payload)
-    self.handle('post', ('event_key', event_key))
+    self.handle('post', ('sequence', 'testing'))
     urlfetch_test_stub.instance.verify_and_reset()
 
     self.assertEquals(
         [(1, 2), (1, 0), (0, 3), (1, 2)],
         main.DELIVERY_SCORER.get_scores(
             [self.callback1, self.callback2, self.callback3, self.callback4]))
+    self.assertEquals([self.callback3],
+                      [r.callback for r in DeliveryRetry.all()])
 
+    later[0] += datetime.timedelta(days=1)
     urlfetch_test_stub.instance.expect(
         'post', self.callback3, 204, '', request_payload=self.expected_payload)
-    self.handle('post', ('event_key', event_key))
+    self.handle('post', ('sequence', 'testing'))
     urlfetch_test_stub.instance.verify_and_reset()
 
     self.assertEquals(
@@ -2712,10 +3340,23 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
             [self.callback1, self.callback2, self.callback3, self.callback4]))
 
     self.assertEquals([], list(EventToDeliver.all()))
+    self.assertEquals([], list(DeliveryRetry.all()))
     tasks = testutil.get_tasks(main.EVENT_QUEUE, expected_count=1)
-    tasks.extend(testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=3))
-    self.assertEquals([event_key] * 4,
-                      [t['params']['event_key'] for t in tasks])
+    self.assertEquals([event_key], [t['params']['event_key'] for t in tasks])
+    testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=0)
+
+  def testScheduledEventSkipped(self):
+    """Tests that events handed off to the retry worker are not re-pushed."""
+    self.assertTrue(Subscription.insert(
+        self.callback1, self.topic, 'token', 'secret'))
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads)
+    event.delivery_mode = EventToDeliver.SCHEDULED
+    event.put()
+    self.handle('post', ('event_key', str(event.key())))
+    self.assertEquals(event.key(), EventToDeliver.all().get().key())
+    testutil.get_tasks(main.EVENT_QUEUE, expected_count=0)
 
   def testUrlFetchFailure(self):
     """Tests the UrlFetch API raising exceptions while sending notifications."""
@@ -2740,13 +3381,11 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
     urlfetch_test_stub.instance.verify_and_reset()
 
     work = EventToDeliver.all().get()
-    sub_list = Subscription.get(work.failed_callbacks)
-    callback_list = [sub.callback for sub in sub_list]
+    self.assertEquals(EventToDeliver.SCHEDULED, work.delivery_mode)
+    callback_list = sorted(
+        r.callback for r in DeliveryRetry.all().ancestor(work.key()))
     self.assertEquals([self.callback1, self.callback2], callback_list)
-
-    self.assertEquals(event_key, testutil.get_tasks(
-        main.EVENT_RETRIES_QUEUE, index=0, expected_count=1)
-        ['params']['event_key'])
+    testutil.get_tasks(main.EVENT_RETRIES_QUEUE, expected_count=0)
 
     self.assertEquals(
         [(0, 1), (0, 1)],
@@ -2778,9 +3417,17 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
           self.header_footer, self.test_payloads)
       event.put()
       self.handle('post', ('event_key', str(event.key())))
-      self.assertEquals([], list(EventToDeliver.all()))
       testutil.get_tasks(main.EVENT_QUEUE, expected_count=0)
 
+      # The blocked delivery is parked for later instead of being dropped.
+      work = EventToDeliver.all().get()
+      self.assertEquals(EventToDeliver.SCHEDULED, work.delivery_mode)
+      self.assertEquals([self.callback2],
+                        [r.callback for r in DeliveryRetry.all()])
+      self.assertEquals(
+          [dos.CircuitBreaker.CLOSED, dos.CircuitBreaker.OPEN],
+          main.DELIVERY_SCORER.get_states([self.callback1, self.callback2]))
+
       self.assertEquals(
           [(1, 0)] + start_scores + [(1, 0)],
           main.DELIVERY_SCORER.get_scores(
@@ -2788,6 +3435,149 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
     finally:
       dos.DISABLE_FOR_TESTING = True
 
+class DeliveryRetryHandlerTest(testutil.HandlerTestBase):
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.HandlerTestBase.setUp(self)
+    self.start = datetime.datetime(2010, 1, 1, 12, 0, 0)
+    self.now = [self.start]
+    self.handler_class = lambda: main.DeliveryRetryHandler(
+        now=lambda: self.now[0])
+    self.chunk_size = main.DELIVERY_RETRY_CHUNK_SIZE
+    self.topic = 'http://example.com/hamster-topic'
+    self.callback1 = 'http://example1.com/hamster-callback1'
+    self.callback2 = 'http://example2.com/hamster-callback2'
+    self.assertTrue(Subscription.insert(
+        self.callback1, self.topic, 'token', 'secret'))
+    self.assertTrue(Subscription.insert(
+        self.callback2, self.topic, 'token', 'secret'))
+    self.sub1 = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback1, self.topic))
+    self.sub2 = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback2, self.topic))
+    self.event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ARBITRARY, 'text/plain', 'my data', [])
+    self.event.delivery_mode = EventToDeliver.SCHEDULED
+    self.event.put()
+
+  def tearDown(self):
+    """Resets any external modules modified for testing."""
+    main.DELIVERY_RETRY_CHUNK_SIZE = self.chunk_size
+    urlfetch_test_stub.instance.verify_and_reset()
+
+  def schedule(self, *subs, **kwargs):
+    """Stores a DeliveryRetry for each Subscription that is due right away."""
+    retry_list = [
+        DeliveryRetry.create(self.event, sub, now=lambda: self.start,
+                             getrandom=lambda: 0, **kwargs)
+        for sub in subs]
+    db.put(retry_list)
+    self.now[0] = self.start + datetime.timedelta(days=1)
+    return retry_list
+
+  def testCronStartsTask(self):
+    """Tests that the cron handler enqueues a single retry worker task."""
+    os.environ['HTTP_X_APPENGINE_QUEUENAME'] = main.POLLING_QUEUE
+    try:
+      self.handle('get')
+      self.handle('get')
+    finally:
+      del os.environ['HTTP_X_APPENGINE_QUEUENAME']
+    task = testutil.get_tasks(main.EVENT_RETRIES_QUEUE,
+                              index=0, expected_count=1)
+    self.assertTrue(task['name'].startswith('retry-deliveries-'))
+    self.assertEquals(task['name'], task['params']['sequence'])
+
+  def testNoneDue(self):
+    """Tests when no retries are due yet."""
+    self.schedule(self.sub1)
+    self.now[0] = self.start
+    self.handle('post', ('sequence', 'testing'))
+    self.assertEquals(1, len(list(DeliveryRetry.all())))
+
+  def testAllSuccessful(self):
+    """Tests that successful retries clean up the retries and the event."""
+    self.schedule(self.sub1, self.sub2)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload='my data',
+        request_headers={'Content-Type': 'text/plain'})
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback2, 200, '', request_payload='my data')
+    self.handle('post', ('sequence', 'testing'))
+    self.assertEquals([], list(DeliveryRetry.all()))
+    self.assertEquals([], list(EventToDeliver.all()))
+
+  def testGiveUp(self):
+    """Tests that exhausted retries mark the event as totally failed."""
+    self.schedule(self.sub1, max_failures=1)
+    self.schedule(self.sub2)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 500, '', request_payload='my data')
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback2, 500, '', request_payload='my data')
+    self.handle('post', ('sequence', 'testing'))
+
+    self.assertEquals([self.callback2],
+                      [r.callback for r in DeliveryRetry.all()])
+    retry = DeliveryRetry.all().get()
+    self.assertEquals(1, retry.attempts)
+    self.assertTrue(retry.next_attempt > self.now[0])
+    event = EventToDeliver.get(self.event.key())
+    self.assertTrue(event.totally_failed)
+
+    urlfetch_test_stub.instance.verify_and_reset()
+    self.now[0] += datetime.timedelta(days=1)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback2, 200, '', request_payload='my data')
+    self.handle('post', ('sequence', 'testing'))
+    self.assertEquals([], list(DeliveryRetry.all()))
+    event = EventToDeliver.get(self.event.key())
+    self.assertTrue(event.totally_failed)
+
+  def testSubscriptionRemoved(self):
+    """Tests that retries for removed subscriptions are dropped."""
+    self.schedule(self.sub1, self.sub2)
+    self.assertTrue(Subscription.remove(self.callback2, self.topic))
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload='my data')
+    self.handle('post', ('sequence', 'testing'))
+    self.assertEquals([], list(DeliveryRetry.all()))
+    self.assertEquals([], list(EventToDeliver.all()))
+
+  def testContinuation(self):
+    """Tests that a full chunk of due retries enqueues another task."""
+    main.DELIVERY_RETRY_CHUNK_SIZE = 1
+    self.schedule(self.sub1, self.sub2)
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback1, 204, '', request_payload='my data')
+    self.handle('post', ('sequence', 'testing'))
+    task = testutil.get_tasks(main.EVENT_RETRIES_QUEUE,
+                              index=0, expected_count=1)
+    self.assertEquals('testing', task['params']['sequence'])
+    self.assertTrue(task['params']['cursor'])
+    self.assertEquals([self.callback2],
+                      [r.callback for r in DeliveryRetry.all()])
+
+    # The continuation resumes after the chunk that was already attempted.
+    urlfetch_test_stub.instance.expect(
+        'post', self.callback2, 204, '', request_payload='my data')
+    self.handle('post', *task['params'].items())
+    self.assertEquals([], list(DeliveryRetry.all()))
+
+  def testNotAllowed(self):
+    """Tests that blocked callbacks are postponed without a failure."""
+    dos.DISABLE_FOR_TESTING = False
+    try:
+      main.DELIVERY_SCORER.blackhole([self.callback1])
+      self.schedule(self.sub1)
+      self.handle('post', ('sequence', 'testing'))
+      retry = DeliveryRetry.all().get()
+      self.assertEquals(0, retry.attempts)
+      self.assertTrue(retry.next_attempt > self.now[0])
+    finally:
+      dos.DISABLE_FOR_TESTING = True
+
 ################################################################################
 
 class SubscribeHandlerTest(testutil.HandlerTestBase):
@@ -3381,6 +4171,193 @@ class SubscribeHandlerThroughHubUrlTest(SubscribeHandlerTest):
 
   handler_class = main.HubHandler
 
+
+class BulkSubscribeHandlerTest(testutil.HandlerTestBase):
+
+  handler_class = main.BulkSubscribeHandler
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.HandlerTestBase.setUp(self)
+    self.callback = 'http://example.com/good-callback'
+    self.callback2 = 'http://example.com/second-callback'
+    self.topic = 'http://example.com/the-topic'
+    self.topic2 = 'http://example.com/second-topic'
+    self.verify_token = 'the_token'
+    self.old_chunk_size = main.BULK_SUBSCRIBE_CHUNK_SIZE
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    testutil.HandlerTestBase.tearDown(self)
+    main.BULK_SUBSCRIBE_CHUNK_SIZE = self.old_chunk_size
+
+  def make_item(self, callback, topic, mode='subscribe', **kwargs):
+    """Returns a 'hub.subscription' parameter for one request."""
+    params = [('hub.mode', mode),
+              ('hub.callback', callback),
+              ('hub.topic', topic),
+              ('hub.verify_token', self.verify_token)]
+    params.extend(('hub.' + k, v) for k, v in kwargs.iteritems())
+    return ('hub.subscription', urllib.urlencode(params))
+
+  def response_lines(self):
+    """Returns the per-request status lines of the response."""
+    return self.response_body().splitlines()
+
+  def testNoRequests(self):
+    """Tests a bulk request without any subscription requests."""
+    self.handle('post', ('hub.mode', 'subscribe'))
+    self.assertEquals(400, self.response_code())
+    self.assertTrue('hub.subscription' in self.response_body())
+
+  def testTooManyRequests(self):
+    """Tests a bulk request with too many subscription requests."""
+    items = [self.make_item(self.callback, self.topic + str(i))
+             for i in xrange(main.MAX_BULK_SUBSCRIBE_REQUESTS + 1)]
+    self.handle('post', *items)
+    self.assertEquals(400, self.response_code())
+    testutil.get_tasks(main.SUBSCRIPTION_QUEUE, expected_count=0)
+
+  def testSubscribe(self):
+    """Tests subscribing many callbacks in one request."""
+    self.assertTrue(Subscription.insert(
+        self.callback2, self.topic, 'old_token', 'old_secret'))
+    self.handle('post',
+        self.make_item(self.callback, self.topic, secret='my secret',
+                       lease_seconds='7200'),
+        self.make_item(self.callback2, self.topic),
+        self.make_item(self.callback, self.topic2))
+    self.assertEquals(200, self.response_code())
+    self.assertEquals(['202 Queued for verification'] * 3,
+                      self.response_lines())
+
+    sub = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback, self.topic))
+    self.assertEquals(Subscription.STATE_NOT_VERIFIED, sub.subscription_state)
+    self.assertEquals(7200, sub.lease_seconds)
+    self.assertEquals('my secret', sub.secret)
+
+    # Existing subscriptions stay verified until they are reconfirmed.
+    sub2 = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback2, self.topic))
+    self.assertEquals(Subscription.STATE_VERIFIED, sub2.subscription_state)
+
+    # All confirmations are verified by a single fork-join task.
+    testutil.get_tasks(main.SUBSCRIPTION_QUEUE, expected_count=1)
+    work_map = dict((w.subscription_key.name(), w)
+                    for w in SubscriptionToConfirm.all())
+    self.assertEquals(
+        set([Subscription.create_key_name(self.callback, self.topic),
+             Subscription.create_key_name(self.callback2, self.topic),
+             Subscription.create_key_name(self.callback, self.topic2)]),
+        set(work_map))
+    self.assertEquals(
+        set([Subscription.STATE_VERIFIED]),
+        set(w.next_state for w in work_map.itervalues()))
+    self.assertEquals('my secret', work_map[sub.key().name()].secret)
+    self.assertEquals(self.verify_token,
+                      work_map[sub2.key().name()].verify_token)
+
+  def testCallbackRateLimit(self):
+    """Tests that requests count against the per-callback rate limit."""
+    limit = main.SUBSCRIBE_CALLBACK_LIMIT
+    items = [self.make_item(self.callback, self.topic + str(i))
+             for i in xrange(limit + 2)]
+    items.append(self.make_item(self.callback2, self.topic))
+    old_remote_addr = os.environ.get('REMOTE_ADDR')
+    os.environ['REMOTE_ADDR'] = '10.1.1.1'
+    dos.DISABLE_FOR_TESTING = False
+    try:
+      self.handle('post', *items)
+    finally:
+      dos.DISABLE_FOR_TESTING = True
+      if old_remote_addr is None:
+        del os.environ['REMOTE_ADDR']
+      else:
+        os.environ['REMOTE_ADDR'] = old_remote_addr
+
+    lines = self.response_lines()
+    self.assertEquals(['202 Queued for verification'] * limit, lines[:limit])
+    self.assertEquals(
+        ['503 Too many requests for hub.callback; try again later'] * 2,
+        lines[limit:-1])
+    self.assertEquals('202 Queued for verification', lines[-1])
+    self.assertEquals(limit + 1, SubscriptionToConfirm.all().count())
+
+  def testUnsubscribe(self):
+    """Tests unsubscribing existing and missing subscriptions."""
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.verify_token, 'secret'))
+    self.handle('post',
+        self.make_item(self.callback, self.topic, mode='unsubscribe'),
+        self.make_item(self.callback2, self.topic, mode='unsubscribe'))
+    self.assertEquals(
+        ['202 Queued for verification', '204 No such subscription'],
+        self.response_lines())
+    self.assertTrue(Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback2, self.topic)) is None)
+    self.assertEquals([Subscription.STATE_TO_DELETE],
+                      [w.next_state for w in SubscriptionToConfirm.all()])
+
+  def testInvalidRequests(self):
+    """Tests that invalid requests do not affect the valid ones."""
+    self.handle('post',
+        self.make_item(self.callback, self.topic),
+        self.make_item(self.callback, self.topic, mode='bad'),
+        self.make_item('httpf://example.com', self.topic),
+        self.make_item(self.callback2, self.topic, verify='sync'),
+        self.make_item(self.callback, self.topic),
+        self.make_item(self.callback, self.topic2, lease_seconds='1x'),
+        ('hub.subscription', 'hub.callback=%FF'))
+    lines = self.response_lines()
+    self.assertEquals(7, len(lines))
+    self.assertEquals('202 Queued for verification', lines[0])
+    self.assertTrue(lines[1].startswith('400 Invalid value for hub.mode'))
+    self.assertTrue(lines[2].startswith('400 Invalid parameter: hub.callback'))
+    self.assertEquals('400 Bulk requests only support hub.verify=async',
+                      lines[3])
+    self.assertEquals(
+        '400 Duplicate request for hub.callback and hub.topic', lines[4])
+    self.assertTrue(
+        lines[5].startswith('400 Invalid value for hub.lease_seconds'))
+    self.assertTrue(lines[6].startswith('400 Invalid parameter encoding'))
+    testutil.get_tasks(main.SUBSCRIPTION_QUEUE, expected_count=1)
+
+  def testChunks(self):
+    """Tests that requests are written and enqueued in chunks."""
+    main.BULK_SUBSCRIBE_CHUNK_SIZE = 2
+    items = [self.make_item(self.callback, self.topic + str(i))
+             for i in xrange(5)]
+    self.handle('post', *items)
+    self.assertEquals(['202 Queued for verification'] * 5,
+                      self.response_lines())
+    self.assertEquals(5, SubscriptionToConfirm.all().count())
+    self.assertEquals(5, Subscription.all().count())
+
+  def testChunkFails(self):
+    """Tests that a failed chunk is reported without failing the others."""
+    main.BULK_SUBSCRIBE_CHUNK_SIZE = 2
+    calls = []
+    old_put = db.put
+    def bad_put(*args, **kwargs):
+      calls.append(1)
+      if len(calls) == 2:
+        raise db.Timeout('Second chunk fails')
+      return old_put(*args, **kwargs)
+    db.put = bad_put
+    try:
+      items = [self.make_item(self.callback, self.topic + str(i))
+               for i in xrange(5)]
+      self.handle('post', *items)
+    finally:
+      db.put = old_put
+    self.assertEquals(
+        ['202 Queued for verification'] * 2 +
+        ['503 Could not record request; try again later'] * 2 +
+        ['202 Queued for verification'],
+        self.response_lines())
+    self.assertEquals(3, SubscriptionToConfirm.all().count())
+
 ################################################################################
 
 class SubscriptionConfirmHandlerTest(testutil.HandlerTestBase):
@@ -3413,16 +4390,15 @@ class SubscriptionConfirmHandlerTest(testutil.HandlerTestBase):
     urlfetch_test_stub.instance.verify_and_reset()
 
   def verify_task(self, next_state):
-    """Verifies that a subscription worker task is present.
+    """Verifies that a subscription confirmation is enqueued.
 
     Args:
       next_state: The next state the task should cause the Subscription to have.
     """
-    task = testutil.get_tasks(main.SUBSCRIPTION_QUEUE,
-                              index=0, expected_count=1)
-    params = task['params']
-    self.assertEquals(self.sub_key, params['subscription_key_name'])
-    self.assertEquals(next_state, params['next_state'])
+    testutil.get_tasks(main.SUBSCRIPTION_QUEUE, index=0, expected_count=1)
+    work = SubscriptionToConfirm.all().get()
+    self.assertEquals(self.sub_key, work.subscription_key.name())
+    self.assertEquals(next_state, work.next_state)
 
   def verify_retry_task(self,
                         eta,
@@ -3464,6 +4440,99 @@ class SubscriptionConfirmHandlerTest(testutil.HandlerTestBase):
     self.handle('post', ('subscription_key_name', 'unknown'),
                         ('next_state', Subscription.STATE_VERIFIED))
 
+  def run_batch_task(self):
+    """Runs the enqueued fork-join confirmation task."""
+    task = testutil.get_tasks(main.SUBSCRIPTION_QUEUE, index=0)
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = task['name']
+    try:
+      self.handle('post')
+    finally:
+      del os.environ['HTTP_X_APPENGINE_TASKNAME']
+
+  def testBatchConfirmation(self):
+    """Tests verifying many confirmations with a single fork-join task."""
+    callback2 = 'http://example.com/second-callback'
+    callback3 = 'http://example.com/third-callback'
+    callback4 = 'http://example.com/fourth-callback'
+    self.assertTrue(Subscription.insert(
+        callback2, self.topic, self.verify_token, self.secret))
+    for callback in (self.callback, callback3, callback4):
+      self.assertTrue(Subscription.request_insert(
+          callback, self.topic, self.verify_token, self.secret))
+    self.assertTrue(Subscription.request_remove(
+        callback2, self.topic, self.verify_token))
+    self.assertEquals(4, SubscriptionToConfirm.all().count())
+
+    def confirm_url(mode, callback):
+      return main.create_confirm_url(
+          mode, self.topic, callback, self.verify_token, self.challenge,
+          main.DEFAULT_LEASE_SECONDS)
+    urlfetch_test_stub.instance.expect(
+        'get', self.verify_callback_querystring_template % 'subscribe', 200,
+        self.challenge)
+    urlfetch_test_stub.instance.expect(
+        'get', confirm_url('unsubscribe', callback2), 200, self.challenge)
+    urlfetch_test_stub.instance.expect(
+        'get', confirm_url('subscribe', callback3), 404, '')
+    urlfetch_test_stub.instance.expect(
+        'get', confirm_url('subscribe', callback4), 500, '')
+    self.run_batch_task()
+
+    def get_sub(callback):
+      return Subscription.get_by_key_name(
+          Subscription.create_key_name(callback, self.topic))
+    sub = get_sub(self.callback)
+    self.assertEquals(Subscription.STATE_VERIFIED, sub.subscription_state)
+    self.assertEquals(self.verify_token, sub.verify_token)
+    self.assertEquals(self.secret, sub.secret)
+    self.assertTrue(get_sub(callback2) is None)
+    self.assertEquals(Subscription.STATE_TO_DELETE,
+                      get_sub(callback3).subscription_state)
+    sub4 = get_sub(callback4)
+    self.assertEquals(Subscription.STATE_NOT_VERIFIED, sub4.subscription_state)
+    self.assertEquals(1, sub4.confirm_failures)
+    self.assertEquals(0, SubscriptionToConfirm.all().count())
+    self.verify_no_record_task()
+
+    # Failures are retried one Subscription at a time.
+    task = testutil.get_tasks(main.SUBSCRIPTION_QUEUE,
+                              index=1, expected_count=2)
+    self.assertEquals(sub4.key().name(),
+                      task['params']['subscription_key_name'])
+    self.assertEquals(Subscription.STATE_VERIFIED,
+                      task['params']['next_state'])
+
+  def testBatchConfirmation_missing(self):
+    """Tests a batched confirmation for a Subscription that was removed."""
+    self.assertTrue(Subscription.request_insert(
+        self.callback, self.topic, self.verify_token, self.secret))
+    self.assertTrue(Subscription.remove(self.callback, self.topic))
+    self.run_batch_task()
+    self.assertEquals(0, SubscriptionToConfirm.all().count())
+
+  def testBatchConfirmation_changed(self):
+    """Tests a batched confirmation for a Subscription changed meanwhile."""
+    self.assertTrue(Subscription.request_insert(
+        self.callback, self.topic, self.verify_token, self.secret))
+    urlfetch_test_stub.instance.expect(
+        'get', self.verify_callback_querystring_template % 'subscribe', 200,
+        self.challenge)
+
+    def get_challenge():
+      # The subscriber is verified synchronously while the batch is running.
+      Subscription.insert(self.callback, self.topic, 'new_token', 'new_secret')
+      return self.challenge
+    main.get_random_challenge = get_challenge
+    self.run_batch_task()
+
+    sub = Subscription.get_by_key_name(self.sub_key)
+    self.assertEquals(Subscription.STATE_VERIFIED, sub.subscription_state)
+    self.assertEquals('new_token', sub.verify_token)
+    self.assertEquals('new_secret', sub.secret)
+    self.assertEquals(0, SubscriptionToConfirm.all().count())
+    self.assertEquals(1, main.KnownFeedStats.get_or_create_all(
+        [self.topic])[0].subscriber_count)
+
   def testSubscribeSuccessful(self):
     """Tests when a subscription task is successful."""
     self.assertTrue(db.get(KnownFeed.create_key(self.topic)) is None)
@@ -3705,70 +4774,330 @@ class SubscriptionConfirmHandlerTest(testutil.HandlerTestBase):
 class SubscriptionReconfirmHandlerTest(testutil.HandlerTestBase):
   """Tests for the periodic subscription reconfirming worker."""
 
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.HandlerTestBase.setUp(self)
+    self.now = time.time()
+    self.handler_class = lambda: main.SubscriptionReconfirmHandler(
+        now=lambda: self.now)
+    self.topic = 'http://example.com/the-topic'
+    self.old_chunk_size = main.SUBSCRIPTION_RECONFIRM_CHUNK_SIZE
+    os.environ['HTTP_X_APPENGINE_QUEUENAME'] = main.POLLING_QUEUE
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    testutil.HandlerTestBase.tearDown(self)
+    main.SUBSCRIPTION_RECONFIRM_CHUNK_SIZE = self.old_chunk_size
+    del os.environ['HTTP_X_APPENGINE_QUEUENAME']
+
+  def insert(self, callback, expires_in):
+    """Inserts a verified Subscription expiring some seconds from now."""
+    now_datetime = datetime.datetime.utcfromtimestamp(self.now)
+    Subscription.insert(callback, self.topic, 'token', 'secret',
+                        lease_seconds=expires_in,
+                        now=lambda: now_datetime)
+    return Subscription.get_by_key_name(
+        Subscription.create_key_name(callback, self.topic))
+
+  def run_task(self, index):
+    """Runs the reconfirmation task at the given index on the queue."""
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=index)
+    self.handle('post', *task['params'].items())
+
+  def get_reconfirmed(self):
+    """Returns the set of Subscription key names with confirmations."""
+    return set(w.subscription_key.name()
+               for w in SubscriptionToConfirm.all()
+               if w.auto_reconfirm)
+
   def testFullFlow(self):
     """Tests a full flow through the reconfirm worker."""
-    self.now = time.time()
-    self.called = False
-    def start_map(*args, **kwargs):
-      self.assertEquals({
-          'name': 'Reconfirm expiring subscriptions',
-          'reader_spec': 'mapreduce.input_readers.DatastoreInputReader',
-          'queue_name': 'polling',
-          'handler_spec': 'offline_jobs.SubscriptionReconfirmMapper.run',
-          'shard_count': 4,
-          'mapper_parameters': {
-            'entity_kind': 'main.Subscription',
-            'processing_rate': 100000,
-            'threshold_timestamp':
-                int(self.now + main.SUBSCRIPTION_CHECK_BUFFER_SECONDS),
-          },
-          'mapreduce_parameters': {
-            'done_callback': '/work/cleanup_mapper',
-            'done_callback_queue': 'polling',
-          },
-      }, kwargs)
-      self.called = True
-
-    def create_handler():
-      return main.SubscriptionReconfirmHandler(
-          now=lambda: self.now,
-          start_map=start_map)
-    self.handler_class = create_handler
+    soon = self.insert('http://example.com/soon', 3600)
+    expired = self.insert('http://example.com/expired', -3600)
+    self.insert('http://example.com/later', 3 * 24 * 3600)
+    self.insert('http://example.com/long-gone', -30 * 24 * 3600)
+    archived = self.insert('http://example.com/archived', 3600)
+    Subscription.archive(archived.callback, archived.topic)
 
-    os.environ['HTTP_X_APPENGINE_QUEUENAME'] = main.POLLING_QUEUE
-    try:
-      self.handle('get')
-      task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
-      self.handle('post')
-    finally:
-      del os.environ['HTTP_X_APPENGINE_QUEUENAME']
+    self.handle('get')
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+    self.assertEquals(
+        str(int(self.now + main.SUBSCRIPTION_CHECK_BUFFER_SECONDS)),
+        task['params']['threshold_timestamp'])
+
+    # Only one root task may run per day.
+    self.handle('get')
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=1)
 
-    self.assertTrue(self.called)
+    self.run_task(0)
+    self.assertEquals(set([soon.key().name(), expired.key().name()]),
+                      self.get_reconfirmed())
+    # The reconfirmations are verified by one fork-join task.
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=2)
+
+  def testContinuation(self):
+    """Tests that large windows are processed by a chain of tasks."""
+    main.SUBSCRIPTION_RECONFIRM_CHUNK_SIZE = 2
+    sub_keys = set(
+        self.insert('http://example.com/callback%d' % i, 3600 + i).key().name()
+        for i in xrange(3))
+
+    self.handle('get')
+    self.run_task(0)
+    self.assertEquals(2, len(self.get_reconfirmed()))
+    task_list = [t for t in testutil.get_tasks(main.POLLING_QUEUE)
+                 if t['url'] == '/work/reconfirm_subscriptions']
+    continuation = [t for t in task_list if 'cursor' in t['params']]
+    self.assertEquals(2, len(task_list))
+    self.assertEquals(1, len(continuation))
+    self.assertTrue(continuation[0]['name'].startswith(
+        task_list[0]['params']['sequence'] + '-'))
+
+    self.handle('post', *continuation[0]['params'].items())
+    self.assertEquals(sub_keys, self.get_reconfirmed())
+
+  def testRetryAfterContinuation(self):
+    """Tests that a retried task still requests its chunk."""
+    main.SUBSCRIPTION_RECONFIRM_CHUNK_SIZE = 2
+    for i in xrange(3):
+      self.insert('http://example.com/callback%d' % i, 3600 + i)
+    self.handle('get')
+    self.run_task(0)
+
+    # The first attempt enqueued its continuation but lost its requests.
+    db.delete(SubscriptionToConfirm.all(keys_only=True))
+    self.run_task(0)
+    self.assertEquals(2, len(self.get_reconfirmed()))
+    task_list = [t for t in testutil.get_tasks(main.POLLING_QUEUE)
+                 if t['url'] == '/work/reconfirm_subscriptions']
+    self.assertEquals(2, len(task_list))
+
+  def testResetsFailures(self):
+    """Tests that reconfirmation starts counting failures from zero."""
+    sub = self.insert('http://example.com/soon', 3600)
+    sub.confirm_failures = 3
+    sub.put()
+    self.handle('get')
+    self.run_task(0)
+    self.assertEquals(0, db.get(sub.key()).confirm_failures)
+    work = SubscriptionToConfirm.all().get()
+    self.assertEquals(Subscription.STATE_VERIFIED, work.next_state)
+    self.assertEquals('token', work.verify_token)
+    self.assertEquals('secret', work.secret)
 
 
 class SubscriptionCleanupHandlerTest(testutil.HandlerTestBase):
   """Tests fo the SubscriptionCleanupHandler."""
 
-  handler_class = main.SubscriptionCleanupHandler
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.HandlerTestBase.setUp(self)
+    self.now = time.time()
+    self.handler_class = lambda: main.SubscriptionCleanupHandler(
+        now=lambda: self.now)
+    self.callback = 'http://example.com/callback/%d'
+    self.topic = 'http://example.com/mytopic'
+    self.old_chunk_size = main.SUBSCRIPTION_CLEANUP_CHUNK_SIZE
+    self.old_batch_size = main.SUBSCRIPTION_CLEANUP_DELETE_BATCH_SIZE
+    self.old_rate = main.SUBSCRIPTION_CLEANUP_MAX_DELETES_PER_SECOND
+    os.environ['HTTP_X_APPENGINE_QUEUENAME'] = main.POLLING_QUEUE
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    testutil.HandlerTestBase.tearDown(self)
+    main.SUBSCRIPTION_CLEANUP_CHUNK_SIZE = self.old_chunk_size
+    main.SUBSCRIPTION_CLEANUP_DELETE_BATCH_SIZE = self.old_batch_size
+    main.SUBSCRIPTION_CLEANUP_MAX_DELETES_PER_SECOND = self.old_rate
+    del os.environ['HTTP_X_APPENGINE_QUEUENAME']
+
+  def insert(self, count, archived):
+    """Inserts Subscriptions for the test topic, optionally archived."""
+    for i in xrange(count):
+      callback = self.callback % (i + (archived and 1000 or 0))
+      self.assertTrue(Subscription.insert(callback, self.topic, '', ''))
+      if archived:
+        Subscription.archive(callback, self.topic)
+
+  def get_states(self):
+    """Returns the states of all remaining Subscriptions."""
+    return [s.subscription_state for s in Subscription.all()]
 
   def testEmpty(self):
     """Tests cleaning up empty subscriptions."""
     self.handle('get')
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+    self.handle('post', *task['params'].items())
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=1)
+
+    # The lock is released once the chain has caught up.
+    self.now += 60
+    self.handle('get')
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=2)
 
   def testCleanup(self):
     """Tests cleaning up a few deleted subscriptions."""
-    callback = 'http://example.com/callback/%d'
-    topic = 'http://example.com/mytopic'
-    self.assertTrue(Subscription.insert(callback % 1, topic, '', ''))
-    self.assertTrue(Subscription.insert(callback % 2, topic, '', ''))
-    self.assertTrue(Subscription.insert(callback % 3, topic, '', ''))
-    self.assertEquals(3 * [Subscription.STATE_VERIFIED],
-                      [s.subscription_state for s in Subscription.all()])
-
-    Subscription.archive(callback % 1, topic)
+    self.insert(2, False)
+    self.insert(1, True)
+    self.handle('get')
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+    self.assertEquals('/work/subscription_cleanup', task['url'])
+    self.handle('post', *task['params'].items())
+    self.assertEquals(2 * [Subscription.STATE_VERIFIED], self.get_states())
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=1)
+
+  def testAlreadyRunning(self):
+    """Tests that only one chain of cleanup tasks runs at a time."""
+    self.handle('get')
+    self.now += 60
+    self.handle('get')
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=1)
+
+  def testContinuation(self):
+    """Tests that large cleanups are done by a chain of rate-limited tasks."""
+    main.SUBSCRIPTION_CLEANUP_CHUNK_SIZE = 3
+    main.SUBSCRIPTION_CLEANUP_DELETE_BATCH_SIZE = 2
+    main.SUBSCRIPTION_CLEANUP_MAX_DELETES_PER_SECOND = 1
+    self.insert(1, False)
+    self.insert(5, True)
+
+    self.handle('get')
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+    self.handle('post', *task['params'].items())
+    self.assertEquals(3, len(self.get_states()))
+
+    task_list = testutil.get_tasks(main.POLLING_QUEUE, usec_eta=True)
+    continuation = [t for t in task_list if 'cursor' in t['params']]
+    self.assertEquals(1, len(continuation))
+    self.assertTrue(continuation[0]['name'].startswith(
+        task['params']['sequence'] + '-'))
+    # Three deletes at one per second delay the continuation.
+    first_eta = min(t['eta'] for t in task_list)
+    self.assertTrue(continuation[0]['eta'] - first_eta >= 2 * 1e6)
+
+    # Running the continuation twice does no harm.
+    self.handle('post', *continuation[0]['params'].items())
+    self.handle('post', *continuation[0]['params'].items())
+    self.assertEquals([Subscription.STATE_VERIFIED], self.get_states())
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=2)
+
+
+class EventPayloadCleanupHandlerTest(testutil.HandlerTestBase):
+  """Tests for the EventPayloadCleanupHandler."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.HandlerTestBase.setUp(self)
+    self.start = datetime.datetime(2010, 1, 1, 12, 0, 0)
+    self.now = [self.start]
+    self.handler_class = lambda: main.EventPayloadCleanupHandler(
+        now=lambda: self.now[0])
+
+  def testEmpty(self):
+    """Tests cleaning up when there are no payloads."""
     self.handle('get')
-    self.assertEquals(2 * [Subscription.STATE_VERIFIED],
-                      [s.subscription_state for s in Subscription.all()])
+
+  def testCleanup(self):
+    """Tests that only expired payloads are cleaned up."""
+    main.EventPayload.store('first', now=lambda: self.start)
+    main.EventPayload.store(
+        'second', now=lambda: self.start + datetime.timedelta(days=3))
+    self.now[0] = self.start + datetime.timedelta(
+        seconds=main.EVENT_PAYLOAD_TTL_SECONDS + 1)
+    self.handle('get')
+    self.assertEquals(['second'],
+                      [p.payload for p in main.EventPayload.all()])
+
+  def testStoreExtendsExpiration(self):
+    """Tests that storing a payload again extends its expiration."""
+    ttl = datetime.timedelta(seconds=main.EVENT_PAYLOAD_TTL_SECONDS)
+    main.EventPayload.store('data', now=lambda: self.start)
+    later = self.start + datetime.timedelta(seconds=1)
+    main.EventPayload.store('data', now=lambda: later)
+    self.assertEquals(self.start + ttl,
+                      main.EventPayload.all().get().expiration_time)
+
+    later = self.start + ttl
+    main.EventPayload.store('data', now=lambda: later)
+    self.assertEquals(later + ttl,
+                      main.EventPayload.all().get().expiration_time)
+
+
+class ForkJoinJournalCleanupHandlerTest(testutil.HandlerTestBase):
+  """Tests for the ForkJoinJournalCleanupHandler."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.HandlerTestBase.setUp(self)
+    self.start = datetime.datetime(2010, 1, 1, 12, 0, 0)
+    self.now = calendar.timegm(self.start.utctimetuple())
+    self.handler_class = lambda: main.ForkJoinJournalCleanupHandler(
+        now=lambda: self.now)
+    self.old_chunk_size = main.FORK_JOIN_JOURNAL_CLEANUP_CHUNK_SIZE
+    self.old_batch_size = main.FORK_JOIN_JOURNAL_CLEANUP_DELETE_BATCH_SIZE
+    os.environ['HTTP_X_APPENGINE_QUEUENAME'] = main.POLLING_QUEUE
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    testutil.HandlerTestBase.tearDown(self)
+    main.FORK_JOIN_JOURNAL_CLEANUP_CHUNK_SIZE = self.old_chunk_size
+    main.FORK_JOIN_JOURNAL_CLEANUP_DELETE_BATCH_SIZE = self.old_batch_size
+    del os.environ['HTTP_X_APPENGINE_QUEUENAME']
+
+  def insert(self, key_name, minutes):
+    """Inserts a journal entry created minutes after the start time."""
+    fork_join_queue.ForkJoinJournal(
+        key_name=key_name, item=db.Blob('item'),
+        created=self.start + datetime.timedelta(minutes=minutes)).put()
+
+  def get_names(self):
+    """Returns the key names of all remaining journal entries."""
+    return sorted(j.key().name() for j in
+                  fork_join_queue.ForkJoinJournal.all())
+
+  def testEmpty(self):
+    """Tests cleaning up when there are no journal entries."""
+    self.handle('get')
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+    self.handle('post', *task['params'].items())
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=1)
+
+    # The lock is released once the chain has caught up.
+    self.now += 60
+    self.handle('get')
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=2)
+
+  def testCleanup(self):
+    """Tests that only expired journal entries are cleaned up."""
+    self.insert('old', 0)
+    self.insert('new', 30)
+    self.now += main.FORK_JOIN_JOURNAL_TTL_SECONDS + 60
+    self.handle('get')
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+    self.assertEquals('/work/journal_cleanup', task['url'])
+    self.handle('post', *task['params'].items())
+    self.assertEquals(['new'], self.get_names())
+
+  def testContinuation(self):
+    """Tests that large cleanups are done by a chain of tasks."""
+    main.FORK_JOIN_JOURNAL_CLEANUP_CHUNK_SIZE = 3
+    main.FORK_JOIN_JOURNAL_CLEANUP_DELETE_BATCH_SIZE = 2
+    for i in xrange(5):
+      self.insert('old%d' % i, 0)
+    self.insert('new', 30)
+    self.now += main.FORK_JOIN_JOURNAL_TTL_SECONDS + 60
+
+    self.handle('get')
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+    self.handle('post', *task['params'].items())
+    self.assertEquals(3, len(self.get_names()))
+
+    task_list = testutil.get_tasks(main.POLLING_QUEUE, expected_count=2)
+    continuation = [t for t in task_list if 'cursor' in t['params']][0]
+    self.assertEquals(task['params']['cutoff'],
+                      continuation['params']['cutoff'])
+    self.handle('post', *continuation['params'].items())
+    self.assertEquals(['new'], self.get_names())
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=2)
 
 
 class CleanupMapperHandlerTest(testutil.HandlerTestBase):
@@ -124,12 +124,27 @@ def count_subscriptions_for_topic(subscription):
 
 
 def save_subscription_counts_for_topic(topic_hash, counts):
-  """Sums subscriptions to a topic and saves a corresponding KnownFeedStat."""
-  total_count = len(counts)
-  entity = main.KnownFeedStats(
+  """Sums subscriptions to a topic and saves a corresponding KnownFeedStat.
+
+  The new total already includes the changes counted so far by the topic's
+  KnownFeedStatsShard counters, so the deltas read before saving are
+  subtracted from the shards in the same transaction. Changes counted
+  after that read stay in the shards and are added to the new total.
+  """
+  stats = main.KnownFeedStats(
       key=main.KnownFeedStats.create_key(topic_hash=topic_hash),
-      subscriber_count=total_count)
-  yield op.db.Put(entity)
+      subscriber_count=len(counts))
+  shard_keys = main.KnownFeedStatsShard.create_keys(topic_hash=topic_hash)
+  counted = dict((shard.key(), shard.subscriber_delta)
+                 for shard in db.get(shard_keys)
+                 if shard is not None and shard.subscriber_delta)
+  def txn():
+    shard_list = [shard for shard in db.get(counted.keys())
+                  if shard is not None]
+    for shard in shard_list:
+      shard.subscriber_delta -= counted[shard.key()]
+    db.put([stats] + shard_list)
+  db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
 
 
 def start_count_subscriptions():
@@ -261,18 +261,31 @@ class SaveSubscriptionCountsTest(unittest.TestCase):
 
   def testReduce(self):
     """Tests the reducer function."""
+    topic_hash = '95ff66c343530c88a750cbc7fd1e0bbd8cc7bce2'
     self.assertEquals(0, len(list(main.KnownFeedStats.all())))
-    it = offline_jobs.save_subscription_counts_for_topic(
-        '95ff66c343530c88a750cbc7fd1e0bbd8cc7bce2',
-        ['1'] * 321)
-    op = it.next()
-    self.assertEquals(
-        db.Key.from_path(
-            'KnownFeed', '95ff66c343530c88a750cbc7fd1e0bbd8cc7bce2',
-            'KnownFeedStats', 'overall'),
-        op.entity.key())
-    self.assertEquals(321, op.entity.subscriber_count)
-    self.assertRaises(StopIteration, it.next)
+    shard_keys = main.KnownFeedStatsShard.create_keys(topic_hash=topic_hash)
+    self.assertEquals(topic_hash + '-shard-0', shard_keys[0].name())
+    self.assertEquals(None, shard_keys[0].parent())
+    main.KnownFeedStatsShard(key=shard_keys[0], subscriber_delta=5).put()
+
+    # A change counted after the shards are read survives the recount.
+    old_get = offline_jobs.db.get
+    def get(keys):
+      result = old_get(keys)
+      offline_jobs.db.get = old_get
+      main.KnownFeedStatsShard(key=shard_keys[0], subscriber_delta=7).put()
+      return result
+    offline_jobs.db.get = get
+    try:
+      offline_jobs.save_subscription_counts_for_topic(topic_hash, ['1'] * 321)
+    finally:
+      offline_jobs.db.get = old_get
+
+    stats = main.KnownFeedStats.get(db.Key.from_path(
+        'KnownFeed', topic_hash, 'KnownFeedStats', 'overall'))
+    self.assertEquals(321, stats.subscriber_count)
+    self.assertEquals([2], [shard.subscriber_delta
+                            for shard in main.KnownFeedStatsShard.all()])
 
   def testStart(self):
     """Tests starting the mapreduce job."""
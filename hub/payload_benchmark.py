@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Profiles event payload compression with the feed test corpus.
+
+Run from the 'hub' directory:
+
+  ./payload_benchmark.py [repeat]
+
+Each document is repeated 'repeat' times (default 20) to get event sizes over
+the compression threshold. Prints the stored size and encode and decode times
+of each document.
+"""
+
+import os
+import sys
+import time
+
+import testutil
+testutil.fix_path()
+
+import main
+
+
+def run_benchmark(repeat):
+  testdata = os.path.join(os.path.dirname(__file__) or '.',
+                          'feed_diff_testdata')
+  total_raw = 0
+  total_stored = 0
+  for name in sorted(os.listdir(testdata)):
+    data = open(os.path.join(testdata, name)).read() * repeat
+
+    start = time.time()
+    stored, encoding = main.encode_payload(data)
+    encode_ms = 1000 * (time.time() - start)
+
+    start = time.time()
+    main.decode_payload(stored, encoding)
+    decode_ms = 1000 * (time.time() - start)
+
+    total_raw += len(data)
+    total_stored += len(stored)
+    print '%-25s %8d -> %8d bytes; encode %.2fms, decode %.2fms' % (
+        name, len(data), len(stored), encode_ms, decode_ms)
+
+  print 'Total %d -> %d bytes (%.1f%%)' % (
+      total_raw, total_stored, 100.0 * total_stored / total_raw)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) > 2:
+    print 'Usage: %s [repeat]' % sys.argv[0]
+    sys.exit(1)
+  run_benchmark(len(sys.argv) == 2 and int(sys.argv[1]) or 20)
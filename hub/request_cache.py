@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Request-scoped read-through cache for Datastore entities fetched by key.
+
+Between calls to start() and stop(), get() returns the same model instance
+for every lookup of a key and only issues Datastore RPCs for keys it has not
+seen yet; missing entities are remembered as None. The cache is disabled
+outside of that scope, so code that is not running in a request (e.g., tests
+of model classes) always reads from the Datastore.
+
+The cache is transaction-aware:
+
+  * get() inside a transaction always reads from the Datastore, so the
+    transaction sees a consistent snapshot and enlists the entity group.
+
+  * Every Datastore Put and Delete RPC, including those made inside of
+    transactions and by code that never uses this module, evicts the written
+    keys. Evicting a key whose transaction later rolls back only costs one
+    extra read.
+
+get_async() issues the Datastore RPC for unseen keys without waiting, so
+the read can overlap with other work in the request. Keys written while the
+RPC is in flight are not cached when it completes.
+
+Call install() once per process to register the eviction hook.
+"""
+
+import logging
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_types
+from google.appengine.ext import db
+
+
+class _RequestCache(object):
+  """State of the cache for the current request."""
+
+  def __init__(self):
+    self.enabled = False
+    self.entities = {}
+    self.pending = set()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+_cache = _RequestCache()
+
+
+def start():
+  """Enables the cache with no entries for a new request."""
+  global _cache
+  _cache = _RequestCache()
+  _cache.enabled = True
+
+
+def stop():
+  """Disables and empties the cache at the end of a request."""
+  global _cache
+  if _cache.enabled and (_cache.hits or _cache.misses):
+    logging.debug('Request cache avoided %d of %d entity gets; '
+                  '%d evictions', _cache.hits, _cache.hits + _cache.misses,
+                  _cache.evictions)
+  _cache = _RequestCache()
+
+
+def get_stats():
+  """Returns the counters of the cache for the current request.
+
+  Returns:
+    Dictionary with the keys 'hits' (duplicate gets avoided), 'misses' (keys
+    read from the Datastore), and 'evictions' (cached keys that were written).
+  """
+  return {
+    'hits': _cache.hits,
+    'misses': _cache.misses,
+    'evictions': _cache.evictions,
+  }
+
+
+class _CachedGetRPC(object):
+  """Result of get_async() that fills the cache once it completes."""
+
+  def __init__(self, cache, keys, multiple):
+    """Initializer.
+
+    Args:
+      cache: The _RequestCache the keys were requested from.
+      keys: List of db.Key instances requested.
+      multiple: True if the caller supplied a list of keys.
+    """
+    self.cache = cache
+    self.keys = keys
+    self.multiple = multiple
+    self.found = {}
+    self.missing = []
+    seen = set()
+    for key in keys:
+      if key in cache.entities:
+        self.found[key] = cache.entities[key]
+      elif key not in seen:
+        seen.add(key)
+        self.missing.append(key)
+    cache.misses += len(self.missing)
+    cache.hits += len(keys) - len(self.missing)
+    self.rpc = None
+    if self.missing:
+      cache.pending.update(self.missing)
+      self.rpc = db.get_async(self.missing)
+
+  def get_result(self):
+    """Waits for the Datastore RPC and returns the entities, like db.get()."""
+    if self.rpc is not None:
+      for key, entity in zip(self.missing, self.rpc.get_result()):
+        self.found[key] = entity
+        # Entities written during the RPC may be stale; don't cache those.
+        if key in self.cache.pending:
+          self.cache.pending.discard(key)
+          self.cache.entities[key] = entity
+      self.rpc = None
+    results = [self.found[key] for key in self.keys]
+    if self.multiple:
+      return results
+    else:
+      return results[0]
+
+
+def get_async(keys):
+  """Starts fetching entities by key, reading each key only once.
+
+  Args:
+    keys: A db.Key or list of db.Key instances, like db.get().
+
+  Returns:
+    An object with a get_result() method that returns what get() would.
+  """
+  if not _cache.enabled or db.is_in_transaction():
+    return db.get_async(keys)
+  multiple = isinstance(keys, (list, tuple))
+  if not multiple:
+    keys = [keys]
+  return _CachedGetRPC(_cache, list(keys), multiple)
+
+
+def get(keys):
+  """Fetches entities by key, reading from the Datastore only once per key.
+
+  Args:
+    keys: A db.Key or list of db.Key instances, like db.get().
+
+  Returns:
+    A model instance or None if keys is a single key; otherwise a list of
+    model instances or None values in the same order as the keys.
+  """
+  return get_async(keys).get_result()
+
+
+def _evict_written_keys(service, call, request, response):
+  """APIProxy post-call hook that evicts keys written to the Datastore."""
+  if not _cache.enabled:
+    return
+  if call == 'Put':
+    key_list = response.key_list()
+  elif call == 'Delete':
+    key_list = request.key_list()
+  else:
+    return
+  for reference in key_list:
+    key = datastore_types.Key._FromPb(reference)
+    _cache.pending.discard(key)
+    if key in _cache.entities:
+      del _cache.entities[key]
+      _cache.evictions += 1
+
+
+def install():
+  """Registers the eviction hook with the APIProxy; safe to call repeatedly."""
+  apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+      'request_cache', _evict_written_keys, 'datastore_v3')
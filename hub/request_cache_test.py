@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the request_cache module."""
+
+import logging
+logging.basicConfig(format='%(levelname)-8s %(filename)s] %(message)s')
+import unittest
+
+import testutil
+testutil.fix_path()
+
+from google.appengine.ext import db
+
+import request_cache
+
+################################################################################
+
+class TestModel(db.Model):
+  value = db.IntegerProperty()
+
+
+class RequestCacheTest(unittest.TestCase):
+  """Tests for the request-scoped entity cache."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    request_cache.install()
+    request_cache.start()
+    self.first = TestModel(key_name='first', value=1)
+    self.second = TestModel(key_name='second', value=2)
+    db.put([self.first, self.second])
+    self.missing_key = db.Key.from_path(TestModel.kind(), 'missing')
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    request_cache.stop()
+
+  def testDuplicateGets(self):
+    """Tests that each key is only read from the Datastore once."""
+    first = request_cache.get(self.first.key())
+    self.assertEquals(1, first.value)
+    result = request_cache.get(
+        [self.first.key(), self.second.key(), self.missing_key])
+    self.assertTrue(result[0] is first)
+    self.assertEquals(2, result[1].value)
+    self.assertTrue(result[2] is None)
+    self.assertTrue(request_cache.get(self.missing_key) is None)
+    self.assertEquals({'hits': 2, 'misses': 3, 'evictions': 0},
+                      request_cache.get_stats())
+
+  def testRepeatedKeyInOneGet(self):
+    """Tests that a key repeated in a single call is read once."""
+    result = request_cache.get([self.first.key(), self.first.key()])
+    self.assertTrue(result[0] is result[1])
+    self.assertEquals({'hits': 1, 'misses': 1, 'evictions': 0},
+                      request_cache.get_stats())
+
+  def testPutAndDeleteEvict(self):
+    """Tests that writes evict the cached entities."""
+    request_cache.get([self.first.key(), self.second.key(), self.missing_key])
+    TestModel(key_name='first', value=10).put()
+    TestModel(key_name='missing', value=30).put()
+    db.delete(self.second.key())
+    result = request_cache.get(
+        [self.first.key(), self.second.key(), self.missing_key])
+    self.assertEquals(10, result[0].value)
+    self.assertTrue(result[1] is None)
+    self.assertEquals(30, result[2].value)
+    self.assertEquals({'hits': 0, 'misses': 6, 'evictions': 3},
+                      request_cache.get_stats())
+
+  def testTransaction(self):
+    """Tests that transactions read from and write through the Datastore."""
+    request_cache.get(self.first.key())
+    def txn():
+      entity = request_cache.get(self.first.key())
+      entity.value += 1
+      entity.put()
+      return entity
+    written = db.run_in_transaction(txn)
+    self.assertEquals(2, written.value)
+    self.assertEquals(2, request_cache.get(self.first.key()).value)
+    self.assertEquals({'hits': 0, 'misses': 2, 'evictions': 1},
+                      request_cache.get_stats())
+
+  def testGetAsync(self):
+    """Tests starting a get and collecting its result later."""
+    request_cache.get(self.first.key())
+    rpc = request_cache.get_async([self.first.key(), self.second.key()])
+    result = rpc.get_result()
+    self.assertTrue(result[0] is request_cache.get(self.first.key()))
+    self.assertEquals(2, result[1].value)
+    self.assertTrue(result[1] is request_cache.get(self.second.key()))
+    self.assertEquals({'hits': 3, 'misses': 2, 'evictions': 0},
+                      request_cache.get_stats())
+
+  def testGetAsync_writtenInFlight(self):
+    """Tests that entities written during an async get are not cached."""
+    rpc = request_cache.get_async(self.first.key())
+    TestModel(key_name='first', value=10).put()
+    rpc.get_result()
+    self.assertEquals(10, request_cache.get(self.first.key()).value)
+    self.assertEquals(2, request_cache.get_stats()['misses'])
+
+  def testDisabled(self):
+    """Tests that the cache does nothing outside of a request."""
+    request_cache.stop()
+    first = request_cache.get(self.first.key())
+    self.assertFalse(first is request_cache.get(self.first.key()))
+    self.assertEquals({'hits': 0, 'misses': 0, 'evictions': 0},
+                      request_cache.get_stats())
+
+################################################################################
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Batches task queue adds into as few Queue.add() calls as possible.
+
+Tasks passed to add() are collected per queue and sent together:
+
+  * Inside of a transaction started by run_in_transaction(), the tasks are
+    added transactionally when the transaction function returns, right before
+    the commit. They are enqueued if and only if the transaction commits.
+
+  * Inside of any other transaction, the task is added transactionally right
+    away, since there is no way to add it later within the same transaction.
+
+  * Outside of transactions, between calls to start() and stop(), tasks are
+    held until flush() is called. stop() flushes anything left at the end of
+    the request. Code that relies on a task existing before it writes some
+    other state must call flush() itself first.
+
+  * Otherwise (e.g., in tests of model classes), tasks are added right away.
+"""
+
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
+
+
+# Number of attempts for each batched Queue.add() call.
+ADD_ATTEMPTS = 3
+
+
+class _TaskBuffer(object):
+  """Tasks waiting to be added, by queue name."""
+
+  def __init__(self):
+    self.queues = {}
+
+  def add(self, task, queue_name):
+    self.queues.setdefault(queue_name, []).append(task)
+
+  def flush(self, transactional=False):
+    """Adds all buffered tasks, in as few Queue.add() calls as possible.
+
+    Tasks for each queue are added in batches of at most
+    taskqueue.MAX_TASKS_PER_ADD. Named tasks that already exist or were
+    tombstoned are treated as added.
+
+    Args:
+      transactional: True if the tasks should be added transactionally.
+
+    Raises:
+      taskqueue.Error or apiproxy_errors.Error if a batch of tasks could not
+      be added after ADD_ATTEMPTS tries. Tasks that were not added yet stay
+      in the buffer.
+    """
+    for queue_name in sorted(self.queues):
+      task_list = self.queues[queue_name]
+      while task_list:
+        batch = task_list[:taskqueue.MAX_TASKS_PER_ADD]
+        for i in xrange(ADD_ATTEMPTS):
+          try:
+            taskqueue.Queue(queue_name).add(batch,
+                                            transactional=transactional)
+          except (taskqueue.TaskAlreadyExistsError,
+                  taskqueue.TombstonedTaskError):
+            # The tasks in the batch with names that were free are still
+            # added.
+            break
+          except (taskqueue.Error, apiproxy_errors.Error):
+            logging.exception('Could not add %d tasks to queue %s',
+                              len(batch), queue_name)
+            if i == (ADD_ATTEMPTS - 1):
+              raise
+          else:
+            break
+        del task_list[:len(batch)]
+      del self.queues[queue_name]
+
+
+class _RequestState(object):
+  """Buffers for the current request and transaction."""
+
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.request_tasks = _TaskBuffer()
+    self.transaction_tasks = None
+
+_state = _RequestState()
+
+
+def start():
+  """Starts collecting non-transactional tasks for a new request."""
+  global _state
+  _state = _RequestState(enabled=True)
+
+
+def stop():
+  """Adds any remaining tasks and stops collecting them."""
+  global _state
+  try:
+    flush()
+  finally:
+    _state = _RequestState()
+
+
+def flush():
+  """Adds all tasks collected outside of transactions."""
+  _state.request_tasks.flush()
+
+
+def add(task, queue_name):
+  """Adds a task to a queue, batched with other tasks where possible.
+
+  Args:
+    task: The taskqueue.Task to add.
+    queue_name: Name of the queue to add it to.
+  """
+  if _state.transaction_tasks is not None:
+    _state.transaction_tasks.add(task, queue_name)
+  elif db.is_in_transaction():
+    tasks = _TaskBuffer()
+    tasks.add(task, queue_name)
+    tasks.flush(transactional=True)
+  elif _state.enabled:
+    _state.request_tasks.add(task, queue_name)
+  else:
+    tasks = _TaskBuffer()
+    tasks.add(task, queue_name)
+    tasks.flush()
+
+
+def run_in_transaction_custom_retries(retries, function, *args, **kwargs):
+  """Runs a function in a transaction, adding its tasks before the commit.
+
+  Args:
+    retries: Number of times to retry the transaction on contention.
+    function: Function to run.
+    *args, **kwargs: Passed to the function.
+
+  Returns:
+    The return value of the function.
+  """
+  def txn():
+    _state.transaction_tasks = _TaskBuffer()
+    try:
+      result = function(*args, **kwargs)
+      _state.transaction_tasks.flush(transactional=True)
+      return result
+    finally:
+      _state.transaction_tasks = None
+  return db.run_in_transaction_custom_retries(retries, txn)
+
+
+def run_in_transaction(function, *args, **kwargs):
+  """Like db.run_in_transaction(), adding the function's tasks together.
+
+  Args:
+    function: Function to run.
+    *args, **kwargs: Passed to the function.
+
+  Returns:
+    The return value of the function.
+  """
+  return run_in_transaction_custom_retries(
+      db.DEFAULT_TRANSACTION_RETRIES, function, *args, **kwargs)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the task_batcher module."""
+
+import logging
+logging.basicConfig(format='%(levelname)-8s %(filename)s] %(message)s')
+import unittest
+
+import testutil
+testutil.fix_path()
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+import task_batcher
+
+################################################################################
+
+class TestModel(db.Model):
+  value = db.IntegerProperty()
+
+
+class TaskBatcherTest(unittest.TestCase):
+  """Tests for batching task queue adds."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.queue = 'default'
+    self.other_queue = 'polling'
+    self.calls = []
+    self.old_add = taskqueue.Queue.add
+    test = self
+    def add(queue, task, transactional=False):
+      test.calls.append((queue.name, len(task), transactional))
+      return test.old_add(queue, task, transactional=transactional)
+    taskqueue.Queue.add = add
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    taskqueue.Queue.add = self.old_add
+    task_batcher.stop()
+
+  def make_task(self, name):
+    """Creates a task with the given name."""
+    return taskqueue.Task(name=name, url='/work/test')
+
+  def testNoRequest(self):
+    """Tests that tasks are added right away outside of a request."""
+    task_batcher.add(self.make_task('one'), self.queue)
+    task_batcher.add(self.make_task('two'), self.queue)
+    testutil.get_tasks(self.queue, expected_count=2)
+    self.assertEquals([(self.queue, 1, False), (self.queue, 1, False)],
+                      self.calls)
+
+  def testRequest(self):
+    """Tests that tasks are held until flushed, one call per queue."""
+    task_batcher.start()
+    task_batcher.add(self.make_task('one'), self.queue)
+    task_batcher.add(self.make_task('two'), self.other_queue)
+    task_batcher.add(self.make_task('three'), self.queue)
+    testutil.get_tasks(self.queue, expected_count=0)
+    task_batcher.flush()
+    testutil.get_tasks(self.queue, expected_count=2)
+    testutil.get_tasks(self.other_queue, expected_count=1)
+    self.assertEquals([(self.queue, 2, False), (self.other_queue, 1, False)],
+                      self.calls)
+
+  def testRequestLargeBatch(self):
+    """Tests that more tasks than fit in one add call are split up."""
+    task_batcher.start()
+    count = taskqueue.MAX_TASKS_PER_ADD + 1
+    for i in xrange(count):
+      task_batcher.add(self.make_task('task-%d' % i), self.queue)
+    task_batcher.flush()
+    testutil.get_tasks(self.queue, expected_count=count)
+    self.assertEquals([(self.queue, taskqueue.MAX_TASKS_PER_ADD, False),
+                       (self.queue, 1, False)],
+                      self.calls)
+
+  def testRequestTaskExists(self):
+    """Tests that named tasks that were already added are skipped."""
+    task_batcher.add(self.make_task('one'), self.queue)
+    task_batcher.start()
+    task_batcher.add(self.make_task('one'), self.queue)
+    task_batcher.add(self.make_task('two'), self.queue)
+    task_batcher.flush()
+    testutil.get_tasks(self.queue, expected_count=2)
+    self.assertEquals([(self.queue, 1, False), (self.queue, 2, False)],
+                      self.calls)
+
+  def testStopFlushes(self):
+    """Tests that tasks left at the end of a request are added."""
+    task_batcher.start()
+    task_batcher.add(self.make_task('one'), self.queue)
+    task_batcher.stop()
+    testutil.get_tasks(self.queue, expected_count=1)
+
+  def testTransaction(self):
+    """Tests that transactional tasks are added together before commit."""
+    task_batcher.start()
+    def txn():
+      TestModel(key_name='first', value=1).put()
+      task_batcher.add(self.make_task('one'), self.queue)
+      task_batcher.add(self.make_task('two'), self.queue)
+      # Transactional tasks are not part of the request's tasks.
+      task_batcher.flush()
+      return 'result'
+    self.assertEquals('result', task_batcher.run_in_transaction(txn))
+    testutil.get_tasks(self.queue, expected_count=2)
+    self.assertEquals([(self.queue, 2, True)], self.calls)
+
+  def testTransactionRollback(self):
+    """Tests that no tasks are added when the transaction fails."""
+    def txn():
+      TestModel(key_name='first', value=1).put()
+      task_batcher.add(self.make_task('one'), self.queue)
+      raise db.Rollback()
+    task_batcher.run_in_transaction(txn)
+    testutil.get_tasks(self.queue, expected_count=0)
+    self.assertTrue(TestModel.get_by_key_name('first') is None)
+
+  def testOtherTransaction(self):
+    """Tests adding tasks in a transaction not run by the batcher."""
+    task_batcher.start()
+    def txn():
+      task_batcher.add(self.make_task('one'), self.queue)
+    db.run_in_transaction(txn)
+    testutil.get_tasks(self.queue, expected_count=1)
+    self.assertEquals([(self.queue, 1, True)], self.calls)
+
+################################################################################
+
+if __name__ == '__main__':
+  unittest.main()
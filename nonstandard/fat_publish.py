@@ -40,8 +40,21 @@ To use this module as a client, send POST requests with the parameters
   topic=http%3A%2F%2Fexample.com%2Fmytopic&\
   content=<url escaped feed contents>&\
   signature=<hmac signature of content and topic concatenated">
+
+Large feeds can instead be sent as the raw request body, which is read in
+chunks and never form-decoded. The topic and signature go in headers:
+
+  POST /fatping/raw HTTP/1.1
+  Content-Type: application/atom+xml
+  Content-Length: ...
+  X-Hub-Topic: http://example.com/mytopic
+  X-Hub-Signature: sha1=<hmac signature of content and topic concatenated>
+
+  <feed contents>
 """
 
+import hashlib
+import hmac
 import logging
 
 from google.appengine.ext import webapp
@@ -49,6 +62,9 @@ from google.appengine.ext import webapp
 
 SECRET_FILE = 'hooks/fat_publish_secret.txt'
 
+# How many bytes of a raw fat publish body to read at a time.
+READ_CHUNK_BYTES = 64 * 1024
+
 
 # Define the Hook class for testing.
 if 'register' not in globals():
@@ -82,12 +98,9 @@ class FatPublishHandler(webapp.RequestHandler):
     logging.debug('Fat publish for topic=%s, signature=%s, size=%s',
                   topic, signature, len(content))
 
-    if not Subscription.has_subscribers(topic):
-      logging.debug('Ignoring fat publish because there are no subscribers.')
-      self.response.set_status(204)
-      return 
+    if not self.check_subscribers(topic):
+      return
 
-    logging.info('Subscribers found. Accepting fat publish event.')
     expected_signature = sha1_hmac(self.secret, content + topic)
     if expected_signature != signature:
       error_message = (
@@ -98,7 +111,39 @@ class FatPublishHandler(webapp.RequestHandler):
       self.response.out.write(error_message)
       return
 
-    feed_record = FeedRecord.get_or_create(topic)
+    self.publish(topic, content)
+
+  def check_subscribers(self, topic):
+    """Checks if a fat publish has anyone to be delivered to.
+
+    Uses the cached subscriber lists, so fat publishes for popular topics do
+    not query the Datastore.
+
+    Args:
+      topic: The topic URL of the fat publish.
+
+    Returns:
+      True if the topic has subscribers. Otherwise False, after responding
+      to the request.
+    """
+    if not Subscription.has_cached_subscribers(topic):
+      logging.debug('Ignoring fat publish because there are no subscribers.')
+      self.response.set_status(204)
+      return False
+    logging.info('Subscribers found. Accepting fat publish event.')
+    return True
+
+  def publish(self, topic, content):
+    """Parses the content of a verified fat publish and responds.
+
+    The FeedRecord is read without a transaction; parse_feed() commits it
+    along with any new entries and events.
+
+    Args:
+      topic: The topic URL of the fat publish.
+      content: The feed document that was published.
+    """
+    feed_record = FeedRecord.get_or_create_all([topic])[0]
     if parse_feed(feed_record, self.request.headers, content):
       self.response.set_status(204)
     else:
@@ -106,6 +151,60 @@ class FatPublishHandler(webapp.RequestHandler):
       self.response.set_status(400)
 
 
+class RawFatPublishHandler(FatPublishHandler):
+  """Request handler for fat publishes sent as the raw request body.
+
+  The signature is computed while the body is read, so the feed is never
+  decoded or copied as a form parameter. Responds like FatPublishHandler.
+  """
+
+  def post(self):
+    topic = self.request.headers.get('X-Hub-Topic')
+    signature = self.request.headers.get('X-Hub-Signature', '')
+    if signature.startswith('sha1='):
+      signature = signature[len('sha1='):]
+
+    if not (topic and signature and self.request.content_length):
+      error_message = (
+          'Raw fat publish must have a body and the "X-Hub-Topic" and '
+          '"X-Hub-Signature" headers')
+      logging.error(error_message)
+      self.response.set_status(400)
+      self.response.out.write(error_message)
+      return
+
+    if not self.check_subscribers(topic):
+      return
+
+    digest = hmac.new(self.secret, digestmod=hashlib.sha1)
+    chunk_list = []
+    remaining = self.request.content_length
+    while remaining > 0:
+      chunk = self.request.body_file.read(min(remaining, READ_CHUNK_BYTES))
+      if not chunk:
+        break
+      digest.update(chunk)
+      chunk_list.append(chunk)
+      remaining -= len(chunk)
+    content = ''.join(chunk_list)
+    digest.update(topic)
+
+    logging.debug('Raw fat publish for topic=%s, signature=%s, size=%s',
+                  topic, signature, len(content))
+
+    expected_signature = digest.hexdigest()
+    if expected_signature != signature:
+      error_message = (
+          'Received raw fat publish with invalid signature. '
+          'expected=%s, found=%s' % (expected_signature, signature))
+      logging.error(error_message)
+      self.response.set_status(403)
+      self.response.out.write(error_message)
+      return
+
+    self.publish(topic, content)
+
+
 def create_handler(shared_secret):
   """Creates a FatPublishHandler sub-class with a particular shared secret.
 
@@ -117,20 +216,36 @@ def create_handler(shared_secret):
   return SpecificFatPublishHandler
 
 
+def create_raw_handler(shared_secret):
+  """Creates a RawFatPublishHandler sub-class with a particular shared secret.
+
+  Args:
+    shared_secret: Used to verify the authenticity of fat publishes.
+  """
+  class SpecificRawFatPublishHandler(RawFatPublishHandler):
+    secret = shared_secret
+  return SpecificRawFatPublishHandler
+
+
 class FatPublishHook(Hook):
   """Hook for accepting fat publishes from publishers."""
 
-  def __init__(self, handler):
+  def __init__(self, handler, raw_handler=None):
     """Initializer.
 
     Args:
       handler: FatPublishHandler class to add for fatpinging.
+      raw_handler: Optional RawFatPublishHandler class to add for fatpinging
+        with the feed as the request body.
     """
     self.handler = handler
+    self.raw_handler = raw_handler
 
   def inspect(self, args, kwargs):
-    """Adds the FatPublishHandler to the list of request handlers."""
+    """Adds the fat publish handlers to the list of request handlers."""
     args[0].append((r'/fatping', self.handler))
+    if self.raw_handler is not None:
+      args[0].append((r'/fatping/raw', self.raw_handler))
     return False
 
 
@@ -138,5 +253,6 @@ if 'register' in globals():
   # You can re-register this same hook here with different shared secrets if
   # you would like to allow other publishing endpoints to do the same thing
   # with separate access controls.
+  secret = open(SECRET_FILE).read()
   register(modify_handlers, FatPublishHook(
-      create_handler(open(SECRET_FILE).read())))
+      create_handler(secret), create_raw_handler(secret)))
@@ -147,6 +147,99 @@ class FatPingHandlerTest(testutil.HandlerTestBase):
     self.assertEquals(400, self.response_code())
 
 
+class RawFatPingHandlerTest(testutil.HandlerTestBase):
+  """Tests for the RawFatPublishHandler class."""
+
+  secret = 'thisismysecret'
+  handler_class = fat_publish.create_raw_handler(secret)
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.HandlerTestBase.setUp(self)
+    self.topic = 'http://example.com/mytopic'
+    self.fakefeed = 'my fake feed'
+    self.fakefeed_signature = '5f9418a2e221ced6a0bc1263aaebcce297438740'
+    self.success = False
+    self.parsed = []
+
+    main.Subscription.insert('callback', self.topic, 'token', 'secret')
+    os.environ['HTTP_X_HUB_TOPIC'] = self.topic
+    os.environ['HTTP_X_HUB_SIGNATURE'] = 'sha1=' + self.fakefeed_signature
+
+    def parse_feed_mock(record, headers, body):
+      self.parsed.append((record.topic, body))
+      return self.success
+
+    fat_publish.parse_feed = parse_feed_mock
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    testutil.HandlerTestBase.tearDown(self)
+    for name in ('HTTP_X_HUB_TOPIC', 'HTTP_X_HUB_SIGNATURE'):
+      if name in os.environ:
+        del os.environ[name]
+
+  def testSuccessfulParsing(self):
+    """Tests when parsing is successful."""
+    self.success = True
+    self.handle_body('post', self.fakefeed)
+    self.assertEquals(204, self.response_code())
+    self.assertEquals([(self.topic, self.fakefeed)], self.parsed)
+
+  def testChunkedRead(self):
+    """Tests that the signature covers a body read in several chunks."""
+    old_chunk_bytes = fat_publish.READ_CHUNK_BYTES
+    fat_publish.READ_CHUNK_BYTES = 5
+    try:
+      self.success = True
+      self.handle_body('post', self.fakefeed)
+    finally:
+      fat_publish.READ_CHUNK_BYTES = old_chunk_bytes
+    self.assertEquals(204, self.response_code())
+    self.assertEquals([(self.topic, self.fakefeed)], self.parsed)
+
+  def testBareSignature(self):
+    """Tests a signature header without the 'sha1=' prefix."""
+    self.success = True
+    os.environ['HTTP_X_HUB_SIGNATURE'] = self.fakefeed_signature
+    self.handle_body('post', self.fakefeed)
+    self.assertEquals(204, self.response_code())
+
+  def testNoSubscribers(self):
+    """Tests that the body is not parsed when there are no subscribers."""
+    self.success = True
+    main.Subscription.remove('callback', self.topic)
+    self.handle_body('post', self.fakefeed)
+    self.assertEquals(204, self.response_code())
+    self.assertEquals([], self.parsed)
+
+  def testParseFails(self):
+    """Tests when parsing fails."""
+    self.handle_body('post', self.fakefeed)
+    self.assertEquals(400, self.response_code())
+
+  def testBadSignature(self):
+    """Tests when the signature is present but invalid."""
+    self.success = True
+    os.environ['HTTP_X_HUB_SIGNATURE'] = 'sha1=bad'
+    self.handle_body('post', self.fakefeed)
+    self.assertEquals(403, self.response_code())
+    self.assertEquals([], self.parsed)
+
+  def testMissingHeaders(self):
+    """Tests when the topic or signature headers are missing."""
+    self.success = True
+    del os.environ['HTTP_X_HUB_SIGNATURE']
+    self.handle_body('post', self.fakefeed)
+    self.assertEquals(400, self.response_code())
+
+    os.environ['HTTP_X_HUB_SIGNATURE'] = 'sha1=' + self.fakefeed_signature
+    del os.environ['HTTP_X_HUB_TOPIC']
+    self.handle_body('post', self.fakefeed)
+    self.assertEquals(400, self.response_code())
+    self.assertEquals([], self.parsed)
+
+
 class FatPublishHookTest(unittest.TestCase):
   """Tests for the FatPublishHook class."""
 
@@ -160,6 +253,17 @@ class FatPublishHookTest(unittest.TestCase):
     self.assertEquals(original_handlers + [(r'/fatping', fat_handler)],
                       handlers)
 
+  def testCreateHook_raw(self):
+    """Tests creating a hook with a raw body handler."""
+    fat_handler = object()
+    raw_handler = object()
+    hook = fat_publish.FatPublishHook(fat_handler, raw_handler)
+    handlers = []
+    self.assertFalse(hook.inspect((handlers,), {}))
+    self.assertEquals([(r'/fatping', fat_handler),
+                       (r'/fatping/raw', raw_handler)],
+                      handlers)
+
 ################################################################################
 
 if __name__ == '__main__':
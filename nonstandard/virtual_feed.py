@@ -30,10 +30,12 @@ together by their virtual feed topics into a combined payload, which is then
 injected into the reference hub's event delivery pipeline. This collation is
 useful because it controls how many HTTP requests will be sent to subscribers
 to this virtual feed, and lets you make the tradeoff between delivery latency
-and request overhead.
+and request overhead. Entries that appear in several fat pings are delivered
+once, newest first, and the combined payload is capped in size.
 """
 
 import logging
+import time
 
 from google.appengine.ext import db
 from google.appengine.ext import webapp
@@ -43,8 +45,13 @@ import fork_join_queue
 ################################################################################
 # Constants
 
+# Task queue on which fragments are collated.
 VIRTUAL_FEED_QUEUE = 'virtual-feeds'
 
+# Maximum size in bytes of the entries collated into one virtual feed event.
+# The newest entries are kept when there are more.
+MAX_COLLATED_PAYLOAD_BYTES = 512 * 1024
+
 ################################################################################
 
 # Define these symbols for testing.
@@ -65,32 +72,65 @@ class FeedFragment(db.Model):
     topic: The topic of the virtual feed being collated.
     header_footer: The feed envelope.
     entries: The <entry>...</entry> text segments that were parsed from the
-      source feeds, already joined together with newlines.
+      source feeds, already joined together with newlines. Only present on
+      fragments injected before entry_list was added.
+    entry_list: The <entry>...</entry> text segments of this fragment.
+    entry_ids: The sha1 hashes of the IDs of the entries in entry_list.
+    created: UNIX timestamp of when the fragment was injected.
     format: 'rss' or 'atom'.
   """
   topic = db.TextProperty()
   header_footer = db.TextProperty()
   entries = db.TextProperty()
+  entry_list = db.ListProperty(db.Text)
+  entry_ids = db.StringListProperty()
+  created = db.FloatProperty()
   format = db.TextProperty()
 
 
-VIRTUAL_FEED_QUEUE = fork_join_queue.MemcacheForkJoinQueue(
-    FeedFragment,
-    None,
-    '/work/virtual_feeds',
-    VIRTUAL_FEED_QUEUE,
-    batch_size=20,
-    batch_period_ms=1000,
-    lock_timeout_ms=1000,
-    sync_timeout_ms=250,
-    stall_timeout_ms=30000,
-    acquire_timeout_ms=10,
-    acquire_attempts=50,
-    shard_count=1,
-    expiration_seconds=60)  # Give up on fragments after 60 seconds.
+def get_queue_name(topic):
+  """Returns the fork-join queue name of the virtual feed for a topic."""
+  # The trailing dash separates the topic hash from the rest of task names.
+  return 'fjq-%s-%s-' % (FeedFragment.kind(), sha1_hash(topic))
+
+
+def get_virtual_feed_queue(name):
+  """Creates the fork-join queue that collates fragments for a virtual feed.
 
+  Each virtual feed topic has its own logical queue, so concurrent requests
+  for different topics never share queue state.
+
+  Args:
+    name: The name of the queue, as returned by get_queue_name().
 
-def inject_virtual_feed(topic, format, header_footer, entries_map):
+  Returns:
+    The MemcacheForkJoinQueue for the virtual feed.
+  """
+  return fork_join_queue.MemcacheForkJoinQueue(
+      FeedFragment,
+      None,
+      '/work/virtual_feeds',
+      VIRTUAL_FEED_QUEUE,
+      name=name,
+      batch_size=20,
+      batch_period_ms=1000,
+      lock_timeout_ms=1000,
+      sync_timeout_ms=250,
+      stall_timeout_ms=30000,
+      acquire_timeout_ms=10,
+      acquire_attempts=50,
+      shard_count=1,
+      expiration_seconds=60)  # Give up on fragments after 60 seconds.
+
+
+def get_virtual_feed_queue_for_task(task_name):
+  """Returns the fork-join queue that a collation task belongs to."""
+  name, rest = task_name.split('--', 1)
+  return get_virtual_feed_queue(name + '-')
+
+
+def inject_virtual_feed(topic, format, header_footer, entries_map,
+                        now=time.time):
   """Injects a virtual feed update to be collated and then delievered.
 
   Args:
@@ -99,28 +139,107 @@ def inject_virtual_feed(topic, format, header_footer, entries_map):
     header_footer: The feed envelope to use for the whole virtual feed.
     entries_map: Dictionary mapping feed entry IDs to strings containing
       full entry payloads (e.g., from <entry> to </entry> including the tags).
+    now: Returns the current time as a UNIX timestamp. Used in tests.
 
   Raises:
     MemcacheError if the virtual feed could not be injected.
   """
+  entry_ids, entry_list = [], []
+  for entry_id, entry_payload in entries_map.iteritems():
+    entry_ids.append(sha1_hash(entry_id))
+    entry_list.append(db.Text(entry_payload))
   fragment = FeedFragment(
       key=db.Key.from_path(FeedFragment.kind(), 'unused'),
       topic=topic,
       header_footer=header_footer,
-      entries='\n'.join(entries_map.values()),
+      entry_list=entry_list,
+      entry_ids=entry_ids,
+      created=now(),
       format=format)
 
-  # Update the name of the queue to include a hash of the topic URL. This
-  # allows us to use a single VIRTUAL_FEED_QUEUE instance to represent a
-  # different logical queue for each virtual feed topic we would like to
-  # collate.
-  VIRTUAL_FEED_QUEUE.name = 'fjq-%s-%s-' % (
-      FeedFragment.kind(), sha1_hash(topic))
-  work_index = VIRTUAL_FEED_QUEUE.next_index()
+  queue = get_virtual_feed_queue(get_queue_name(topic))
+  work_index = queue.next_index()
   try:
-    VIRTUAL_FEED_QUEUE.put(work_index, [fragment])
+    queue.put(work_index, [fragment])
   finally:
-    VIRTUAL_FEED_QUEUE.add(work_index)
+    queue.add(work_index)
+
+
+def _merge_entries(fragment_list, max_bytes):
+  """Merges the entries of fragments for one topic, newest fragment first.
+
+  Args:
+    fragment_list: List of FeedFragment instances, newest first.
+    max_bytes: Maximum size of the merged entries.
+
+  Returns:
+    List of entry payloads in order of newest to oldest.
+  """
+  seen_ids = set()
+  entry_payloads = []
+  size = 0
+  dropped = 0
+  for fragment in fragment_list:
+    if fragment.entry_ids:
+      entry_pairs = zip(fragment.entry_ids, fragment.entry_list)
+    elif fragment.entries:
+      # Older fragments have no entry IDs and cannot be deduped.
+      entry_pairs = [(None, fragment.entries)]
+    else:
+      entry_pairs = []
+
+    for entry_id, entry_payload in entry_pairs:
+      if entry_id is not None:
+        if entry_id in seen_ids:
+          continue
+        seen_ids.add(entry_id)
+      if entry_payloads and size + len(entry_payload) > max_bytes:
+        dropped += 1
+        continue
+      size += len(entry_payload)
+      entry_payloads.append(entry_payload)
+
+  if dropped:
+    logging.warning('Dropped %d entries of virtual topic %r to stay within '
+                    '%d bytes', dropped, fragment_list[0].topic, max_bytes)
+  return entry_payloads
+
+
+def collate_fragments(fragment_list, max_bytes=None):
+  """Merges the fragments of virtual feeds into one update per topic.
+
+  Fragments are merged newest first. An entry that appears in several
+  fragments is only included once, from the newest fragment it is in. Once
+  the entries for a topic reach max_bytes, the older entries are dropped;
+  the newest entry is always included.
+
+  Args:
+    fragment_list: List of FeedFragment instances.
+    max_bytes: Maximum size of the entries for each topic; defaults to
+      MAX_COLLATED_PAYLOAD_BYTES.
+
+  Returns:
+    List of (newest fragment, entry payloads) tuples, one per topic, with the
+    entry payloads in order of newest to oldest.
+  """
+  if max_bytes is None:
+    max_bytes = MAX_COLLATED_PAYLOAD_BYTES
+
+  # Sort on the position as well so later fragments win timestamp ties.
+  ordered = sorted(enumerate(fragment_list),
+                   key=lambda pair: (pair[1].created or 0, pair[0]),
+                   reverse=True)
+  topic_list = []
+  topic_fragments = {}
+  for unused, fragment in ordered:
+    if fragment.topic not in topic_fragments:
+      topic_list.append(fragment.topic)
+      topic_fragments[fragment.topic] = []
+    topic_fragments[fragment.topic].append(fragment)
+
+  return [(topic_fragments[topic][0],
+           _merge_entries(topic_fragments[topic], max_bytes))
+          for topic in topic_list]
 
 
 class CollateFeedHandler(webapp.RequestHandler):
@@ -128,36 +247,33 @@ class CollateFeedHandler(webapp.RequestHandler):
 
   @work_queue_only
   def post(self):
-    # Restore the pseudo-name of the queue so we can properly pop tasks
-    # from it for the specific virtual feed this task is targetting.
     task_name = self.request.headers['X-AppEngine-TaskName']
-    VIRTUAL_FEED_QUEUE.name, rest = task_name.split('--')
-    VIRTUAL_FEED_QUEUE.name += '-'
-
-    fragment_list = VIRTUAL_FEED_QUEUE.pop_request(self.request)
+    queue = get_virtual_feed_queue_for_task(task_name)
+    fragment_list = queue.pop_request(self.request)
     if not fragment_list:
       logging.warning('Pop of virtual feed task %r found no fragments.',
                       task_name)
       return
 
-    fragment = fragment_list[0]
-    entry_payloads = [f.entries for f in fragment_list]
-
-    def txn():
-      event_to_deliver = EventToDeliver.create_event_for_topic(
-          fragment.topic,
-          fragment.format,
-          self.request.headers.get('Content-Type', 'application/atom+xml'),
-          fragment.header_footer,
-          entry_payloads,
-          set_parent=False,
-          max_failures=1)
-      db.put(event_to_deliver)
-      event_to_deliver.enqueue()
-
-    db.run_in_transaction(txn)
-    logging.debug('Injected %d fragments for virtual topic %r',
-                  len(fragment_list), fragment.topic)
+    content_type = self.request.headers.get(
+        'Content-Type', 'application/atom+xml')
+    for fragment, entry_payloads in collate_fragments(fragment_list):
+      def txn():
+        event_to_deliver = EventToDeliver.create_event_for_topic(
+            fragment.topic,
+            fragment.format,
+            content_type,
+            fragment.header_footer,
+            entry_payloads,
+            set_parent=False,
+            max_failures=1)
+        db.put(event_to_deliver)
+        event_to_deliver.enqueue()
+
+      db.run_in_transaction(txn)
+      logging.debug('Injected %d entries from %d fragments for virtual '
+                    'topic %r', len(entry_payloads), len(fragment_list),
+                    fragment.topic)
 
 
 class VirtualFeedHook(Hook):
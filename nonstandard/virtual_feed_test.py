@@ -31,6 +31,7 @@ sys.path.insert(0, os.getcwd())
 import testutil
 testutil.fix_path()
 
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 
 import main
@@ -59,7 +60,7 @@ class InjectVirtualFeedTest(testutil.HandlerTestBase):
       'three': '<entry>third data</entry>',
     }
     os.environ['CURRENT_VERSION_ID'] = 'my-version.1234'
-    virtual_feed.VIRTUAL_FEED_QUEUE.queue_name = 'default'
+    virtual_feed.VIRTUAL_FEED_QUEUE = 'default'
 
   def testInsertOneFragment(self):
     """Tests inserting one new fragment."""
@@ -69,17 +70,20 @@ class InjectVirtualFeedTest(testutil.HandlerTestBase):
     self.assertTrue(task['name'].startswith(
         'fjq-FeedFragment-54124f41c1ea6e67e4beacac85b9f015e6830d41--'
         'my-version-'))
-    results = virtual_feed.VIRTUAL_FEED_QUEUE.pop(task['name'])
+    queue = virtual_feed.get_virtual_feed_queue_for_task(task['name'])
+    results = queue.pop(task['name'])
     self.assertEquals(1, len(results))
     fragment = results[0]
     self.assertEquals(self.topic, fragment.topic)
     self.assertEquals(self.header_footer, fragment.header_footer)
     self.assertEquals(self.format, fragment.format)
     self.assertEquals(
-        '<entry>third data</entry>\n'  # Hash order
-        '<entry>second data</entry>\n'
-        '<entry>first data</entry>',
-        fragment.entries)
+        ['<entry>third data</entry>',  # Hash order
+         '<entry>second data</entry>',
+         '<entry>first data</entry>'],
+        fragment.entry_list)
+    self.assertEquals([main.sha1_hash(i) for i in ('three', 'two', 'one')],
+                      fragment.entry_ids)
 
   def testInsertMultipleFragments(self):
     """Tests inserting multiple fragments on different virtual topics."""
@@ -96,14 +100,19 @@ class InjectVirtualFeedTest(testutil.HandlerTestBase):
         'fjq-FeedFragment-0449375bf584a7a5d3a09b344a726dead30c3927--'
         'my-version-'))
 
-    virtual_feed.VIRTUAL_FEED_QUEUE.name = \
-        'fjq-FeedFragment-54124f41c1ea6e67e4beacac85b9f015e6830d41-'
-    fragment1 = virtual_feed.VIRTUAL_FEED_QUEUE.pop(task1['name'])[0]
+    queue1 = virtual_feed.get_virtual_feed_queue(
+        virtual_feed.get_queue_name(self.topic))
+    self.assertEquals(
+        'fjq-FeedFragment-54124f41c1ea6e67e4beacac85b9f015e6830d41-',
+        queue1.name)
+    fragment1 = queue1.pop(task1['name'])[0]
     self.assertEquals(self.topic, fragment1.topic)
 
-    virtual_feed.VIRTUAL_FEED_QUEUE.name = \
-        'fjq-FeedFragment-0449375bf584a7a5d3a09b344a726dead30c3927-'
-    fragment2 = virtual_feed.VIRTUAL_FEED_QUEUE.pop(task2['name'])[0]
+    queue2 = virtual_feed.get_virtual_feed_queue_for_task(task2['name'])
+    self.assertEquals(
+        'fjq-FeedFragment-0449375bf584a7a5d3a09b344a726dead30c3927-',
+        queue2.name)
+    fragment2 = queue2.pop(task2['name'])[0]
     self.assertEquals(self.topic2, fragment2.topic)
 
 
@@ -125,7 +134,7 @@ class CollateFeedHandlerTest(testutil.HandlerTestBase):
       'three': '<entry>third data</entry>',
     }
     os.environ['CURRENT_VERSION_ID'] = 'my-version.1234'
-    virtual_feed.VIRTUAL_FEED_QUEUE.queue_name = 'default'
+    virtual_feed.VIRTUAL_FEED_QUEUE = 'default'
 
   def testNoWork(self):
     """Tests when the queue is empty."""
@@ -165,7 +174,7 @@ class CollateFeedHandlerTest(testutil.HandlerTestBase):
     self.assertEquals(str(event.key()), task['params']['event_key'])
 
   def testMultipleFragments(self):
-    """Tests when there is more than one fragment in the queue."""
+    """Tests that entries in more than one fragment are only sent once."""
     virtual_feed.inject_virtual_feed(
         self.topic, self.format, self.header_footer, self.entries_map)
     virtual_feed.inject_virtual_feed(
@@ -185,9 +194,80 @@ class CollateFeedHandlerTest(testutil.HandlerTestBase):
       '<entry>third data</entry>\n'
       '<entry>second data</entry>\n'
       '<entry>first data</entry>\n'
-      '<entry>third data</entry>\n'
+      '</feed>',
+      event.payload)
+
+  def testNewestFirst(self):
+    """Tests that entries are ordered and deduped newest fragment first."""
+    virtual_feed.inject_virtual_feed(
+        self.topic, self.format, self.header_footer,
+        {'one': '<entry>old first</entry>'}, now=lambda: 2.0)
+    virtual_feed.inject_virtual_feed(
+        self.topic, self.format, self.header_footer,
+        {'one': '<entry>new first</entry>'}, now=lambda: 3.0)
+    virtual_feed.inject_virtual_feed(
+        self.topic, self.format, self.header_footer,
+        {'two': '<entry>oldest second</entry>'}, now=lambda: 1.0)
+    task = testutil.get_tasks('default', index=0, expected_count=1)
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = task['name']
+    self.handle('post')
+
+    event = main.EventToDeliver.all().get()
+    self.assertEquals(
+      '<?xml version="1.0" encoding="utf-8"?>\n'
+      '<feed><id>tag:my-id</id>\n\n'
+      '<entry>new first</entry>\n'
+      '<entry>oldest second</entry>\n'
+      '</feed>',
+      event.payload)
+
+  def testPayloadCap(self):
+    """Tests that the oldest entries are dropped over the size limit."""
+    old_max = virtual_feed.MAX_COLLATED_PAYLOAD_BYTES
+    virtual_feed.MAX_COLLATED_PAYLOAD_BYTES = 30
+    try:
+      virtual_feed.inject_virtual_feed(
+          self.topic, self.format, self.header_footer,
+          {'one': '<entry>first data</entry>'}, now=lambda: 1.0)
+      virtual_feed.inject_virtual_feed(
+          self.topic, self.format, self.header_footer,
+          {'two': '<entry>second data</entry>'}, now=lambda: 2.0)
+      task = testutil.get_tasks('default', index=0, expected_count=1)
+      os.environ['HTTP_X_APPENGINE_TASKNAME'] = task['name']
+      self.handle('post')
+    finally:
+      virtual_feed.MAX_COLLATED_PAYLOAD_BYTES = old_max
+
+    event = main.EventToDeliver.all().get()
+    self.assertEquals(
+      '<?xml version="1.0" encoding="utf-8"?>\n'
+      '<feed><id>tag:my-id</id>\n\n'
       '<entry>second data</entry>\n'
+      '</feed>',
+      event.payload)
+
+  def testLegacyFragment(self):
+    """Tests collating fragments injected with joined entries."""
+    queue = virtual_feed.get_virtual_feed_queue(
+        virtual_feed.get_queue_name(self.topic))
+    work_index = queue.next_index()
+    queue.put(work_index, [virtual_feed.FeedFragment(
+        key=db.Key.from_path(virtual_feed.FeedFragment.kind(), 'unused'),
+        topic=self.topic,
+        header_footer=self.header_footer,
+        entries='<entry>first data</entry>\n<entry>second data</entry>',
+        format=self.format)])
+    queue.add(work_index)
+    task = testutil.get_tasks('default', index=0, expected_count=1)
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = task['name']
+    self.handle('post')
+
+    event = main.EventToDeliver.all().get()
+    self.assertEquals(
+      '<?xml version="1.0" encoding="utf-8"?>\n'
+      '<feed><id>tag:my-id</id>\n\n'
       '<entry>first data</entry>\n'
+      '<entry>second data</entry>\n'
       '</feed>',
       event.payload)
 